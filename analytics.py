@@ -0,0 +1,176 @@
+"""
+Demand rollups for the admin heatmaps.
+
+rollup_demand() reads request_events past a stored watermark and folds them
+into small per hour x service x geohash-cell tables. Each pass only touches
+new events, and the heatmap queries only read the aggregates.
+
+Time-to-assign is kept as a histogram per cell so medians can be combined
+across cells and hours; the median is read from the bucket it falls in.
+"""
+from datetime import datetime
+
+from spatial import geohash, geohash_center, parse_point
+
+GEOHASH_PRECISION = 5
+ROLLUP_BATCH_SIZE = 5000
+# upper bounds in seconds of the time-to-assign histogram buckets; the last is open
+ASSIGN_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+NO_LOCATION = ''
+
+NEW_EVENTS_QUERY = '''
+    SELECT e.event_id, e.from_status, e.to_status, e.ts, sr.service_type_id,
+           sr.user_latitude, sr.user_longitude,
+           (SELECT c.ts FROM request_events c
+            WHERE c.request_id = e.request_id AND c.from_status IS NULL) AS created_ts
+    FROM request_events e
+    JOIN service_requests sr ON sr.request_id = e.request_id
+    WHERE e.event_id > ?
+    ORDER BY e.event_id
+    LIMIT ?
+'''
+
+
+def _bucket(seconds):
+    for i, bound in enumerate(ASSIGN_BUCKETS):
+        if seconds <= bound:
+            return i
+    return len(ASSIGN_BUCKETS)
+
+
+def _cell(row):
+    try:
+        point = parse_point(row['user_latitude'], row['user_longitude'])
+    except ValueError:
+        # a row that cannot be placed must not stall the watermark
+        return NO_LOCATION
+    return geohash(*point, GEOHASH_PRECISION) if point else NO_LOCATION
+
+
+def rollup_demand(conn, batch_size=ROLLUP_BATCH_SIZE):
+    """Fold request_events past the watermark into the demand tables.
+
+    Each batch and its watermark commit together under the write lock, so
+    events are counted exactly once even with several workers running this.
+    Returns the number of events processed.
+    """
+    processed = 0
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("SELECT last_event_id FROM rollup_watermarks WHERE name = 'demand'").fetchone()
+            watermark = row[0] if row else 0
+            events = conn.execute(NEW_EVENTS_QUERY, (watermark, batch_size)).fetchall()
+            if not events:
+                conn.rollback()
+                return processed
+
+            counts = {}    # (hour, service, cell) -> [requests, assigned, cancelled]
+            latency = {}   # (hour, service, cell, bucket) -> count
+            for event in events:
+                if event['created_ts'] is None:
+                    continue
+                # everything is counted against the hour the request was made
+                key = (event['created_ts'][:13] + ':00', event['service_type_id'], _cell(event))
+                totals = counts.setdefault(key, [0, 0, 0])
+                if event['from_status'] is None:
+                    totals[0] += 1
+                elif event['to_status'] == 'accepted':
+                    totals[1] += 1
+                    waited = (datetime.fromisoformat(event['ts'])
+                              - datetime.fromisoformat(event['created_ts'])).total_seconds()
+                    bucket_key = key + (_bucket(waited),)
+                    latency[bucket_key] = latency.get(bucket_key, 0) + 1
+                elif event['to_status'] == 'cancelled':
+                    totals[2] += 1
+
+            conn.executemany('''
+                INSERT INTO demand_hourly (hour, service_type_id, geohash, requests, assigned, cancelled)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (hour, service_type_id, geohash) DO UPDATE SET
+                    requests = requests + excluded.requests,
+                    assigned = assigned + excluded.assigned,
+                    cancelled = cancelled + excluded.cancelled
+            ''', [key + tuple(totals) for key, totals in counts.items()])
+            conn.executemany('''
+                INSERT INTO assign_latency_hourly (hour, service_type_id, geohash, bucket, count)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (hour, service_type_id, geohash, bucket) DO UPDATE SET count = count + excluded.count
+            ''', [key + (count,) for key, count in latency.items()])
+            conn.execute("INSERT OR REPLACE INTO rollup_watermarks (name, last_event_id) VALUES ('demand', ?)",
+                         (events[-1]['event_id'],))
+            conn.commit()
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+        processed += len(events)
+        if len(events) < batch_size:
+            return processed
+
+
+def median_seconds(histogram):
+    """Upper bound of the bucket holding the median, from {bucket: count}.
+
+    A median in the open last bucket is reported as its lower bound.
+    """
+    total = sum(histogram.values())
+    if not total:
+        return None
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen * 2 >= total:
+            return ASSIGN_BUCKETS[min(bucket, len(ASSIGN_BUCKETS) - 1)]
+    return None
+
+
+def demand_heatmap(conns, start_hour, end_hour, service_type_id=None):
+    """Per-cell demand between two 'YYYY-MM-DD HH:00' hours (end exclusive).
+
+    `conns` holds one connection per shard, each with its own rollups.
+
+    Returns {'cells': [...], 'hours': [...]}: totals per geohash cell, and
+    per hour across all cells, each with fill rate and median time-to-assign.
+    """
+    where = 'hour >= ? AND hour < ?'
+    params = [start_hour, end_hour]
+    if service_type_id is not None:
+        where += ' AND service_type_id = ?'
+        params.append(service_type_id)
+
+    cells, hours = {}, {}
+    for conn in conns:
+        for row in conn.execute(f'''
+            SELECT hour, geohash, SUM(requests), SUM(assigned), SUM(cancelled)
+            FROM demand_hourly WHERE {where}
+            GROUP BY hour, geohash
+        ''', params):
+            hour, cell, requests, assigned, cancelled = row
+            for groups, key in ((cells, cell), (hours, hour)):
+                entry = groups.setdefault(key, {'requests': 0, 'assigned': 0, 'cancelled': 0, 'histogram': {}})
+                entry['requests'] += requests
+                entry['assigned'] += assigned
+                entry['cancelled'] += cancelled
+        for hour, cell, bucket, count in conn.execute(f'''
+            SELECT hour, geohash, bucket, SUM(count)
+            FROM assign_latency_hourly WHERE {where}
+            GROUP BY hour, geohash, bucket
+        ''', params):
+            for groups, key in ((cells, cell), (hours, hour)):
+                histogram = groups.setdefault(key, {'requests': 0, 'assigned': 0, 'cancelled': 0, 'histogram': {}})['histogram']
+                histogram[bucket] = histogram.get(bucket, 0) + count
+
+    def finish(entry):
+        histogram = entry.pop('histogram')
+        entry['fill_rate'] = round(entry['assigned'] / entry['requests'], 3) if entry['requests'] else None
+        entry['median_assign_seconds'] = median_seconds(histogram)
+        return entry
+
+    cell_rows = []
+    for cell, entry in sorted(cells.items(), key=lambda item: -item[1]['requests']):
+        entry = finish(entry)
+        entry['geohash'] = cell or None
+        entry['lat'], entry['lon'] = geohash_center(cell) if cell else (None, None)
+        cell_rows.append(entry)
+    hour_rows = [dict(finish(entry), hour=hour) for hour, entry in sorted(hours.items())]
+    return {'cells': cell_rows, 'hours': hour_rows}
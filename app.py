@@ -1,9 +1,35 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
-import sqlite3
-import math
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, has_app_context, has_request_context, abort, Response, stream_with_context
+import base64
+import click
+import csv
+import functools
+import hashlib
+import hmac
+import io
+import json
+from datetime import datetime, timedelta, timezone
 import os
+import tempfile
+import time
+from analytics import GEOHASH_PRECISION, demand_heatmap, rollup_demand
+from db import REPLICA_PRAGMAS, ConnectionPool, ShardConnectionPool, query_log, replica_synced_at, sync_replica
+from events import ChangeFeed, ShardedChangeFeed, sse_stream
+from bulk_import import IMPORT_FORMATS, import_helpers, read_rows
+from cache import IdentityCache, VersionedCache
+from jobs import JobScheduler
+from matching import min_distance_assignment
+from metrics import COUNT_BUCKETS, MetricsRegistry, QueryProfiler
+from passwords import HasherBusy, PasswordHasher, tune_scrypt
+from repository import (
+    ADMIN_HELPERS_QUERY, ADMIN_USERS_QUERY, API_REQUESTS_QUERIES, API_REQUESTS_VERSION_QUERIES, CHANGES_QUERIES,
+    IDENTITY_QUERIES, PENDING_HELPERS_QUERY, RECENT_REQUESTS_QUERY, REQUEST_EVENTS_QUERY, USER_REQUESTS_QUERY,
+    HELPER_REQUESTS_QUERY, SERVICES_QUERY, DuplicateAccount, Repository,
+)
+from sessions import ServerSideSessionInterface, SQLiteSessionStore
+from shards import HOME_SHARD, ShardRouter, ShardedRepository, first_id, shard_of
+from spatial import DISPATCH_HELPERS_QUERY, HelperIndexRegistry, haversine_km, parse_point
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import is_resource_modified
 
 app = Flask(__name__)
 app.secret_key = 'nearfix_secret_key_2024'
@@ -11,14 +37,195 @@ app.secret_key = 'nearfix_secret_key_2024'
 # SQLite Database Configuration
 DATABASE = 'nearfix.db'
 
+# Region shards, see shards.py: (database path, geohash prefixes) per region.
+# Helpers and requests located in a region live in its file; the rest, and
+# all accounts, stay in DATABASE. A shard's number is part of every helper
+# and request id it hands out, so only append here.
+SHARDS = [
+    # ('nearfix-delhi.db', ('ttn', 'ttp')),
+]
+shard_router = ShardRouter([prefixes for _, prefixes in SHARDS])
+ALL_SHARDS = range(shard_router.count)
+
+# Nearest-helper lookup, per shard one spatial index per service type
+helper_indexes = [HelperIndexRegistry() for _ in ALL_SHARDS]
+DISPATCH_BATCH_SIZE = 100
+# batch matcher: helpers considered per request, and requests per sweep
+MATCH_CANDIDATES = 8
+MATCH_BATCH_LIMIT = 2000
+# Request lifecycle, the service_requests status ENUM in database.sql:
+# status -> statuses it may move to. Migration 8 enforces the same table.
+REQUEST_TRANSITIONS = {
+    'pending': ('accepted', 'cancelled'),
+    'accepted': ('in_progress', 'cancelled'),
+    'in_progress': ('work_done_by_helper', 'cancelled'),
+    'work_done_by_helper': ('completed',),
+    'completed': (),
+    'cancelled': (),
+}
+# moves a helper may make from their dashboard
+HELPER_STATUSES = ('in_progress', 'work_done_by_helper', 'cancelled')
+# requests in these states hold one of their helper's job slots
+ACTIVE_STATUSES = ('accepted', 'in_progress')
+# moves a user may make: confirming finished work
+USER_STATUSES = ('completed',)
+
+# Password hashing runs on a bounded process pool. Changing the method/cost
+# here upgrades each stored hash the next time its owner logs in.
+# Every web worker process has its own pool and queue, so set WEB_CONCURRENCY
+# to the number of them on this host (gunicorn --workers); the pools then
+# share the CPUs instead of each taking all of them.
+WEB_CONCURRENCY = 1
+PASSWORD_HASH_METHOD = 'scrypt:32768:8:1'
+PASSWORD_HASH_WORKERS = None   # per web worker; default: CPUs // WEB_CONCURRENCY, at least 1
+PASSWORD_HASH_QUEUE = None     # waiting hashes before 503, per web worker; default: 4 per hashing worker
+password_hasher = PasswordHasher(PASSWORD_HASH_METHOD, PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE,
+                                 WEB_CONCURRENCY)
+
+# Admin helper imports: the upload is stored in IMPORT_DIR and imported by
+# the run_helper_imports job, which records its progress in helper_imports.
+# Request bodies over MAX_UPLOAD_BYTES, the import file included, get a 413.
+IMPORT_DIR = 'imports'
+MAX_UPLOAD_BYTES = 32 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+# Services catalog, written only by add_service. Loaded on the caller's
+# connection: the dispatcher reads it mid-transaction, and a second checkout
+# of the same thread's connection would roll that transaction back on release.
+# Each shard's dispatcher reads that shard's copy.
+services_caches = [VersionedCache('services', lambda conn: conn.execute(SERVICES_QUERY).fetchall())
+                   for _ in ALL_SHARDS]
+services_cache = services_caches[HOME_SHARD]
+
+# Periodic maintenance, started with the first request
+jobs = JobScheduler()
+
+# Route and query metrics, served at /metrics. Statements slower than
+# SLOW_QUERY_MS are logged to the nearfix.sql logger, a sample of them with
+# their query plan; None leaves the slow-query log off.
+SLOW_QUERY_MS = None
+SLOW_QUERY_EXPLAIN_RATE = 0.1
+# bearer token a Prometheus scraper sends; without one only admins see /metrics
+METRICS_TOKEN = None
+metrics = MetricsRegistry()
+route_durations = metrics.histogram('nearfix_http_request_duration_seconds', 'Time to produce a response',
+                                    ('endpoint', 'method', 'status'))
+route_queries = metrics.histogram('nearfix_http_request_queries', 'Statements run while handling a request',
+                                  ('endpoint',), COUNT_BUCKETS)
+query_profiler = QueryProfiler(metrics, SLOW_QUERY_MS, SLOW_QUERY_EXPLAIN_RATE)
+
+db_pool = ConnectionPool(DATABASE, profiler=query_profiler)
+# Shard 0 is DATABASE. Request handlers open the others with DATABASE
+# attached for users; background jobs, which lock the whole file set with
+# BEGIN IMMEDIATE, open them on their own.
+shard_pools = [db_pool] + [ShardConnectionPool(path, DATABASE, profiler=query_profiler) for path, _ in SHARDS]
+job_pools = [db_pool] + [ConnectionPool(path, profiler=query_profiler) for path, _ in SHARDS]
+
+# Read replica for dashboards and admin listings: a copy of DATABASE that
+# the sync_read_replica job refreshes with SQLite's backup API. A session
+# that has just written reads from DATABASE until a sync picks the write up.
+# None serves every read from DATABASE.
+REPLICA_DATABASE = None   # e.g. 'nearfix-replica.db'
+REPLICA_SYNC_SECONDS = 60
+replica_pool = ConnectionPool(REPLICA_DATABASE, REPLICA_PRAGMAS, query_profiler) if REPLICA_DATABASE else None
+
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Connection for the current app context, reused until teardown"""
+    if not has_app_context():
+        return db_pool.acquire()
+    if 'db' not in g:
+        g.db = db_pool.acquire(scoped=True)
+    return g.db
+
+def get_read_connection():
+    """Connection for reads that may lag a few seconds: the replica, unless
+    it has not synced since this session last wrote"""
+    if replica_pool is None or not has_request_context():
+        return get_db_connection()
+    if 'read_db' not in g:
+        replica = replica_pool.acquire(scoped=True)
+        synced_at = replica_synced_at(replica)
+        if synced_at is None or synced_at < session.get('wrote_at', 0):
+            replica.release()
+            replica = None
+        g.read_db = replica
+    return g.read_db or get_db_connection()
+
+def get_shard_connection(shard):
+    """Connection to a shard for the current app context"""
+    if shard == HOME_SHARD:
+        return get_db_connection()
+    if not has_app_context():
+        return shard_pools[shard].acquire()
+    shard_dbs = g.setdefault('shard_dbs', {})
+    if shard not in shard_dbs:
+        shard_dbs[shard] = shard_pools[shard].acquire(scoped=True)
+    return shard_dbs[shard]
+
+def get_job_connection(shard):
+    """Connection to a shard for background jobs and schema upkeep"""
+    if shard == HOME_SHARD:
+        return get_db_connection()
+    return job_pools[shard].acquire()
+
+def note_session_write():
+    """Remember when this session last wrote, for get_read_connection()"""
+    if replica_pool is not None and has_request_context():
+        session['wrote_at'] = time.time()
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    stop_query_log()
+    for name in ('db', 'read_db'):
+        conn = g.pop(name, None)
+        if conn is not None:
+            conn.release()
+    for conn in g.pop('shard_dbs', {}).values():
+        conn.release()
 
-def init_database():
-    if not os.path.exists(DATABASE):
-        conn = get_db_connection()
+# Every query the routes run; see repository.py
+repo = Repository(get_db_connection, get_read_connection, note_session_write)
+if SHARDS:
+    repo = ShardedRepository(shard_router, [repo] + [Repository(functools.partial(get_shard_connection, shard))
+                                                     for shard in ALL_SHARDS[1:]])
+
+# Sessions live in the database; the cookie only carries the session id.
+# sessions.MemorySessionStore works too when running a single process.
+session_store = SQLiteSessionStore(get_db_connection)
+app.session_interface = ServerSideSessionInterface(session_store)
+
+# session key -> account kind, for the logged-in identity checks
+SESSION_ACCOUNTS = {'user_id': 'user', 'helper_id': 'helper', 'admin_id': 'admin'}
+
+def load_identity(kind):
+    def load(account_id):
+        return repo.identity(kind, account_id)
+    return load
+
+# Profile rows of logged-in accounts, so each request need not refetch them
+identity_cache = IdentityCache({kind: load_identity(kind) for kind in IDENTITY_QUERIES})
+
+# request_events pushed to open dashboards, one poller per worker process
+change_feed = ChangeFeed(get_db_connection)
+if SHARDS:
+    change_feed = ShardedChangeFeed([ChangeFeed(functools.partial(get_job_connection, shard), shard=shard)
+                                     for shard in ALL_SHARDS])
+
+metrics.gauge('nearfix_db_connections_in_use', 'Pooled connections checked out',
+              lambda: db_pool.stats()['in_use'])
+metrics.gauge('nearfix_password_hashes_pending', 'Password hashes queued or running',
+              lambda: password_hasher.stats()['pending'])
+metrics.gauge('nearfix_cache_hits_total', 'In-process cache hits', lambda: {
+    ('services',): services_cache.hits, ('identity',): identity_cache.hits}, ('cache',), 'counter')
+metrics.gauge('nearfix_cache_misses_total', 'In-process cache misses', lambda: {
+    ('services',): services_cache.misses, ('identity',): identity_cache.misses}, ('cache',), 'counter')
+metrics.gauge('nearfix_event_subscribers', 'Open live dashboard streams',
+              lambda: change_feed.stats()['subscribers'])
+
+def init_database(shard=HOME_SHARD):
+    database = DATABASE if shard == HOME_SHARD else SHARDS[shard - 1][0]
+    if not os.path.exists(database):
+        conn = get_job_connection(shard)
         
         # Create tables
         conn.execute('''
@@ -92,6 +299,16 @@ def init_database():
             )
         ''')
         
+        if shard != HOME_SHARD:
+            # ids of this shard's helpers and requests start from its own range;
+            # its services are copied from DATABASE at startup
+            conn.executemany('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)',
+                             [('helpers', first_id(shard)), ('service_requests', first_id(shard))])
+            conn.commit()
+            conn.close()
+            print(f"Shard database {database} initialized")
+            return
+
         # Insert default services
         services = [
             ('Plumber', 'Fixing pipes, leaks, drainage issues'),
@@ -114,8 +331,656 @@ def init_database():
         conn.close()
         print("Database initialized successfully!")
 
+# Schema changes for databases created by an older init_database.
+# Entry N brings the database to PRAGMA user_version N; only append here.
+MIGRATIONS = [
+    [
+        # dashboards: WHERE user_id/helper_id = ? ORDER BY created_at DESC
+        'CREATE INDEX IF NOT EXISTS idx_requests_user_created ON service_requests (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_requests_helper_created ON service_requests (helper_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_requests_created ON service_requests (created_at)',
+        # dispatch: covers the columns the spatial index is built from
+        'CREATE INDEX IF NOT EXISTS idx_helpers_dispatch ON helpers (service_type_id, is_available, is_approved, latitude, longitude)',
+        'CREATE INDEX IF NOT EXISTS idx_helpers_approved ON helpers (is_approved)',
+        # admin listings
+        'CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_helpers_created ON helpers (created_at)',
+    ],
+    [
+        # admin dashboard statistics, kept current by triggers
+        '''CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID''',
+        '''INSERT OR REPLACE INTO stats_counters (name, value) VALUES
+            ('total_users', (SELECT COUNT(*) FROM users)),
+            ('total_helpers', (SELECT COUNT(*) FROM helpers)),
+            ('pending_helpers', (SELECT COUNT(*) FROM helpers WHERE is_approved = 0)),
+            ('total_requests', (SELECT COUNT(*) FROM service_requests))''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_users_count_insert AFTER INSERT ON users BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'total_users';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_users_count_delete AFTER DELETE ON users BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'total_users';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_helpers_count_insert AFTER INSERT ON helpers BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'total_helpers';
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'pending_helpers' AND NEW.is_approved = 0;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_helpers_count_approve AFTER UPDATE OF is_approved ON helpers
+        WHEN (OLD.is_approved = 0) <> (NEW.is_approved = 0) BEGIN
+            UPDATE stats_counters SET value = value + (CASE WHEN NEW.is_approved = 0 THEN 1 ELSE -1 END)
+            WHERE name = 'pending_helpers';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_helpers_count_delete AFTER DELETE ON helpers BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'total_helpers';
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'pending_helpers' AND OLD.is_approved = 0;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_count_insert AFTER INSERT ON service_requests BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'total_requests';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_count_delete AFTER DELETE ON service_requests BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'total_requests';
+        END''',
+    ],
+    [
+        # admin exports filtered by status and date range
+        'CREATE INDEX IF NOT EXISTS idx_requests_status_created ON service_requests (status, created_at)',
+    ],
+    [
+        # bumped on every catalog write so other workers drop their cached copy
+        '''CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID''',
+        "INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('services', 0)",
+        '''CREATE TRIGGER IF NOT EXISTS trg_services_version_insert AFTER INSERT ON services BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'services';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_services_version_update AFTER UPDATE ON services BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'services';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_services_version_delete AFTER DELETE ON services BEGIN
+            UPDATE cache_versions SET version = version + 1 WHERE name = 'services';
+        END''',
+    ],
+    [
+        # new pending requests wait here until a dispatcher matches them
+        '''CREATE TABLE IF NOT EXISTS dispatch_queue (
+            request_id INTEGER PRIMARY KEY,
+            enqueued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_enqueue AFTER INSERT ON service_requests
+        WHEN NEW.status = 'pending' AND NEW.helper_id IS NULL BEGIN
+            INSERT OR IGNORE INTO dispatch_queue (request_id) VALUES (NEW.request_id);
+        END''',
+    ],
+    [
+        # job slots: a helper holds up to their service's max_concurrent_jobs at once
+        'ALTER TABLE services ADD COLUMN max_concurrent_jobs INTEGER NOT NULL DEFAULT 1',
+        'ALTER TABLE helpers ADD COLUMN active_jobs INTEGER NOT NULL DEFAULT 0',
+        '''UPDATE helpers SET active_jobs = (
+            SELECT COUNT(*) FROM service_requests sr
+            WHERE sr.helper_id = helpers.helper_id AND sr.status IN ('accepted', 'in_progress')
+        )''',
+        # dispatch used to mark busy helpers unavailable; active_jobs covers that now
+        'UPDATE helpers SET is_available = 1 WHERE active_jobs > 0',
+        'DROP INDEX IF EXISTS idx_helpers_dispatch',
+        'CREATE INDEX IF NOT EXISTS idx_helpers_capacity ON helpers (service_type_id, is_available, is_approved, active_jobs, latitude, longitude)',
+    ],
+    [
+        # server-side sessions; expires_at is unix time
+        '''CREATE TABLE IF NOT EXISTS sessions (
+            sid TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)',
+    ],
+    [
+        # request lifecycle; keep in step with REQUEST_TRANSITIONS
+        '''CREATE TABLE IF NOT EXISTS request_transitions (
+            from_status TEXT NOT NULL,
+            to_status TEXT NOT NULL,
+            PRIMARY KEY (from_status, to_status)
+        ) WITHOUT ROWID''',
+        '''INSERT OR IGNORE INTO request_transitions (from_status, to_status) VALUES
+            ('pending', 'accepted'), ('pending', 'cancelled'),
+            ('accepted', 'in_progress'), ('accepted', 'cancelled'),
+            ('in_progress', 'work_done_by_helper'), ('in_progress', 'cancelled'),
+            ('work_done_by_helper', 'completed')''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_transition BEFORE UPDATE OF status ON service_requests
+        WHEN OLD.status IS NOT NEW.status AND NOT EXISTS (
+            SELECT 1 FROM request_transitions WHERE from_status = OLD.status AND to_status = NEW.status
+        ) BEGIN
+            SELECT RAISE(ABORT, 'invalid request status transition');
+        END''',
+        # append-only status history; ts has millisecond resolution
+        '''CREATE TABLE IF NOT EXISTS request_events (
+            event_id INTEGER PRIMARY KEY,
+            request_id INTEGER NOT NULL,
+            from_status TEXT,
+            to_status TEXT NOT NULL,
+            ts TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now'))
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_request_events_request ON request_events (request_id, ts)',
+        'CREATE INDEX IF NOT EXISTS idx_request_events_status ON request_events (to_status, ts)',
+        # history before this migration is approximated from the request row
+        '''INSERT INTO request_events (request_id, from_status, to_status, ts)
+            SELECT request_id, NULL, 'pending', created_at FROM service_requests''',
+        '''INSERT INTO request_events (request_id, from_status, to_status, ts)
+            SELECT request_id, 'pending', status, COALESCE(updated_at, created_at)
+            FROM service_requests WHERE status <> 'pending' ''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_event_insert AFTER INSERT ON service_requests BEGIN
+            INSERT INTO request_events (request_id, from_status, to_status) VALUES (NEW.request_id, NULL, NEW.status);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_event_update AFTER UPDATE OF status ON service_requests
+        WHEN OLD.status IS NOT NEW.status BEGIN
+            INSERT INTO request_events (request_id, from_status, to_status) VALUES (NEW.request_id, OLD.status, NEW.status);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_request_events_no_update BEFORE UPDATE ON request_events BEGIN
+            SELECT RAISE(ABORT, 'request_events is append-only');
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_request_events_no_delete BEFORE DELETE ON request_events BEGIN
+            SELECT RAISE(ABORT, 'request_events is append-only');
+        END''',
+    ],
+    [
+        # demand rollups, filled from request_events by rollup_demand_job
+        '''CREATE TABLE IF NOT EXISTS rollup_watermarks (
+            name TEXT PRIMARY KEY,
+            last_event_id INTEGER NOT NULL
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS demand_hourly (
+            hour TEXT NOT NULL,
+            service_type_id INTEGER NOT NULL,
+            geohash TEXT NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            assigned INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, service_type_id, geohash)
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS assign_latency_hourly (
+            hour TEXT NOT NULL,
+            service_type_id INTEGER NOT NULL,
+            geohash TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, service_type_id, geohash, bucket)
+        ) WITHOUT ROWID''',
+    ],
+    [
+        # COUNT and MAX(updated_at) per owner straight from the index, for API validators
+        'CREATE INDEX IF NOT EXISTS idx_requests_user_updated ON service_requests (user_id, updated_at)',
+        'CREATE INDEX IF NOT EXISTS idx_requests_helper_updated ON service_requests (helper_id, updated_at)',
+    ],
+    [
+        # updated_at is kept by the database, on every write path, with
+        # millisecond resolution so two changes in one second still differ.
+        # Writers are serialized, so stamps follow commit order and
+        # (updated_at, request_id) works as a sync cursor.
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_updated_at_insert AFTER INSERT ON service_requests BEGIN
+            UPDATE service_requests SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+            WHERE request_id = NEW.request_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_updated_at AFTER UPDATE ON service_requests
+        WHEN NEW.updated_at IS OLD.updated_at BEGIN
+            UPDATE service_requests SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now')
+            WHERE request_id = NEW.request_id;
+        END''',
+        'CREATE INDEX IF NOT EXISTS idx_requests_updated ON service_requests (updated_at)',
+    ],
+    [
+        # payments, as in database.sql, so both backends share one schema
+        '''CREATE TABLE IF NOT EXISTS payments (
+            payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            gateway_payment_id TEXT,
+            status TEXT DEFAULT 'pending' CHECK (status IN ('pending', 'success', 'failed')),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (request_id) REFERENCES service_requests (request_id),
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )''',
+    ],
+    [
+        # change_seq numbers every write to a request from a counter bumped in
+        # the same transaction, so it follows commit order even when the clock
+        # does not; the changes cursor is a change_seq. The new triggers also
+        # take over stamping updated_at.
+        'DROP TRIGGER IF EXISTS trg_requests_updated_at_insert',
+        'DROP TRIGGER IF EXISTS trg_requests_updated_at',
+        'ALTER TABLE service_requests ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0',
+        '''CREATE TABLE IF NOT EXISTS sequences (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID''',
+        # existing rows in the order the old (updated_at, request_id) cursor saw them
+        '''UPDATE service_requests SET change_seq = ranked.seq
+        FROM (SELECT request_id, ROW_NUMBER() OVER (ORDER BY updated_at, request_id) AS seq
+              FROM service_requests) AS ranked
+        WHERE service_requests.request_id = ranked.request_id''',
+        "INSERT INTO sequences (name, value) SELECT 'request_changes', COUNT(*) FROM service_requests",
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_changed_insert AFTER INSERT ON service_requests BEGIN
+            UPDATE sequences SET value = value + 1 WHERE name = 'request_changes';
+            UPDATE service_requests
+            SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now'),
+                change_seq = (SELECT value FROM sequences WHERE name = 'request_changes')
+            WHERE request_id = NEW.request_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_requests_changed AFTER UPDATE ON service_requests
+        WHEN NEW.change_seq IS OLD.change_seq BEGIN
+            UPDATE sequences SET value = value + 1 WHERE name = 'request_changes';
+            UPDATE service_requests
+            SET updated_at = CASE WHEN NEW.updated_at IS OLD.updated_at
+                                  THEN strftime('%Y-%m-%d %H:%M:%f', 'now') ELSE NEW.updated_at END,
+                change_seq = (SELECT value FROM sequences WHERE name = 'request_changes')
+            WHERE request_id = NEW.request_id;
+        END''',
+        'CREATE INDEX IF NOT EXISTS idx_requests_change_seq ON service_requests (change_seq)',
+        'CREATE INDEX IF NOT EXISTS idx_requests_user_change_seq ON service_requests (user_id, change_seq)',
+        'CREATE INDEX IF NOT EXISTS idx_requests_helper_change_seq ON service_requests (helper_id, change_seq)',
+    ],
+    [
+        # admin uploads waiting for, or handled by, the run_helper_imports job
+        '''CREATE TABLE IF NOT EXISTS helper_imports (
+            import_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT,
+            path TEXT NOT NULL,
+            format TEXT NOT NULL,
+            approve INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed')),
+            report TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_helper_imports_status ON helper_imports (status, import_id)',
+    ],
+]
+
+def migrate_database(shard=HOME_SHARD):
+    conn = get_job_connection(shard)
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        for sql in statements:
+            conn.execute(sql)
+        conn.execute(f'PRAGMA user_version = {number}')
+        conn.commit()
+        print(f"Applied database migration {number}")
+    conn.close()
+
+# stats_counters row -> the full count it must agree with
+COUNTER_QUERIES = {
+    'total_users': 'SELECT COUNT(*) FROM users',
+    'total_helpers': 'SELECT COUNT(*) FROM helpers',
+    'pending_helpers': 'SELECT COUNT(*) FROM helpers WHERE is_approved = 0',
+    'total_requests': 'SELECT COUNT(*) FROM service_requests',
+}
+
+ACTIVE_JOBS_QUERY = '''
+    SELECT COUNT(*) FROM service_requests sr
+    WHERE sr.helper_id = helpers.helper_id AND sr.status IN ('accepted', 'in_progress')
+'''
+
+@jobs.every(3600)
+def reconcile_counters():
+    """Recount every statistic and repair any drift in stats_counters"""
+    drift = {}
+    for shard in ALL_SHARDS:
+        for name, value in reconcile_shard(shard).items():
+            drift[name if shard == HOME_SHARD else f'{name} ({SHARDS[shard - 1][0]})'] = value
+    if drift:
+        app.logger.warning('stats_counters drift repaired: %s', drift)
+    return drift
+
+def reconcile_shard(shard):
+    """Repair one shard's counters and job slots; returns what had drifted"""
+    conn = get_job_connection(shard)
+    # hold the write lock so no trigger fires between counting and fixing
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        stored = dict(conn.execute('SELECT name, value FROM stats_counters').fetchall())
+        drift = {}
+        for name, sql in COUNTER_QUERIES.items():
+            actual = conn.execute(sql).fetchone()[0]
+            if stored.get(name) != actual:
+                drift[name] = (stored.get(name), actual)
+                conn.execute('INSERT OR REPLACE INTO stats_counters (name, value) VALUES (?, ?)', (name, actual))
+        # helper job slots can drift the same way
+        resynced = [row[0] for row in conn.execute(f'''
+            UPDATE helpers SET active_jobs = ({ACTIVE_JOBS_QUERY})
+            WHERE active_jobs <> ({ACTIVE_JOBS_QUERY})
+            RETURNING helper_id
+        ''')]
+        if resynced:
+            drift['active_jobs'] = resynced
+        conn.commit()
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.close()
+    if resynced:
+        helper_indexes[shard].clear()
+    return drift
+
+def assign_batch(conn, pending, shard=HOME_SHARD):
+    """Assign pending request rows to helpers, minimizing total distance per service.
+
+    Runs inside the caller's transaction on `shard` and returns the number assigned.
+    """
+    helper_index = helper_indexes[shard]
+    by_service = {}
+    for req in pending:
+        try:
+            located = parse_point(req['user_latitude'], req['user_longitude'])
+        except ValueError:
+            # saved before coordinates were checked; it cannot be matched, so leave it pending
+            app.logger.warning('dispatch skipped request %s: bad coordinates', req['request_id'])
+            continue
+        if located:
+            by_service.setdefault(req['service_type_id'], []).append(req)
+
+    assignments = []
+    for service_type_id, reqs in by_service.items():
+        try:
+            assignments.extend(plan_service_group(conn, helper_index, service_type_id, reqs, shard))
+        except Exception:
+            # a bad group must not sink the whole batch; its requests stay pending
+            app.logger.exception('dispatch skipped service %r, requests %s', service_type_id,
+                                 [req['request_id'] for req in reqs])
+
+    assigned = 0
+    for service_type_id, capacity, helper_id, request_id in assignments:
+        active_jobs = claim_helper(conn, helper_id, capacity)
+        if active_jobs is None:
+            # filled up since we looked; the request stays pending for the next sweep
+            continue
+        cur = conn.execute('''
+            UPDATE service_requests SET helper_id = ?, status = 'accepted'
+            WHERE request_id = ? AND status = 'pending' AND helper_id IS NULL
+        ''', (helper_id, request_id))
+        if cur.rowcount != 1:
+            release_helper(conn, helper_id)
+            continue
+        if active_jobs >= capacity:
+            helper_index.discard(service_type_id, helper_id)
+        assigned += 1
+    return assigned
+
+def plan_service_group(conn, helper_index, service_type_id, reqs, shard):
+    """(service_type_id, capacity, helper_id, request_id) for the best assignment of one service's requests"""
+    capacity = service_capacity(conn, service_type_id, shard)
+    candidates = {}
+    for req in reqs:
+        try:
+            candidates[req['request_id']] = helper_index.nearest(conn, service_type_id, req['user_latitude'],
+                                                                 req['user_longitude'], k=MATCH_CANDIDATES)
+        except Exception:
+            # one bad row must not hold back the rest of its service
+            app.logger.exception('dispatch skipped request %s', req['request_id'])
+    # the index may lag behind other workers, so confirm against the table
+    helper_ids = {helper_id for options in candidates.values() for _, helper_id in options}
+    placeholders = ', '.join('?' * len(helper_ids))
+    free_slots = dict(conn.execute(f'''
+        SELECT helper_id, ? - active_jobs FROM helpers
+        WHERE helper_id IN ({placeholders}) AND is_available = 1 AND is_approved = 1 AND active_jobs < ?
+    ''', [capacity, *helper_ids, capacity]).fetchall())
+    for helper_id in helper_ids - free_slots.keys():
+        helper_index.discard(service_type_id, helper_id)
+    # a helper with n free slots is n interchangeable (helper, slot) columns
+    for request_id, options in candidates.items():
+        candidates[request_id] = [
+            (distance, (helper_id, slot)) for distance, helper_id in options
+            for slot in range(min(free_slots.get(helper_id, 0), len(reqs)))
+        ]
+    return [(service_type_id, capacity, helper_id, request_id)
+            for request_id, (helper_id, slot) in min_distance_assignment(candidates).items()]
+
+def service_capacity(conn, service_type_id, shard=HOME_SHARD):
+    """How many jobs one helper of this service may hold at once"""
+    for service in services_caches[shard].get(conn):
+        if service['service_id'] == int(service_type_id):
+            return service['max_concurrent_jobs']
+    return 1
+
+def claim_helper(conn, helper_id, capacity):
+    """Take one of a helper's free job slots; returns their new active_jobs, or None if full.
+
+    The capacity test and the increment are one statement, so concurrent
+    dispatchers can never push a helper past capacity.
+    """
+    row = conn.execute('''
+        UPDATE helpers SET active_jobs = active_jobs + 1
+        WHERE helper_id = ? AND is_available = 1 AND is_approved = 1 AND active_jobs < ?
+        RETURNING active_jobs
+    ''', (helper_id, capacity)).fetchone()
+    return row[0] if row else None
+
+def release_helper(conn, helper_id):
+    """Give back one of a helper's job slots"""
+    conn.execute('UPDATE helpers SET active_jobs = active_jobs - 1 WHERE helper_id = ? AND active_jobs > 0',
+                 (helper_id,))
+
+def change_request_status(request_id, status, kind, owner_id):
+    """Move a request to `status` if REQUEST_TRANSITIONS allows it from where it is.
+
+    Only touches the request if its `kind` ('user' or 'helper') is owner_id.
+    The update is conditional on the status just read, so of two racing
+    changes only one applies. Frees the helper's job slot when the request
+    leaves an active status, and returns the previous status, or None if
+    nothing changed.
+    """
+    row = repo.request_state(kind, request_id, owner_id)
+    if row is None or status not in REQUEST_TRANSITIONS.get(row['status'], ()):
+        return None
+    released = row['helper_id'] is not None and row['status'] in ACTIVE_STATUSES and status not in ACTIVE_STATUSES
+    if not repo.move_request(request_id, row['status'], status, row['helper_id'] if released else None):
+        return None
+    if released:
+        sync_helper_index(row['helper_id'])
+    return row['status']
+
+@jobs.every(2)
+def dispatch_queued_requests():
+    """Match a batch of newly queued requests in every shard"""
+    return sum(dispatch_queued_batch(shard) for shard in ALL_SHARDS)
+
+def dispatch_queued_batch(shard):
+    """Match a batch of one shard's newly queued requests.
+
+    The batch is claimed and assigned in one write transaction, so each queued
+    request is handled by exactly one worker process, and a crash part-way
+    leaves it queued.
+    """
+    conn = get_job_connection(shard)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        claimed = [row[0] for row in conn.execute('''
+            DELETE FROM dispatch_queue
+            WHERE request_id IN (SELECT request_id FROM dispatch_queue ORDER BY request_id LIMIT ?)
+            RETURNING request_id
+        ''', (DISPATCH_BATCH_SIZE,)).fetchall()]
+        assigned = 0
+        if claimed:
+            placeholders = ', '.join('?' * len(claimed))
+            pending = conn.execute(f'''
+                SELECT request_id, service_type_id, user_latitude, user_longitude
+                FROM service_requests
+                WHERE request_id IN ({placeholders}) AND status = 'pending' AND helper_id IS NULL
+            ''', claimed).fetchall()
+            assigned = assign_batch(conn, pending, shard)
+        conn.commit()
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.close()
+    # more work may be waiting behind this batch
+    if len(claimed) == DISPATCH_BATCH_SIZE:
+        jobs.trigger('dispatch_queued_requests')
+    return assigned
+
+def sync_read_replica():
+    """Copy the database to REPLICA_DATABASE"""
+    conn = get_db_connection()
+    try:
+        return sync_replica(conn, REPLICA_DATABASE)
+    finally:
+        conn.close()
+
+if REPLICA_DATABASE:
+    jobs.every(REPLICA_SYNC_SECONDS)(sync_read_replica)
+
+@jobs.every(60)
+def run_helper_imports():
+    """Import the queued admin uploads, oldest first; each is claimed by one worker"""
+    imported = 0
+    while True:
+        conn = get_job_connection(HOME_SHARD)
+        try:
+            job = conn.execute('''
+                UPDATE helper_imports SET status = 'running'
+                WHERE import_id = (SELECT import_id FROM helper_imports WHERE status = 'queued'
+                                   ORDER BY import_id LIMIT 1)
+                RETURNING import_id, path, format, approve
+            ''').fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+        if job is None:
+            return imported
+        run_helper_import(job)
+        imported += 1
+
+def run_helper_import(job):
+    """Import one stored upload, saving the counts as each chunk commits"""
+    conns = [get_job_connection(shard) for shard in ALL_SHARDS]
+    progress = {}
+
+    def record(report, status='running', error=None):
+        progress.update(report)
+        conns[HOME_SHARD].execute('''
+            UPDATE helper_imports
+            SET status = ?, report = ?, error = ?,
+                finished_at = CASE WHEN ? = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END
+            WHERE import_id = ?
+        ''', (status, json.dumps(progress), error, status, job['import_id']))
+        conns[HOME_SHARD].commit()
+
+    try:
+        with open(job['path'], 'rb') as stream:
+            report = import_helpers(conns if SHARDS else conns[0], read_rows(stream, job['format']),
+                                    approve=bool(job['approve']), hash_method=PASSWORD_HASH_METHOD,
+                                    route=shard_router.shard_for if SHARDS else None, progress=record)
+        record(report, 'done')
+    except Exception as e:
+        if not isinstance(e, (ValueError, csv.Error, OSError)):
+            app.logger.exception('helper import %s failed', job['import_id'])
+        record({}, 'failed', str(e))
+    finally:
+        for conn in conns:
+            conn.close()
+        if os.path.exists(job['path']):
+            os.remove(job['path'])
+        clear_helper_indexes()
+
+@jobs.every(60, name='rollup_demand')
+def rollup_demand_job():
+    """Fold new request events into the demand heatmap tables of every shard"""
+    processed = 0
+    for shard in ALL_SHARDS:
+        conn = get_job_connection(shard)
+        try:
+            processed += rollup_demand(conn)
+        finally:
+            conn.close()
+    return processed
+
+@jobs.every(600)
+def sweep_sessions():
+    """Delete expired sessions"""
+    return session_store.sweep()
+
+@jobs.every(30)
+def rematch_pending_requests():
+    """Retry every request still pending, oldest first, as one batch per shard"""
+    assigned = 0
+    for shard in ALL_SHARDS:
+        conn = get_job_connection(shard)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            pending = conn.execute(PENDING_REQUESTS_QUERY, (MATCH_BATCH_LIMIT,)).fetchall()
+            assigned += assign_batch(conn, pending, shard)
+            conn.commit()
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.close()
+    return assigned
+
+# Hot queries; check_query_plans() makes sure each one stays on an index.
+# The request handlers' queries live in repository.py.
+PENDING_REQUESTS_QUERY = '''
+    SELECT request_id, service_type_id, user_latitude, user_longitude
+    FROM service_requests
+    WHERE status = 'pending' AND helper_id IS NULL
+    ORDER BY created_at
+    LIMIT ?
+'''
+
+# Keyset pagination over (created_at, id), newest first
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+FIRST_PAGE = ('9999-12-31 23:59:59', 2 ** 63 - 1)
+# full sync: every change_seq is above this
+FIRST_CHANGE = 0
+
+# name -> (sql, sample params, whether a full walk of an index is the intended plan)
+HOT_QUERIES = {
+    'user_dashboard': (USER_REQUESTS_QUERY, (0, *FIRST_PAGE, PAGE_SIZE), False),
+    'helper_dashboard': (HELPER_REQUESTS_QUERY, (0, *FIRST_PAGE, PAGE_SIZE), False),
+    'admin_users': (ADMIN_USERS_QUERY, (*FIRST_PAGE, PAGE_SIZE), False),
+    'admin_helpers': (ADMIN_HELPERS_QUERY, (*FIRST_PAGE, PAGE_SIZE), False),
+    'admin_pending_helpers': (PENDING_HELPERS_QUERY, (), False),
+    'admin_recent_requests': (RECENT_REQUESTS_QUERY, (), True),
+    'pending_sweep': (PENDING_REQUESTS_QUERY, (MATCH_BATCH_LIMIT,), False),
+    'dispatch': (DISPATCH_HELPERS_QUERY, (0,), False),
+    'request_history': (REQUEST_EVENTS_QUERY, (0,), False),
+    'api_user_requests': (API_REQUESTS_QUERIES['user'], (0, *FIRST_PAGE, PAGE_SIZE), False),
+    'api_helper_requests': (API_REQUESTS_QUERIES['helper'], (0, *FIRST_PAGE, PAGE_SIZE), False),
+    'api_user_requests_version': (API_REQUESTS_VERSION_QUERIES['user'], (0,), False),
+    'api_helper_requests_version': (API_REQUESTS_VERSION_QUERIES['helper'], (0,), False),
+    'user_changes': (CHANGES_QUERIES['user'], (0, FIRST_CHANGE, PAGE_SIZE), False),
+    'helper_changes': (CHANGES_QUERIES['helper'], (0, FIRST_CHANGE, PAGE_SIZE), False),
+    'all_changes': (CHANGES_QUERIES['admin'], (FIRST_CHANGE, PAGE_SIZE), False),
+}
+
+def check_query_plans(shard=HOME_SHARD):
+    """Refuse to start if a hot query would scan a table or sort in a temp b-tree"""
+    conn = get_shard_connection(shard)
+    problems = []
+    for name, (sql, params, index_scan_ok) in HOT_QUERIES.items():
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            detail = row['detail']
+            if detail.startswith('SCAN') and not (index_scan_ok and 'INDEX' in detail):
+                problems.append(f'{name}: {detail}')
+            elif 'TEMP B-TREE' in detail:
+                problems.append(f'{name}: {detail}')
+    conn.close()
+    if problems:
+        raise RuntimeError('Hot queries lost their indexes:\n  ' + '\n  '.join(problems))
+
 # Initialize database
-init_database()
+for shard in ALL_SHARDS:
+    init_database(shard)
+    migrate_database(shard)
+if SHARDS:
+    repo.copy_services()
+for shard in ALL_SHARDS:
+    check_query_plans(shard)
+if REPLICA_DATABASE:
+    sync_read_replica()
 
 @app.template_filter('date')
 def format_date(value, fmt='%Y-%m-%d'):
@@ -128,10 +993,106 @@ def format_date(value, fmt='%Y-%m-%d'):
 
 
 
+@app.before_request
+def start_background_jobs():
+    jobs.start()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # statements of connections released meanwhile, shard fan-out included
+    g.query_log = query_log.set([])
+
+def stop_query_log():
+    token = g.pop('query_log', None)
+    if token is None:
+        return []
+    collected = query_log.get()
+    query_log.reset(token)
+    return collected
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or 'unmatched'
+    # a streamed body keeps querying after this; those count toward their statements only
+    conns = [g.get(name) for name in ('db', 'read_db') if g.get(name) is not None]
+    queries = [record for conn in conns + list(g.get('shard_dbs', {}).values()) for record in conn.queries]
+    queries += stop_query_log()
+    route_durations.observe(elapsed, endpoint, request.method, response.status_code)
+    route_queries.observe(len(queries), endpoint)
+    db_ms = sum(record.elapsed for record in queries) * 1000
+    response.headers['Server-Timing'] = (f'app;dur={elapsed * 1000:.1f}, '
+                                         f'db;dur={db_ms:.1f};desc="{len(queries)} queries"')
+    return response
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recount the admin dashboard statistics"""
+    print(reconcile_counters() or 'No drift')
+
+@app.cli.command('import-helpers')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--approve', is_flag=True, help='Mark imported helpers approved')
+@click.option('--batch-size', default=500, show_default=True, help='Rows per transaction')
+@click.option('--workers', type=int, help='Hashing processes (default: CPU count)')
+def import_helpers_command(path, approve, batch_size, workers):
+    """Import helpers from a .csv or .ndjson file"""
+    fmt = os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt not in IMPORT_FORMATS:
+        raise click.BadParameter('expected a .csv or .ndjson file', param_hint='PATH')
+    conns = [get_shard_connection(shard) for shard in ALL_SHARDS]
+    with open(path, 'rb') as stream:
+        report = import_helpers(conns if SHARDS else conns[0], read_rows(stream, fmt), approve=approve,
+                                batch_size=batch_size, workers=workers, hash_method=PASSWORD_HASH_METHOD,
+                                route=shard_router.shard_for if SHARDS else None)
+    for conn in conns:
+        conn.close()
+    clear_helper_indexes()
+    print(report)
+
+@app.cli.command('tune-password-hash')
+@click.option('--target-ms', default=250, show_default=True, help='Time one hash should take')
+def tune_password_hash_command(target_ms):
+    """Find the scrypt cost that takes about --target-ms on this machine"""
+    method, elapsed_ms = tune_scrypt(target_ms)
+    workers = password_hasher.workers
+    print(f'{method}: {elapsed_ms:.0f} ms per hash')
+    print(f'about {1000 / elapsed_ms * workers:.0f} logins/sec per app process with {workers} hashing workers')
+    print(f"set PASSWORD_HASH_METHOD = '{method}' in app.py to use it")
+
+@app.errorhandler(HasherBusy)
+def hasher_busy(e):
+    # fail fast so clients retry instead of piling onto a saturated pool
+    app.logger.warning('password hashing saturated: %s', e)
+    return 'The server is busy, please try again in a moment.', 503, {'Retry-After': '1'}
+
 # Helper Functions
+def current_account(kind):
+    """Cached profile row of the logged-in account of this kind, or None.
+
+    An account deleted since login is logged out here.
+    """
+    key = next(key for key, account_kind in SESSION_ACCOUNTS.items() if account_kind == kind)
+    if key not in session:
+        return None
+    account = identity_cache.get(kind, session[key], session.get('identity_version', 0))
+    if account is None:
+        session.pop(key, None)
+        session.pop(f'{kind}_name', None)
+    return account
+
+def account_changed(kind, account_id):
+    """Call after an account edits its own row so every worker reloads it"""
+    identity_cache.invalidate(kind, account_id)
+    session['identity_version'] = session.get('identity_version', 0) + 1
+
 def login_required(f):
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session and 'helper_id' not in session and 'admin_id' not in session:
+        if not any(current_account(kind) for key, kind in SESSION_ACCOUNTS.items() if key in session):
             return redirect(url_for('home'))
         return f(*args, **kwargs)
     decorated_function.__name__ = f.__name__
@@ -139,27 +1100,110 @@ def login_required(f):
 
 def admin_required(f):
     def decorated_function(*args, **kwargs):
-        if 'admin_id' not in session:
+        if current_account('admin') is None:
             flash('Admin access required!', 'error')
             return redirect(url_for('admin_login'))
         return f(*args, **kwargs)
     decorated_function.__name__ = f.__name__
     return decorated_function
 
+def encode_cursor(value, row_id):
+    """Opaque token for a (timestamp, id) keyset position"""
+    return base64.urlsafe_b64encode(f"{value}|{row_id}".encode()).decode()
+
+def decode_cursor(token):
+    try:
+        value, row_id = base64.urlsafe_b64decode(token.encode()).decode().rsplit('|', 1)
+        return value, int(row_id)
+    except ValueError:
+        abort(400, 'Invalid cursor.')
+
+def encode_cursors(positions):
+    """Opaque token for one change_seq position per shard"""
+    return base64.urlsafe_b64encode(';'.join(map(str, positions)).encode()).decode()
+
+def decode_cursors(token):
+    """The positions of an encode_cursors token. A token from before a shard
+    was added starts the missing shards from scratch. Tokens from before
+    change_seq hold (updated_at, request_id) pairs, which the repository
+    turns into a change_seq."""
+    try:
+        positions = []
+        for part in base64.urlsafe_b64decode(token.encode()).decode().split(';'):
+            if '|' in part:
+                value, row_id = part.rsplit('|', 1)
+                positions.append((value, int(row_id)))
+            else:
+                positions.append(int(part))
+    except ValueError:
+        abort(400, 'Invalid cursor.')
+    if len(positions) > shard_router.count:
+        abort(400, 'Invalid cursor.')
+    return tuple(positions) + (FIRST_CHANGE,) * (shard_router.count - len(positions))
+
+def page_limit():
+    return min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+
+def page_args():
+    """Read ?after=<token>&limit=<n> into a (cursor, limit) pair"""
+    limit = page_limit()
+    token = request.args.get('after')
+    if not token:
+        return FIRST_PAGE, limit
+    return decode_cursor(token), limit
+
+def fetch_page(query, id_column, *args):
+    """Call a keyset query as query(*args, cursor, limit) and return
+    (rows, token for the next page or None)"""
+    cursor, limit = page_args()
+    rows = query(*args, cursor, limit + 1)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last['created_at'], last[id_column])
+
+def changed_requests(kind, owner_id=None, cursor=None, limit=PAGE_SIZE):
+    """Requests changed after `cursor`: (rows, next cursor, whether more are waiting).
+
+    A cursor holds one change_seq position per shard; None
+    starts from the beginning. kind 'user' or 'helper' limits this to
+    requests of owner_id; 'admin' sees all of them. With nothing new the
+    cursor comes back unchanged.
+    """
+    cursor = list(cursor or (FIRST_CHANGE,) * shard_router.count)
+    rows = repo.changed_requests(kind, owner_id, tuple(cursor), limit + 1)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    for row in rows:
+        cursor[shard_of(row['request_id'])] = row['change_seq']
+    return rows, tuple(cursor), more
+
+def check_login(kind, account, password):
+    """Verify a login password, upgrading its hash if PASSWORD_HASH_METHOD has changed"""
+    if not account or not password_hasher.verify(account['password'], password):
+        return False
+    if password_hasher.needs_rehash(account['password']):
+        try:
+            new_hash = password_hasher.hash(password)
+        except HasherBusy:
+            # upgrade on a later login rather than fail this one
+            return True
+        repo.replace_password_hash(kind, account[f'{kind}_id'], account['password'], new_hash)
+    return True
+
 def calculate_distance(lat1, lon1, lat2, lon2):
     """Calculate distance between two points in kilometers"""
-    R = 6371  # Earth's radius in kilometers
-    
-    lat1_rad = math.radians(float(lat1))
-    lat2_rad = math.radians(float(lat2))
-    delta_lat = math.radians(float(lat2) - float(lat1))
-    delta_lon = math.radians(float(lon2) - float(lon1))
-    
-    a = math.sin(delta_lat/2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(delta_lon/2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    distance = R * c
-    
-    return distance
+    return haversine_km(lat1, lon1, lat2, lon2)
+
+def sync_helper_index(helper_id):
+    """Push a helper's current row into its shard's dispatch index"""
+    helper_indexes[shard_of(helper_id)].sync_helper(repo.helper_dispatch_row(helper_id))
+
+def clear_helper_indexes():
+    """Drop every dispatch index, to be rebuilt from the tables"""
+    for helper_index in helper_indexes:
+        helper_index.clear()
 
 # Routes
 @app.route('/')
@@ -176,20 +1220,15 @@ def user_register():
         phone = request.form['phone']
         address = request.form['address']
         
-        hashed_password = generate_password_hash(password)
+        hashed_password = password_hasher.hash(password)
         
-        conn = get_db_connection()
         try:
-            conn.execute('INSERT INTO users (username, email, password, full_name, phone, address) VALUES (?, ?, ?, ?, ?, ?)',
-                       (username, email, hashed_password, full_name, phone, address))
-            conn.commit()
-            flash('Registration successful! Please login.', 'success')
-            return redirect(url_for('user_login'))
-        except sqlite3.IntegrityError:
+            repo.create_user(username, email, hashed_password, full_name, phone, address)
+        except DuplicateAccount:
             flash('Username or email already exists!', 'error')
             return redirect(url_for('user_register'))
-        finally:
-            conn.close()
+        flash('Registration successful! Please login.', 'success')
+        return redirect(url_for('user_login'))
     
     return render_template('user_register.html')
 
@@ -199,11 +1238,10 @@ def user_login():
         username = request.form['username']
         password = request.form['password']
         
-        conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-        conn.close()
+        user = repo.account_by_username('user', username)
         
-        if user and check_password_hash(user['password'], password):
+        if check_login('user', user, password):
+            session.regenerate()
             session['user_id'] = user['user_id']
             session['user_name'] = user['full_name']
             flash('Login successful!', 'success')
@@ -222,72 +1260,70 @@ def user_dashboard():
     conn = get_db_connection()
     
     # Get services
-    services = conn.execute('SELECT * FROM services').fetchall()
+    services = services_cache.get(conn)
+    
+    conn.close()
     
     # Get user's requests
-    requests = conn.execute('''
-        SELECT sr.*, s.service_name, h.full_name as helper_name
-        FROM service_requests sr
-        LEFT JOIN services s ON sr.service_type_id = s.service_id
-        LEFT JOIN helpers h ON sr.helper_id = h.helper_id
-        WHERE sr.user_id = ?
-        ORDER BY sr.created_at DESC
-    ''', (session['user_id'],)).fetchall()
+    requests, next_page = fetch_page(repo.dashboard_requests, 'request_id', 'user', session['user_id'])
     
+    return render_template('user_dashboard.html', services=services, requests=requests, next_page=next_page,
+                           last_event_id=change_feed.format_position(repo.last_event_id()))
+
+def known_point(data):
+    """(latitude, longitude) of a form or JSON body, (None, None) if not given; aborts with 400 if invalid"""
+    try:
+        point = parse_point(data.get('latitude'), data.get('longitude'))
+    except ValueError:
+        abort(400, 'latitude and longitude must be numbers within range.')
+    return point or (None, None)
+
+def known_service_type(value):
+    """`value` as the id of an existing service, aborting with 400 otherwise"""
+    try:
+        service_type_id = int(value) if not isinstance(value, bool) else None
+    except (TypeError, ValueError):
+        service_type_id = None
+    conn = get_db_connection()
+    if not any(service['service_id'] == service_type_id for service in services_cache.get(conn)):
+        abort(400, 'Unknown service_type_id.')
     conn.close()
-    
-    return render_template('user_dashboard.html', services=services, requests=requests)
+    return service_type_id
 
 @app.route('/user/request_service', methods=['POST'])
 @login_required
 def request_service():
-    service_type_id = request.form['service_type_id']
+    service_type_id = known_service_type(request.form['service_type_id'])
     title = request.form['title']
     description = request.form['description']
-    latitude = request.form.get('latitude')
-    longitude = request.form.get('longitude')
+    latitude, longitude = known_point(request.form)
     address = request.form.get('address')
     
-    conn = get_db_connection()
-    
-    # Find nearest available helper
-    helpers = conn.execute('''
-        SELECT h.*, s.service_name
-        FROM helpers h
-        JOIN services s ON h.service_type_id = s.service_id
-        WHERE h.service_type_id = ? AND h.is_available = 1 AND h.is_approved = 1
-    ''', (service_type_id,)).fetchall()
-    
-    nearest_helper = None
-    min_distance = float('inf')
-    
-    for helper in helpers:
-        if helper['latitude'] and helper['longitude'] and latitude and longitude:
-            distance = calculate_distance(latitude, longitude, helper['latitude'], helper['longitude'])
-            if distance < min_distance:
-                min_distance = distance
-                nearest_helper = helper
-    
-    # Create service request
-    status = 'accepted' if nearest_helper else 'pending'
-    helper_id = nearest_helper['helper_id'] if nearest_helper else None
-    
-    conn.execute('''
-        INSERT INTO service_requests 
-        (user_id, service_type_id, title, description, user_latitude, user_longitude, user_address, helper_id, status)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (session['user_id'], service_type_id, title, description, latitude, longitude, address, helper_id, status))
-    
-    conn.commit()
-    conn.close()
-    
-    if nearest_helper:
-        flash(f'Service request sent to nearest {nearest_helper["service_name"]}!', 'success')
-    else:
-        flash('Service request submitted. No available helper found nearby.', 'warning')
+    # Matching happens in the background dispatcher; the insert enqueues it
+    repo.create_request(session['user_id'], service_type_id, title, description, latitude, longitude, address)
+    jobs.trigger('dispatch_queued_requests')
     
+    flash('Service request submitted! We are finding the nearest helper for you.', 'success')
     return redirect(url_for('user_dashboard'))
 
+@app.route('/user/request/<int:request_id>/status')
+@login_required
+def request_status(request_id):
+    """JSON status of one request, for the request's user or assigned helper"""
+    row = repo.request_status(request_id)
+    
+    if not row or (row['user_id'] != session.get('user_id') and row['helper_id'] != session.get('helper_id')):
+        abort(404)
+    history = repo.request_history(request_id)
+    return jsonify({
+        'request_id': row['request_id'],
+        'status': row['status'],
+        'helper_name': row['helper_name'],
+        'service_name': row['service_name'],
+        'updated_at': row['updated_at'],
+        'history': [{'from': event['from_status'], 'to': event['to_status'], 'at': event['ts']} for event in history],
+    })
+
 @app.route('/user/logout')
 def user_logout():
     session.pop('user_id', None)
@@ -306,18 +1342,12 @@ def confirm_work(request_id):
         flash('Please login first', 'error')
         return redirect(url_for('user_login'))
 
-    conn = get_db_connection()
-
     # security: user can confirm only their own request
-    conn.execute("""
-        UPDATE service_requests
-        SET status = 'completed'
-        WHERE request_id = ? AND user_id = ?
-    """, (request_id, user_id))
-
-    conn.commit()
-    conn.close()
+    confirmed = change_request_status(request_id, 'completed', 'user', user_id)
 
+    if not confirmed:
+        flash('Only work the helper has marked as done can be confirmed.', 'error')
+        return redirect(url_for('user_dashboard'))
     flash('Work confirmed successfully! You can now proceed to payment.', 'success')
     return redirect(url_for('user_dashboard'))
 
@@ -331,29 +1361,22 @@ def helper_register():
         full_name = request.form['full_name']
         phone = request.form['phone']
         service_type_id = request.form['service_type_id']
-        latitude = request.form.get('latitude')
-        longitude = request.form.get('longitude')
+        latitude, longitude = known_point(request.form)
         
-        hashed_password = generate_password_hash(password)
+        hashed_password = password_hasher.hash(password)
         
-        conn = get_db_connection()
         try:
-            conn.execute('''
-                INSERT INTO helpers 
-                (username, email, password, full_name, phone, service_type_id, latitude, longitude)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (username, email, hashed_password, full_name, phone, service_type_id, latitude, longitude))
-            conn.commit()
-            flash('Registration successful! Please wait for admin approval.', 'success')
-            return redirect(url_for('helper_login'))
-        except sqlite3.IntegrityError:
+            helper_id = repo.create_helper(username, email, hashed_password, full_name, phone, service_type_id,
+                                           latitude, longitude)
+        except DuplicateAccount:
             flash('Username or email already exists!', 'error')
             return redirect(url_for('helper_register'))
-        finally:
-            conn.close()
+        sync_helper_index(helper_id)
+        flash('Registration successful! Please wait for admin approval.', 'success')
+        return redirect(url_for('helper_login'))
     
     conn = get_db_connection()
-    services = conn.execute('SELECT * FROM services').fetchall()
+    services = services_cache.get(conn)
     conn.close()
     
     return render_template('helper_register.html', services=services)
@@ -364,15 +1387,14 @@ def helper_login():
         username = request.form['username']
         password = request.form['password']
         
-        conn = get_db_connection()
-        helper = conn.execute('SELECT * FROM helpers WHERE username = ?', (username,)).fetchone()
-        conn.close()
+        helper = repo.account_by_username('helper', username)
         
-        if helper and check_password_hash(helper['password'], password):
+        if check_login('helper', helper, password):
             if not helper['is_approved']:
                 flash('Your account is not approved yet!', 'error')
                 return redirect(url_for('helper_login'))
             
+            session.regenerate()
             session['helper_id'] = helper['helper_id']
             session['helper_name'] = helper['full_name']
             flash('Login successful!', 'success')
@@ -388,36 +1410,52 @@ def helper_dashboard():
     if 'helper_id' not in session:
         return redirect(url_for('helper_login'))
     
-    conn = get_db_connection()
-    
     # Get helper info
-    helper = conn.execute('SELECT * FROM helpers WHERE helper_id = ?', (session['helper_id'],)).fetchone()
+    helper = current_account('helper')
     
     # Get assigned requests
-    requests = conn.execute('''
-        SELECT sr.*, u.full_name as user_name, u.phone as user_phone, s.service_name
-        FROM service_requests sr
-        JOIN users u ON sr.user_id = u.user_id
-        JOIN services s ON sr.service_type_id = s.service_id
-        WHERE sr.helper_id = ?
-        ORDER BY sr.created_at DESC
-    ''', (session['helper_id'],)).fetchall()
-    
-    conn.close()
+    requests, next_page = fetch_page(repo.dashboard_requests, 'request_id', 'helper', session['helper_id'])
     
-    return render_template('helper_dashboard.html', helper=helper, requests=requests)
+    return render_template('helper_dashboard.html', helper=helper, requests=requests, next_page=next_page,
+                           last_event_id=change_feed.format_position(repo.last_event_id()))
+
+@app.route('/<any(user, helper):kind>/events')
+def request_events_stream(kind):
+    """Server-Sent Events of status changes on this account's requests"""
+    account = current_account(kind)
+    if account is None:
+        # 204 tells EventSource to stop reconnecting
+        return '', 204
+    after = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    after = change_feed.parse_position(after)
+    return Response(sse_stream(change_feed, kind, account[f'{kind}_id'], after), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/<any(user, helper):kind>/request/<int:request_id>/card')
+@login_required
+def request_card(kind, request_id):
+    """One dashboard card, refetched when the request changes"""
+    account = current_account(kind)
+    if account is None:
+        abort(404)
+    row = repo.request_card(kind, request_id, account[f'{kind}_id'])
+    if row is None:
+        abort(404)
+    return render_template(f'{kind}_request_item.html', request=row)
 
 @app.route('/helper/update_status', methods=['POST'])
 @login_required
 def update_request_status():
     request_id = request.form['request_id']
     status = request.form['status']
+    if status not in HELPER_STATUSES:
+        abort(400)
     
-    conn = get_db_connection()
-    conn.execute('UPDATE service_requests SET status = ? WHERE request_id = ?', (status, request_id))
-    conn.commit()
-    conn.close()
+    changed = change_request_status(request_id, status, 'helper', session.get('helper_id'))
     
+    if not changed:
+        flash(f"This request can't be moved to {status.replace('_', ' ')} from its current status.", 'error')
+        return redirect(url_for('helper_dashboard'))
     flash('Request status updated!', 'success')
     return redirect(url_for('helper_dashboard'))
 
@@ -426,11 +1464,9 @@ def update_request_status():
 def toggle_availability():
     is_available = request.form['is_available'] == 'True'
     
-    conn = get_db_connection()
-    conn.execute('UPDATE helpers SET is_available = ? WHERE helper_id = ?', 
-                (not is_available, session['helper_id']))
-    conn.commit()
-    conn.close()
+    repo.set_helper_availability(session['helper_id'], not is_available)
+    sync_helper_index(session['helper_id'])
+    account_changed('helper', session['helper_id'])
     
     flash('Availability updated!', 'success')
     return redirect(url_for('helper_dashboard'))
@@ -449,11 +1485,10 @@ def admin_login():
         username = request.form['username']
         password = request.form['password']
         
-        conn = get_db_connection()
-        admin = conn.execute('SELECT * FROM admins WHERE username = ?', (username,)).fetchone()
-        conn.close()
+        admin = repo.account_by_username('admin', username)
         
         if admin and admin['password'] == password:  # In production, use password hashing
+            session.regenerate()
             session['admin_id'] = admin['admin_id']
             session['admin_name'] = admin['full_name']
             flash('Login successful!', 'success')
@@ -467,85 +1502,92 @@ def admin_login():
 @app.route('/admin/dashboard')
 @admin_required
 def admin_dashboard():
-    conn = get_db_connection()
-    
     # Get statistics
-    total_users = conn.execute('SELECT COUNT(*) as count FROM users').fetchone()['count']
-    total_helpers = conn.execute('SELECT COUNT(*) as count FROM helpers').fetchone()['count']
-    pending_helpers = conn.execute('SELECT COUNT(*) as count FROM helpers WHERE is_approved = 0').fetchone()['count']
-    total_requests = conn.execute('SELECT COUNT(*) as count FROM service_requests').fetchone()['count']
+    stats = repo.stats_counters()
     
     # Get pending helpers
-    pending_helpers_list = conn.execute('''
-        SELECT h.*, s.service_name
-        FROM helpers h
-        LEFT JOIN services s ON h.service_type_id = s.service_id
-        WHERE h.is_approved = 0
-    ''').fetchall()
-
+    pending_helpers_list = repo.pending_helpers()
     
     # Get recent requests
-    recent_requests = conn.execute('''
-        SELECT sr.*, u.full_name as user_name, h.full_name as helper_name, s.service_name
-        FROM service_requests sr
-        LEFT JOIN users u ON sr.user_id = u.user_id
-        LEFT JOIN helpers h ON sr.helper_id = h.helper_id
-        LEFT JOIN services s ON sr.service_type_id = s.service_id
-        ORDER BY sr.created_at DESC
-        LIMIT 10
-    ''').fetchall()
-    
-    conn.close()
+    recent_requests = repo.recent_requests()
     
     return render_template('admin_dashboard.html', 
-                         total_users=total_users,
-                         total_helpers=total_helpers,
-                         pending_helpers=pending_helpers,
-                         total_requests=total_requests,
+                         total_users=stats['total_users'],
+                         total_helpers=stats['total_helpers'],
+                         pending_helpers=stats['pending_helpers'],
+                         total_requests=stats['total_requests'],
                          pending_helpers_list=pending_helpers_list,
                          recent_requests=recent_requests)
 
 @app.route('/admin/approve_helper/<int:helper_id>')
 @admin_required
 def approve_helper(helper_id):
-    conn = get_db_connection()
-    conn.execute('UPDATE helpers SET is_approved = 1 WHERE helper_id = ?', (helper_id,))
-    conn.commit()
-    conn.close()
+    repo.approve_helper(helper_id)
+    sync_helper_index(helper_id)
     
     flash('Helper approved successfully!', 'success')
     return redirect(url_for('admin_dashboard'))
 
+@app.route('/admin/helpers/approve', methods=['POST'])
+@admin_required
+def approve_helpers():
+    """Approve every pending helper matching the form's service, date range and location filters"""
+    approved = repo.approve_helpers(
+        service_type_id=request.form.get('service_type_id', type=int) or None,
+        created_from=day_start(request.form.get('from')),
+        created_before=day_end(request.form.get('to')),
+        with_location=bool(request.form.get('with_location')),
+    )
+    if approved:
+        clear_helper_indexes()
+    
+    flash(f'{approved} helpers approved.', 'success')
+    return redirect(url_for('admin_helpers'))
 
+@app.route('/admin/helpers/import', methods=['POST'])
+@admin_required
+def admin_import_helpers():
+    """Store an uploaded .csv or .ndjson file and queue it for run_helper_imports"""
+    upload = request.files.get('file')
+    fmt = os.path.splitext(upload.filename)[1].lstrip('.').lower() if upload else None
+    if fmt not in IMPORT_FORMATS:
+        flash('Upload a .csv or .ndjson file.', 'error')
+        return redirect(url_for('admin_helpers'))
+    
+    os.makedirs(IMPORT_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=f'.{fmt}', dir=IMPORT_DIR)
+    with os.fdopen(fd, 'wb') as stored:
+        upload.save(stored)
+    repo.create_import(upload.filename, os.path.abspath(path), fmt, request.form.get('approve'))
+    jobs.trigger('run_helper_imports')
+    
+    flash(f'{upload.filename} is being imported; its progress is shown below.', 'success')
+    return redirect(url_for('admin_helpers'))
 
 @app.route('/admin/users')
 @admin_required
 def admin_users():
-    conn = get_db_connection()
-    users = conn.execute('SELECT * FROM users ORDER BY created_at DESC').fetchall()
-    conn.close()
+    users, next_page = fetch_page(repo.users_page, 'user_id')
     
-    return render_template('admin_users.html', users=users)
+    return render_template('admin_users.html', users=users, next_page=next_page)
 
 @app.route('/admin/helpers')
 @admin_required
 def admin_helpers():
+    helpers, next_page = fetch_page(repo.helpers_page, 'helper_id')
     conn = get_db_connection()
-    helpers = conn.execute('''
-        SELECT h.*, s.service_name
-        FROM helpers h
-        LEFT JOIN services s ON h.service_type_id = s.service_id
-        ORDER BY h.created_at DESC
-    ''').fetchall()
+    services = services_cache.get(conn)
     conn.close()
+    imports = [dict(row, report=json.loads(row['report'] or '{}')) for row in repo.recent_imports()]
     
-    return render_template('admin_helpers.html', helpers=helpers)
+    return render_template('admin_helpers.html', helpers=helpers, next_page=next_page, services=services,
+                           imports=imports)
 
 @app.route('/admin/services')
 @admin_required
 def admin_services():
     conn = get_db_connection()
-    services = conn.execute('SELECT * FROM services ORDER BY service_name').fetchall()
+    services = sorted(services_cache.get(conn), key=lambda service: service['service_name'])
     conn.close()
     
     return render_template('admin_services.html', services=services)
@@ -555,16 +1597,151 @@ def admin_services():
 def add_service():
     service_name = request.form['service_name']
     description = request.form['description']
+    max_concurrent_jobs = request.form.get('max_concurrent_jobs', 1, type=int)
+    if max_concurrent_jobs is None or max_concurrent_jobs < 1:
+        flash('Max concurrent jobs must be a whole number of at least 1.', 'error')
+        return redirect(url_for('admin_services'))
     
-    conn = get_db_connection()
-    conn.execute('INSERT INTO services (service_name, description) VALUES (?, ?)', 
-                (service_name, description))
-    conn.commit()
-    conn.close()
+    repo.add_service(service_name, description, max_concurrent_jobs)
+    services_cache.invalidate()
     
     flash('Service added successfully!', 'success')
     return redirect(url_for('admin_services'))
 
+@app.route('/admin/services/<int:service_id>/capacity', methods=['POST'])
+@admin_required
+def set_service_capacity(service_id):
+    max_concurrent_jobs = request.form.get('max_concurrent_jobs', type=int)
+    if max_concurrent_jobs is None or max_concurrent_jobs < 1:
+        flash('Max concurrent jobs must be a whole number of at least 1.', 'error')
+        return redirect(url_for('admin_services'))
+    
+    repo.set_service_capacity(service_id, max_concurrent_jobs)
+    services_cache.invalidate()
+    # which helpers have a free slot changed; rebuild the dispatch indexes
+    clear_helper_indexes()
+    
+    flash('Service capacity updated!', 'success')
+    return redirect(url_for('admin_services'))
+
+# Admin exports: table -> (exported columns, id column, supports status filter).
+# Password hashes are never exported.
+EXPORTS = {
+    'users': (['user_id', 'username', 'email', 'full_name', 'phone', 'address', 'created_at'],
+              'user_id', False),
+    'helpers': (['helper_id', 'username', 'email', 'full_name', 'phone', 'service_type_id',
+                 'latitude', 'longitude', 'is_available', 'is_approved', 'created_at'],
+                'helper_id', False),
+    'service_requests': (['request_id', 'user_id', 'helper_id', 'service_type_id', 'title', 'description',
+                          'user_latitude', 'user_longitude', 'user_address', 'status',
+                          'created_at', 'updated_at'],
+                         'request_id', True),
+}
+EXPORT_BATCH_SIZE = 1000
+
+def parse_day(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        abort(400)
+
+def day_start(value):
+    """Timestamp text for the start of a YYYY-MM-DD day, or None without one"""
+    return parse_day(value).strftime('%Y-%m-%d %H:%M:%S') if value else None
+
+def day_end(value):
+    """Timestamp text for the start of the day after a YYYY-MM-DD day, or None"""
+    return (parse_day(value) + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S') if value else None
+
+@app.route('/admin/export/<table>.<fmt>')
+@admin_required
+def admin_export(table, fmt):
+    """Stream a table as CSV or NDJSON, optionally filtered by ?from=, ?to= (YYYY-MM-DD) and ?status="""
+    if table not in EXPORTS or fmt not in ('csv', 'ndjson'):
+        abort(404)
+    columns, id_column, has_status = EXPORTS[table]
+
+    status = request.args.get('status') or None
+    if status and not has_status:
+        abort(400)
+    batches = repo.export_batches(table, columns, id_column, status, day_start(request.args.get('from')),
+                                  day_end(request.args.get('to')), EXPORT_BATCH_SIZE)
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if fmt == 'csv':
+            writer.writerow(columns)
+        for rows in batches:
+            for row in rows:
+                values = [row[column] for column in columns]
+                if fmt == 'csv':
+                    writer.writerow(values)
+                else:
+                    buffer.write(json.dumps(dict(zip(columns, values))) + '\n')
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    filename = f"{table}-{datetime.now().strftime('%Y%m%d')}.{fmt}"
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@app.route('/admin/analytics/demand.json')
+@admin_required
+def admin_demand():
+    """Demand heatmap from the hourly rollups: ?from=, ?to= (YYYY-MM-DD, UTC), ?service_type_id="""
+    start = time.perf_counter()
+    if request.args.get('to'):
+        end_day = parse_day(request.args['to']) + timedelta(days=1)
+    else:
+        end_day = datetime.utcnow() + timedelta(hours=1)
+    start_day = parse_day(request.args['from']) if request.args.get('from') else end_day - timedelta(days=1)
+    service_type_id = request.args.get('service_type_id', type=int)
+    
+    conns = [get_shard_connection(shard) for shard in ALL_SHARDS]
+    heatmap = demand_heatmap(conns, start_day.strftime('%Y-%m-%d %H:00'), end_day.strftime('%Y-%m-%d %H:00'),
+                             service_type_id)
+    for conn in conns:
+        conn.close()
+    
+    heatmap.update({
+        'from': start_day.strftime('%Y-%m-%d %H:00'),
+        'to': end_day.strftime('%Y-%m-%d %H:00'),
+        'service_type_id': service_type_id,
+        'geohash_precision': GEOHASH_PRECISION,
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 2),
+    })
+    return jsonify(heatmap)
+
+@app.route('/admin/db_stats')
+@admin_required
+def admin_db_stats():
+    stats = db_pool.stats()
+    stats['services_cache'] = {'hits': services_cache.hits, 'misses': services_cache.misses}
+    stats['password_hasher'] = password_hasher.stats()
+    stats['identity_cache'] = {'hits': identity_cache.hits, 'misses': identity_cache.misses}
+    stats['change_feed'] = change_feed.stats()
+    if replica_pool is not None:
+        stats['replica'] = replica_pool.stats()
+    if SHARDS:
+        stats['shards'] = [pool.stats() for pool in shard_pools[1:]]
+        stats['shard_jobs'] = [pool.stats() for pool in job_pools[1:]]
+    # the SQL behind each statement label in /metrics
+    stats['statements'] = dict(query_profiler.statements)
+    return jsonify(stats)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    authorization = request.headers.get('Authorization', '')
+    scraper = METRICS_TOKEN and hmac.compare_digest(authorization.encode(), f'Bearer {METRICS_TOKEN}'.encode())
+    if not scraper and current_account('admin') is None:
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/admin/logout')
 def admin_logout():
     session.pop('admin_id', None)
@@ -572,5 +1749,174 @@ def admin_logout():
     flash('Logged out successfully!', 'success')
     return redirect(url_for('home'))
 
+# ---------------------------JSON API---------------------------------------------
+# For the mobile app. Same session cookie as the site; lists and details
+# carry an ETag (and Last-Modified where rows have updated_at), and a
+# matching If-None-Match / If-Modified-Since is answered 304 from a single
+# index lookup without reading any rows.
+API_PREFIX = '/api/v1'
+
+@app.errorhandler(HTTPException)
+def http_error(e):
+    if request.path.startswith(API_PREFIX):
+        return jsonify(error=e.description), e.code
+    return e
+
+def api_account(*kinds):
+    """(kind, id) of the first logged-in account of these kinds, or 401"""
+    for kind in kinds:
+        account = current_account(kind)
+        if account is not None:
+            return kind, account[f'{kind}_id']
+    abort(401, 'Login required.')
+
+def api_body(*required):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, 'Expected a JSON object.')
+    missing = [field for field in required if data.get(field) in (None, '')]
+    if missing:
+        abort(400, f"Missing {', '.join(missing)}.")
+    return data
+
+def api_validators(*parts, updated_at=None):
+    """(etag, last_modified) for a resource whose state is `parts`"""
+    etag = hashlib.sha1(repr(parts + (updated_at,)).encode()).hexdigest()[:20]
+    last_modified = None
+    if updated_at:
+        # stored as UTC text; HTTP dates have whole seconds
+        last_modified = datetime.fromisoformat(updated_at).replace(microsecond=0, tzinfo=timezone.utc)
+    return etag, last_modified
+
+def api_cache_headers(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # per-account data: clients may keep it but must revalidate
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def api_not_modified(etag, last_modified):
+    """An empty 304 if the client's copy is current, else None"""
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return api_cache_headers(Response(status=304), etag, last_modified)
+
+def api_json(payload, etag, last_modified=None):
+    return api_cache_headers(jsonify(payload), etag, last_modified)
+
+@app.route(f'{API_PREFIX}/login', methods=['POST'])
+def api_login():
+    data = api_body('account', 'username', 'password')
+    if data['account'] not in ('user', 'helper'):
+        abort(400, 'account must be "user" or "helper".')
+    id_column = f"{data['account']}_id"
+    account = repo.account_by_username(data['account'], data['username'])
+    if not check_login(data['account'], account, data['password']):
+        abort(401, 'Invalid username or password.')
+    if data['account'] == 'helper' and not account['is_approved']:
+        abort(403, 'Your account is not approved yet.')
+    session.regenerate()
+    session[id_column] = account[id_column]
+    session[f"{data['account']}_name"] = account['full_name']
+    return jsonify(account=data['account'], id=account[id_column], full_name=account['full_name'])
+
+@app.route(f'{API_PREFIX}/logout', methods=['POST'])
+def api_logout():
+    session.clear()
+    return '', 204
+
+@app.route(f'{API_PREFIX}/services')
+def api_services():
+    conn = get_db_connection()
+    etag, _ = api_validators('services', services_cache.version(conn))
+    not_modified = api_not_modified(etag, None)
+    if not_modified:
+        return not_modified
+    services = [{'service_id': service['service_id'], 'service_name': service['service_name'],
+                 'description': service['description']} for service in services_cache.get(conn)]
+    conn.close()
+    return api_json({'services': services}, etag)
+
+@app.route(f'{API_PREFIX}/requests')
+def api_requests():
+    kind, account_id = api_account('user', 'helper')
+    count, updated_at = repo.requests_version(kind, account_id)
+    etag, last_modified = api_validators(kind, account_id, count, updated_at=updated_at)
+    not_modified = api_not_modified(etag, last_modified)
+    if not_modified:
+        return not_modified
+    rows, next_page = fetch_page(repo.api_requests, 'request_id', kind, account_id)
+    return api_json({'requests': [dict(row) for row in rows], 'next_page': next_page}, etag, last_modified)
+
+@app.route(f'{API_PREFIX}/requests', methods=['POST'])
+def api_create_request():
+    kind, user_id = api_account('user')
+    data = api_body('service_type_id', 'title', 'description')
+    latitude, longitude = known_point(data)
+    service_type_id = known_service_type(data['service_type_id'])
+    request_id = repo.create_request(user_id, service_type_id, data['title'], data['description'], latitude,
+                                     longitude, data.get('address'))
+    row = repo.api_request(kind, request_id, user_id)
+    jobs.trigger('dispatch_queued_requests')
+    response = api_json(dict(row), *api_validators(request_id, row['status'], updated_at=row['updated_at']))
+    response.status_code = 201
+    response.location = url_for('api_request', request_id=request_id)
+    return response
+
+@app.route(f'{API_PREFIX}/requests/<int:request_id>')
+def api_request(request_id):
+    kind, account_id = api_account('user', 'helper')
+    row = repo.request_state(kind, request_id, account_id)
+    if row is None:
+        abort(404, 'No such request.')
+    etag, last_modified = api_validators(request_id, row['status'], updated_at=row['updated_at'])
+    not_modified = api_not_modified(etag, last_modified)
+    if not_modified:
+        return not_modified
+    detail = dict(repo.api_request(kind, request_id, account_id))
+    detail['history'] = [{'from': event['from_status'], 'to': event['to_status'], 'at': event['ts']}
+                         for event in repo.request_history(request_id)]
+    return api_json(detail, etag, last_modified)
+
+@app.route(f'{API_PREFIX}/requests/<int:request_id>/status', methods=['POST'])
+def api_request_status(request_id):
+    kind, account_id = api_account('user', 'helper')
+    status = api_body('status')['status']
+    allowed = HELPER_STATUSES if kind == 'helper' else USER_STATUSES
+    if status not in allowed:
+        abort(400, f"status must be one of {', '.join(allowed)}.")
+    previous = change_request_status(request_id, status, kind, account_id)
+    if previous is None:
+        abort(409, f"This request can't be moved to {status} from its current status.")
+    return jsonify(request_id=request_id, previous_status=previous, status=status)
+
+@app.route(f'{API_PREFIX}/changes')
+def api_changes():
+    """Requests changed since ?since=<cursor>, for incremental sync.
+
+    Call without `since` for a full sync, then keep passing back the
+    returned cursor; admins get every request, others their own.
+    """
+    kind, account_id = api_account('user', 'helper', 'admin')
+    since = request.args.get('since')
+    cursor = decode_cursors(since) if since else None
+    rows, cursor, more = changed_requests(kind, account_id, cursor, page_limit())
+    return jsonify(changes=[dict(row) for row in rows], cursor=encode_cursors(cursor), has_more=more)
+
+@app.route(f'{API_PREFIX}/helper/availability', methods=['GET', 'PUT'])
+def api_helper_availability():
+    kind, helper_id = api_account('helper')
+    if request.method == 'PUT':
+        is_available = api_body('is_available')['is_available']
+        if not isinstance(is_available, bool):
+            abort(400, 'is_available must be true or false.')
+        repo.set_helper_availability(helper_id, is_available)
+        sync_helper_index(helper_id)
+        account_changed('helper', helper_id)
+    row = repo.helper_availability(helper_id)
+    return jsonify(is_available=bool(row['is_available']), active_jobs=row['active_jobs'])
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,394 @@
+"""
+Benchmark the app's hot routes against a seeded database.
+
+    python seed_data.py --dir /tmp/nearfix-bench --users 100000 --helpers 5000 --requests 200000
+    python bench_app.py --dir /tmp/nearfix-bench --ops 300 --out before.json
+    python bench_app.py --dir /tmp/nearfix-bench --url http://127.0.0.1:8000 --compare before.json
+
+Each scenario is run by --workers processes at once, each logged in as its
+own accounts picked from the seeded data. Requests go through the Flask test
+client in-process, or over HTTP to a running server with --url (start it from
+the same --dir, e.g. `gunicorn -w 4 -k gthread --chdir /tmp/nearfix-bench
+--pythonpath . app:app`). Logging in happens before the clock starts, except
+in the logins scenario.
+
+Per route it reports requests, errors (5xx, or 4xx where none is expected),
+throughput and p50/p95/p99/max latency. --out writes the results as JSON
+together with the git commit; --compare reads such a file and exits non-zero
+when any route's p95 got more than --tolerance slower.
+"""
+import argparse
+import http.cookiejar
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+from seed_data import Geography
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ADMIN_LOGIN = ('admin', 'admin123')
+# latency differences below this are noise, whatever the percentage
+NOISE_MS = 1.0
+
+
+class TestClientDriver:
+    """In-process requests through the Flask test client"""
+
+    def __init__(self, base_url=None):
+        import app as app_module
+        self.client = app_module.app.test_client()
+
+    def request(self, method, path, data=None, json_body=None, headers=None):
+        response = self.client.open(path, method=method, data=data, json=json_body, headers=headers)
+        response.close()
+        return response.status_code, response.headers
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # time the POST itself, not the page it redirects to
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpDriver:
+    """Requests over HTTP to a running server, with a cookie jar per driver"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect)
+
+    def request(self, method, path, data=None, json_body=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode()
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers)
+        try:
+            with self.opener.open(req, timeout=60) as response:
+                response.read()
+                return response.status, response.headers
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code, e.headers
+
+
+def login(driver, kind, username, password):
+    status, _ = driver.request('POST', f'/{kind}/login', data={'username': username, 'password': password})
+    return status
+
+
+# Scenarios: accounts each worker logs in as, and one step of traffic.
+# A step returns (route, status, expected statuses).
+
+class Scenario:
+    accounts = ()
+
+    def __init__(self, drivers, accounts, rng, services):
+        self.drivers = drivers
+        self.accounts = accounts
+        self.rng = rng
+        self.services = services
+
+    def step(self):
+        raise NotImplementedError
+
+
+class BookingStorm(Scenario):
+    """Users submitting requests as fast as they can"""
+    accounts = ('user',)
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.geo = Geography(self.rng)
+
+    def step(self):
+        lat, lon = self.geo.point(self.geo.city())
+        status, _ = self.drivers['user'].request('POST', '/user/request_service', data={
+            'service_type_id': str(self.rng.choice(self.services)),
+            'title': 'Benchmark booking',
+            'description': 'Booked by bench_app.py',
+            'latitude': str(lat),
+            'longitude': str(lon),
+            'address': '',
+        })
+        return 'POST /user/request_service', status, (302,)
+
+
+class Dashboards(Scenario):
+    """Users and helpers reading their dashboards, in HTML and through the API"""
+    accounts = ('user', 'helper')
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.etag = None
+
+    def step(self):
+        choice = self.rng.random()
+        if choice < 0.35:
+            status, _ = self.drivers['user'].request('GET', '/user/dashboard')
+            return 'GET /user/dashboard', status, (200,)
+        if choice < 0.7:
+            status, _ = self.drivers['helper'].request('GET', '/helper/dashboard')
+            return 'GET /helper/dashboard', status, (200,)
+        if choice < 0.85 or self.etag is None:
+            status, headers = self.drivers['user'].request('GET', '/api/v1/requests')
+            self.etag = headers.get('ETag')
+            return 'GET /api/v1/requests', status, (200,)
+        status, _ = self.drivers['user'].request('GET', '/api/v1/requests', headers={'If-None-Match': self.etag})
+        return 'GET /api/v1/requests (If-None-Match)', status, (200, 304)
+
+
+class AdminPages(Scenario):
+    """The admin screens"""
+    accounts = ('admin',)
+    PAGES = ['/admin/dashboard', '/admin/users', '/admin/helpers', '/admin/services',
+             '/admin/analytics/demand.json', '/admin/db_stats']
+
+    def step(self):
+        path = self.rng.choice(self.PAGES)
+        status, _ = self.drivers['admin'].request('GET', path)
+        return f'GET {path}', status, (200,)
+
+
+class Logins(Scenario):
+    """Users and helpers logging in; each step is a fresh session"""
+
+    def __init__(self, drivers, accounts, rng, services, driver_class=None, base_url=None):
+        super().__init__(drivers, accounts, rng, services)
+        self.driver_class = driver_class
+        self.base_url = base_url
+
+    def step(self):
+        kind = self.rng.choice(('user', 'helper'))
+        username, password = self.rng.choice(self.accounts[kind])
+        status = login(self.driver_class(self.base_url), kind, username, password)
+        # 503 means the hashing pool pushed back
+        return f'POST /{kind}/login', status, (302,)
+
+
+SCENARIOS = {
+    'booking_storm': BookingStorm,
+    'dashboards': Dashboards,
+    'admin': AdminPages,
+    'logins': Logins,
+}
+
+
+def sample_accounts(conn, kind, count, password, rng):
+    """`count` random seeded accounts of a kind, as (username, password) pairs"""
+    table, id_column = {'user': ('users', 'user_id'), 'helper': ('helpers', 'helper_id')}[kind]
+    extra = 'AND is_approved = 1' if kind == 'helper' else ''
+    low, high = conn.execute(f"SELECT MIN({id_column}), MAX({id_column}) FROM {table} "
+                             f"WHERE username LIKE 'bench%' {extra}").fetchone()
+    if low is None:
+        sys.exit(f'no seeded {kind}s; run seed_data.py first')
+    picked = set()
+    for _ in range(20):
+        ids = [rng.randint(low, high) for _ in range(count * 2)]
+        placeholders = ', '.join('?' * len(ids))
+        picked.update(row[0] for row in conn.execute(
+            f"SELECT username FROM {table} WHERE {id_column} IN ({placeholders}) "
+            f"AND username LIKE 'bench%' {extra}", ids))
+        if len(picked) >= count:
+            break
+    return [(username, password) for username in sorted(picked)[:count]]
+
+
+def worker(number, scenario_name, args, accounts, services, barrier, results):
+    driver_class = HttpDriver if args.url else TestClientDriver
+    rng = random.Random(args.seed * 1000 + number)
+    scenario_class = SCENARIOS[scenario_name]
+    drivers = {}
+    mine = {kind: accounts[kind][number::args.workers] for kind in accounts}
+    for kind in scenario_class.accounts:
+        drivers[kind] = driver_class(args.url)
+        username, password = ADMIN_LOGIN if kind == 'admin' else mine[kind][0]
+        login(drivers[kind], kind, username, password)
+    if scenario_class is Logins:
+        scenario = Logins(drivers, mine, rng, services, driver_class, args.url)
+    else:
+        scenario = scenario_class(drivers, mine, rng, services)
+
+    routes = {}
+    barrier.wait()
+    started = time.time()
+    for _ in range(args.ops):
+        start = time.perf_counter()
+        route, status, expected = scenario.step()
+        elapsed = time.perf_counter() - start
+        entry = routes.setdefault(route, {'latencies': [], 'errors': 0, 'statuses': {}})
+        entry['latencies'].append(elapsed)
+        entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+        if status not in expected:
+            entry['errors'] += 1
+    results.put((started, time.time(), routes))
+
+    if not args.url:
+        import app as app_module
+        app_module.password_hasher.shutdown()
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(started, finished, worker_routes):
+    seconds = finished - started
+    merged = {}
+    for routes in worker_routes:
+        for route, entry in routes.items():
+            into = merged.setdefault(route, {'latencies': [], 'errors': 0, 'statuses': {}})
+            into['latencies'] += entry['latencies']
+            into['errors'] += entry['errors']
+            for status, count in entry['statuses'].items():
+                into['statuses'][str(status)] = into['statuses'].get(str(status), 0) + count
+    summary = {'seconds': round(seconds, 3), 'ops': 0, 'errors': 0, 'routes': {}}
+    for route, entry in sorted(merged.items()):
+        ordered = sorted(entry['latencies'])
+        summary['ops'] += len(ordered)
+        summary['errors'] += entry['errors']
+        summary['routes'][route] = {
+            'count': len(ordered),
+            'errors': entry['errors'],
+            'statuses': entry['statuses'],
+            'ops_per_sec': round(len(ordered) / seconds, 1) if seconds else None,
+            'p50_ms': round(percentile(ordered, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(ordered, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(ordered, 0.99) * 1000, 2),
+            'max_ms': round(ordered[-1] * 1000, 2),
+        }
+    summary['ops_per_sec'] = round(summary['ops'] / seconds, 1) if seconds else None
+    return summary
+
+
+def run_scenario(name, args, accounts, services):
+    barrier = multiprocessing.Barrier(args.workers)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(n, name, args, accounts, services, barrier, results))
+                 for n in range(args.workers)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    if any(process.exitcode for process in processes):
+        sys.exit(f'{name}: a worker process failed')
+    return summarize(min(c[0] for c in collected), max(c[1] for c in collected), [c[2] for c in collected])
+
+
+def print_report(results):
+    print(f"{'scenario':<14} {'route':<40} {'count':>6} {'err':>4} {'ops/s':>8} "
+          f"{'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  (ms)")
+    for name, scenario in results['scenarios'].items():
+        for route, stats in scenario['routes'].items():
+            print(f"{name:<14} {route:<40} {stats['count']:>6} {stats['errors']:>4} {stats['ops_per_sec']:>8} "
+                  f"{stats['p50_ms']:>8} {stats['p95_ms']:>8} {stats['p99_ms']:>8} {stats['max_ms']:>8}")
+        print(f"{name:<14} {'(all)':<40} {scenario['ops']:>6} {scenario['errors']:>4} {scenario['ops_per_sec']:>8}")
+
+
+def compare(results, baseline, tolerance):
+    """Print p95 changes against an earlier run; returns the routes that regressed"""
+    regressed = []
+    print(f"\ncompared with {baseline.get('commit') or 'baseline'} ({baseline.get('started_at')}):")
+    if baseline.get('mode') != results['mode'] or baseline.get('dataset') != results['dataset']:
+        print(f"  note: baseline ran in {baseline.get('mode')} mode on {baseline.get('dataset')}")
+    for name, scenario in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name, {}).get('routes', {})
+        for route, stats in scenario['routes'].items():
+            if route not in before:
+                continue
+            old, new = before[route]['p95_ms'], stats['p95_ms']
+            change = (new - old) / old if old else 0
+            slower = change > tolerance and new - old > NOISE_MS
+            if slower:
+                regressed.append(f'{name} {route}')
+            print(f"  {'SLOWER' if slower else '':<7}{name:<14} {route:<40} p95 {old:>8} -> {new:>8} ({change:+.0%})")
+    return regressed
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--dir', required=True, help='directory holding the seeded nearfix.db')
+    parser.add_argument('--url', help='benchmark a running server instead of the in-process test client')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"comma-separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument('--workers', type=int, default=4, help='concurrent client processes')
+    parser.add_argument('--ops', type=int, default=200, help='requests per worker per scenario')
+    parser.add_argument('--password', default='bench', help='password the accounts were seeded with')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='earlier --out file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 slowdown, as a fraction')
+    args = parser.parse_args()
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    # the app opens nearfix.db in the working directory
+    args.out = args.out and os.path.abspath(args.out)
+    args.compare = args.compare and os.path.abspath(args.compare)
+    sys.path.insert(0, HERE)
+    os.chdir(args.dir)
+    if not os.path.exists('nearfix.db'):
+        sys.exit(f'{args.dir} has no nearfix.db; run seed_data.py first')
+    conn = sqlite3.connect('nearfix.db')
+    rng = random.Random(args.seed)
+    per_worker = 3
+    accounts = {kind: sample_accounts(conn, kind, args.workers * per_worker, args.password, rng)
+                for kind in ('user', 'helper')}
+    services = [row[0] for row in conn.execute('SELECT service_id FROM services')]
+    dataset = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+               for table in ('users', 'helpers', 'service_requests')}
+    conn.close()
+    if not args.url:
+        # build the app (and run its migrations) once, before the workers fork
+        import app  # noqa: F401
+
+    results = {
+        'commit': git_commit(),
+        'started_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'mode': 'http' if args.url else 'test_client',
+        'params': {key: value for key, value in vars(args).items() if key not in ('out', 'compare')},
+        'dataset': dataset,
+        'scenarios': {},
+    }
+    for name in names:
+        print(f'running {name} ...', file=sys.stderr)
+        results['scenarios'][name] = run_scenario(name, args, accounts, services)
+
+    print_report(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(results, json.load(f), args.tolerance)
+        if regressed:
+            print(f"\n{len(regressed)} routes slower than {args.tolerance:.0%}: {', '.join(regressed)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Compare batch assignment against per-request greedy dispatch.
+
+    python bench_matching.py --requests 2000 --helpers 1500
+
+Requests and helpers are scattered around a few hotspots in a city-sized box.
+For each strategy the script reports assignments per second, how many
+requests got a helper, the total travel distance of those assignments and the
+most jobs any one helper was given.
+"""
+import argparse
+import json
+import random
+import time
+from collections import Counter
+
+from matching import greedy_assignment, min_distance_assignment, total_distance
+from spatial import GridIndex
+
+# Delhi NCR-ish bounding box and a few demand hotspots
+CITY = (28.40, 28.90, 76.85, 77.45)
+HOTSPOTS = [(28.63, 77.22), (28.46, 77.03), (28.57, 77.32), (28.70, 77.10)]
+
+
+def random_point(rng):
+    if rng.random() < 0.7:
+        lat, lon = rng.choice(HOTSPOTS)
+        return lat + rng.gauss(0, 0.03), lon + rng.gauss(0, 0.03)
+    return rng.uniform(CITY[0], CITY[1]), rng.uniform(CITY[2], CITY[3])
+
+
+def build_candidates(n_requests, n_helpers, k, seed):
+    rng = random.Random(seed)
+    index = GridIndex()
+    for helper_id in range(n_helpers):
+        index.add(helper_id, *random_point(rng))
+    requests = [random_point(rng) for _ in range(n_requests)]
+
+    start = time.perf_counter()
+    candidates = {i: index.nearest(lat, lon, k=k) for i, (lat, lon) in enumerate(requests)}
+    return candidates, time.perf_counter() - start
+
+
+def run(strategy, candidates):
+    start = time.perf_counter()
+    assigned = strategy(candidates)
+    elapsed = time.perf_counter() - start
+    load = Counter(assigned.values())
+    return {
+        'seconds': round(elapsed, 4),
+        'assignments_per_sec': round(len(assigned) / elapsed) if elapsed else None,
+        'assigned': len(assigned),
+        'total_km': round(total_distance(candidates, assigned), 2),
+        'mean_km': round(total_distance(candidates, assigned) / len(assigned), 3) if assigned else None,
+        'max_jobs_per_helper': max(load.values()) if load else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--helpers', type=int, default=1500)
+    parser.add_argument('--candidates', type=int, default=8, help='nearest helpers considered per request')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    candidates, prefilter_seconds = build_candidates(args.requests, args.helpers, args.candidates, args.seed)
+    results = {
+        'params': vars(args),
+        'prefilter_seconds': round(prefilter_seconds, 4),
+        'greedy': run(greedy_assignment, candidates),
+        'greedy_exclusive': run(lambda c: greedy_assignment(c, exclusive=True), candidates),
+        'min_distance': run(min_distance_assignment, candidates),
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{args.requests} requests, {args.helpers} helpers, {args.candidates} candidates each "
+          f"(spatial prefilter {results['prefilter_seconds']}s)")
+    print(f"{'strategy':<18}{'seconds':>9}{'assign/s':>10}{'assigned':>10}{'total km':>11}{'mean km':>9}{'max load':>10}")
+    for name in ('greedy', 'greedy_exclusive', 'min_distance'):
+        r = results[name]
+        print(f"{name:<18}{r['seconds']:>9}{r['assignments_per_sec']:>10}{r['assigned']:>10}"
+              f"{r['total_km']:>11}{r['mean_km']:>9}{r['max_jobs_per_helper']:>10}")
+
+
+if __name__ == '__main__':
+    main()
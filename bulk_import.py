@@ -0,0 +1,156 @@
+"""
+Bulk import of helpers from CSV or NDJSON.
+
+The file is read as a stream, one chunk of rows at a time. Password hashing,
+which is deliberately slow, is spread over a process pool, and the hashes for
+the next chunk are computed while the current chunk is being inserted. Each
+chunk goes in with one executemany and its own transaction, so a bad row late
+in a large file does not undo the rows before it.
+
+With region shards each helper goes to the shard of their location, and a
+username or email already taken in any shard is skipped.
+"""
+import csv
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+from werkzeug.security import generate_password_hash
+
+from spatial import parse_point
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+HELPER_IMPORT_COLUMNS = ['username', 'email', 'password', 'full_name', 'phone',
+                         'service_type_id', 'latitude', 'longitude']
+REQUIRED_COLUMNS = ('username', 'email', 'password', 'full_name')
+IMPORT_BATCH_SIZE = 500
+
+INSERT_HELPERS = '''
+    INSERT OR IGNORE INTO helpers
+    (username, email, password, full_name, phone, service_type_id, latitude, longitude, is_approved)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+def read_rows(stream, fmt):
+    """Yield one dict per record of a binary CSV or NDJSON stream"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        yield from csv.DictReader(text)
+    elif fmt == 'ndjson':
+        for line in text:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError(f'unsupported import format: {fmt}')
+
+
+def _clean(row):
+    """Normalize one record to HELPER_IMPORT_COLUMNS, or None if it is unusable"""
+    values = {column: row.get(column) for column in HELPER_IMPORT_COLUMNS}
+    for column, value in values.items():
+        if isinstance(value, str):
+            value = value.strip()
+        values[column] = None if value in ('', None) else value
+    if any(values[column] is None for column in REQUIRED_COLUMNS):
+        return None
+    try:
+        values['latitude'], values['longitude'] = parse_point(values['latitude'], values['longitude']) or (None, None)
+        if values['service_type_id'] is not None:
+            values['service_type_id'] = int(values['service_type_id'])
+    except (TypeError, ValueError):
+        return None
+    return values
+
+
+def _hash_batch(pool, workers, batch, hash_method):
+    # Executor.map submits everything now and hands back results lazily
+    chunksize = max(1, len(batch) // (workers * 4))
+    hasher = partial(generate_password_hash, method=hash_method) if hash_method else generate_password_hash
+    return pool.map(hasher, [row['password'] for row in batch], chunksize=chunksize)
+
+
+def import_helpers(conn, rows, approve=False, batch_size=IMPORT_BATCH_SIZE, workers=None, hash_method=None,
+                   route=None, progress=None):
+    """Insert helper records from an iterable of dicts.
+
+    Rows missing a required column or with bad numbers are counted as invalid;
+    rows whose username or email already exists are counted as skipped.
+    With `route`, conn is a list of one connection per shard and
+    route(latitude, longitude) picks a helper's shard.
+    progress(report) is called with the counts so far after each chunk commits.
+    Returns a report with counts and rows/sec.
+    """
+    conns = conn if route is not None else [conn]
+    workers = workers or os.cpu_count() or 1
+    report = {'inserted': 0, 'skipped': 0, 'invalid': 0}
+    start = time.perf_counter()
+
+    def batches():
+        source = iter(rows)
+        while True:
+            raw = list(islice(source, batch_size))
+            if not raw:
+                return
+            batch = [row for row in map(_clean, raw) if row is not None]
+            report['invalid'] += len(raw) - len(batch)
+            yield batch
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = None
+        for batch in batches():
+            hashed = _hash_batch(pool, workers, batch, hash_method)
+            # the pool hashes this batch while the previous one is inserted
+            if pending:
+                _insert(conns, route, *pending, approve, report)
+                if progress:
+                    progress(report)
+            pending = (batch, hashed)
+        if pending:
+            _insert(conns, route, *pending, approve, report)
+
+    seconds = time.perf_counter() - start
+    report['seconds'] = round(seconds, 3)
+    total = report['inserted'] + report['skipped'] + report['invalid']
+    report['rows_per_sec'] = round(total / seconds) if seconds else None
+    return report
+
+
+def _taken(conns, batch):
+    """Usernames and emails of `batch` that some shard already has"""
+    usernames, emails = set(), set()
+    for column, taken in (('username', usernames), ('email', emails)):
+        values = [row[column] for row in batch]
+        marks = ', '.join('?' * len(values))
+        for conn in conns:
+            taken.update(found for found, in conn.execute(
+                f'SELECT {column} FROM helpers WHERE {column} IN ({marks})', values))
+    return usernames, emails
+
+
+def _insert(conns, route, batch, hashed, approve, report):
+    by_shard = {}
+    if route is not None and batch:
+        # INSERT OR IGNORE only sees its own shard's helpers
+        usernames, emails = _taken(conns, batch)
+    for row, password_hash in zip(batch, hashed):
+        shard = 0
+        if route is not None:
+            if row['username'] in usernames or row['email'] in emails:
+                report['skipped'] += 1
+                continue
+            usernames.add(row['username'])
+            emails.add(row['email'])
+            shard = route(row['latitude'], row['longitude'])
+        by_shard.setdefault(shard, []).append(
+            (row['username'], row['email'], password_hash, row['full_name'], row['phone'],
+             row['service_type_id'], row['latitude'], row['longitude'], int(approve)))
+    for shard, params in by_shard.items():
+        cur = conns[shard].executemany(INSERT_HELPERS, params)
+        conns[shard].commit()
+        report['inserted'] += cur.rowcount
+        report['skipped'] += len(params) - cur.rowcount
@@ -0,0 +1,99 @@
+"""
+Small in-process caches for rarely written tables and logged-in accounts.
+
+Each gunicorn worker keeps its own copy, so a write in one worker has to reach
+the others: writers bump a row in the cache_versions table (triggers do this)
+and readers compare it with the version they loaded, which is a single
+primary-key lookup.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class VersionedCache:
+    """Read-through cache of one query result.
+
+    The cached value is reloaded when the TTL runs out, when invalidate() is
+    called, or when the cache_versions row for `name` changes.
+    """
+
+    def __init__(self, name, loader, ttl=300):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self._value = None
+        self._version = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _current_version(self, conn):
+        row = conn.execute('SELECT version FROM cache_versions WHERE name = ?', (self.name,)).fetchone()
+        return row[0] if row else None
+
+    def get(self, conn):
+        version = self._current_version(conn)
+        with self._lock:
+            fresh = time.monotonic() - self._loaded_at < self.ttl
+            if self._value is not None and fresh and version == self._version:
+                self.hits += 1
+                return self._value
+            self.misses += 1
+            self._value = self.loader(conn)
+            self._version = version
+            self._loaded_at = time.monotonic()
+            return self._value
+
+    def version(self, conn):
+        """The cache_versions counter; it changes whenever the cached rows do"""
+        return self._current_version(conn)
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+
+
+class IdentityCache:
+    """Per-process cache of logged-in accounts' profile rows.
+
+    loaders maps an account kind ('user', 'helper', ...) to a function taking
+    the account id and returning its row, or None if it no longer exists.
+    Entries expire after `ttl` seconds. A caller passing a higher `version`
+    than the entry was loaded with forces a reload; the app keeps that counter
+    in the session and bumps it when an account edits itself, so the account
+    sees its own change from every worker at once.
+    """
+
+    def __init__(self, loaders, ttl=60, max_entries=10000):
+        self.loaders = loaders
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind, account_id, version=0):
+        key = (kind, account_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                row, loaded_version, loaded_at = entry
+                if loaded_version >= version and time.monotonic() - loaded_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return row
+            self.misses += 1
+        row = self.loaders[kind](account_id)
+        with self._lock:
+            self._entries[key] = (row, version, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return row
+
+    def invalidate(self, kind, account_id):
+        with self._lock:
+            self._entries.pop((kind, account_id), None)
@@ -2,6 +2,10 @@
 -- NearFix Database Schema
 -- All-in-One Local Service Booking System
 -- Database: MySQL
+--
+-- The tables repository.py reads and writes. Sessions, the dispatch
+-- queue, rollups and the other tables app.py maintains itself are
+-- SQLite-only, so app.py still runs on SQLite.
 -- =====================================================
 
 -- Create Database
@@ -15,6 +19,7 @@ CREATE TABLE services (
     service_id INT AUTO_INCREMENT PRIMARY KEY,
     service_name VARCHAR(100) NOT NULL,
     description TEXT,
+    max_concurrent_jobs INT NOT NULL DEFAULT 1,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -47,6 +52,7 @@ CREATE TABLE helpers (
     longitude DECIMAL(11,8),
     is_available BOOLEAN DEFAULT TRUE,
     is_approved BOOLEAN DEFAULT FALSE,
+    active_jobs INT NOT NULL DEFAULT 0,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (service_type_id) REFERENCES services(service_id)
 );
@@ -75,8 +81,11 @@ CREATE TABLE service_requests (
     ) DEFAULT 'pending',
 
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        ON UPDATE CURRENT_TIMESTAMP,
+    -- milliseconds, so the changes cursor can tell apart two updates in one second
+    updated_at TIMESTAMP(3) DEFAULT CURRENT_TIMESTAMP(3)
+        ON UPDATE CURRENT_TIMESTAMP(3),
+    -- position of the latest write in the changes feed, set by triggers below
+    change_seq BIGINT NOT NULL DEFAULT 0,
 
     FOREIGN KEY (user_id) REFERENCES users(user_id),
     FOREIGN KEY (helper_id) REFERENCES helpers(helper_id),
@@ -111,6 +120,121 @@ CREATE TABLE admins (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- =====================================================
+-- INDEXES (dashboards, dispatch and admin listings)
+-- =====================================================
+CREATE INDEX idx_requests_user_created ON service_requests (user_id, created_at);
+CREATE INDEX idx_requests_helper_created ON service_requests (helper_id, created_at);
+CREATE INDEX idx_requests_created ON service_requests (created_at);
+CREATE INDEX idx_requests_status_created ON service_requests (status, created_at);
+CREATE INDEX idx_requests_user_updated ON service_requests (user_id, updated_at);
+CREATE INDEX idx_requests_helper_updated ON service_requests (helper_id, updated_at);
+CREATE INDEX idx_requests_updated ON service_requests (updated_at, request_id);
+CREATE INDEX idx_requests_change_seq ON service_requests (change_seq);
+CREATE INDEX idx_requests_user_change_seq ON service_requests (user_id, change_seq);
+CREATE INDEX idx_requests_helper_change_seq ON service_requests (helper_id, change_seq);
+CREATE INDEX idx_helpers_capacity ON helpers (service_type_id, is_available, is_approved, active_jobs, latitude, longitude);
+CREATE INDEX idx_helpers_approved ON helpers (is_approved);
+CREATE INDEX idx_users_created ON users (created_at);
+CREATE INDEX idx_helpers_created ON helpers (created_at);
+
+-- =====================================================
+-- STATS COUNTERS (admin dashboard, maintained by triggers)
+-- =====================================================
+CREATE TABLE stats_counters (
+    name VARCHAR(50) PRIMARY KEY,
+    value BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO stats_counters (name, value) VALUES
+('total_users', 0), ('total_helpers', 0), ('pending_helpers', 0), ('total_requests', 0);
+
+CREATE TRIGGER trg_users_count_insert AFTER INSERT ON users FOR EACH ROW
+    UPDATE stats_counters SET value = value + 1 WHERE name = 'total_users';
+CREATE TRIGGER trg_users_count_delete AFTER DELETE ON users FOR EACH ROW
+    UPDATE stats_counters SET value = value - 1 WHERE name = 'total_users';
+CREATE TRIGGER trg_helpers_count_insert AFTER INSERT ON helpers FOR EACH ROW
+    UPDATE stats_counters
+    SET value = value + (CASE WHEN name = 'total_helpers' THEN 1 ELSE NEW.is_approved = 0 END)
+    WHERE name IN ('total_helpers', 'pending_helpers');
+CREATE TRIGGER trg_helpers_count_approve AFTER UPDATE ON helpers FOR EACH ROW
+    UPDATE stats_counters SET value = value + (NEW.is_approved = 0) - (OLD.is_approved = 0)
+    WHERE name = 'pending_helpers';
+CREATE TRIGGER trg_helpers_count_delete AFTER DELETE ON helpers FOR EACH ROW
+    UPDATE stats_counters
+    SET value = value - (CASE WHEN name = 'total_helpers' THEN 1 ELSE OLD.is_approved = 0 END)
+    WHERE name IN ('total_helpers', 'pending_helpers');
+CREATE TRIGGER trg_requests_count_insert AFTER INSERT ON service_requests FOR EACH ROW
+    UPDATE stats_counters SET value = value + 1 WHERE name = 'total_requests';
+CREATE TRIGGER trg_requests_count_delete AFTER DELETE ON service_requests FOR EACH ROW
+    UPDATE stats_counters SET value = value - 1 WHERE name = 'total_requests';
+
+-- =====================================================
+-- REQUEST EVENTS (append-only status history)
+-- =====================================================
+-- The allowed moves are REQUEST_TRANSITIONS in app.py:
+-- pending -> accepted -> in_progress -> work_done_by_helper -> completed,
+-- and pending/accepted/in_progress -> cancelled.
+CREATE TABLE request_events (
+    event_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    request_id INT NOT NULL,
+    from_status VARCHAR(30),
+    to_status VARCHAR(30) NOT NULL,
+    ts DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3)
+);
+
+CREATE INDEX idx_request_events_request ON request_events (request_id, ts);
+CREATE INDEX idx_request_events_status ON request_events (to_status, ts);
+
+CREATE TRIGGER trg_requests_event_insert AFTER INSERT ON service_requests FOR EACH ROW
+    INSERT INTO request_events (request_id, from_status, to_status) VALUES (NEW.request_id, NULL, NEW.status);
+CREATE TRIGGER trg_requests_event_update AFTER UPDATE ON service_requests FOR EACH ROW
+    INSERT INTO request_events (request_id, from_status, to_status)
+    SELECT NEW.request_id, OLD.status, NEW.status FROM DUAL WHERE NOT (OLD.status <=> NEW.status);
+
+-- =====================================================
+-- CHANGE SEQUENCE (cursor of the changes feed)
+-- =====================================================
+-- Every write to a request takes the next value. The counter row stays
+-- locked until the writer commits, so values follow commit order.
+CREATE TABLE sequences (
+    name VARCHAR(50) PRIMARY KEY,
+    value BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO sequences (name, value) VALUES ('request_changes', 0);
+
+DELIMITER //
+CREATE TRIGGER trg_requests_changed_insert BEFORE INSERT ON service_requests FOR EACH ROW
+BEGIN
+    UPDATE sequences SET value = value + 1 WHERE name = 'request_changes';
+    SET NEW.change_seq = (SELECT value FROM sequences WHERE name = 'request_changes');
+END//
+CREATE TRIGGER trg_requests_changed_update BEFORE UPDATE ON service_requests FOR EACH ROW
+BEGIN
+    UPDATE sequences SET value = value + 1 WHERE name = 'request_changes';
+    SET NEW.change_seq = (SELECT value FROM sequences WHERE name = 'request_changes');
+END//
+DELIMITER ;
+
+-- =====================================================
+-- HELPER IMPORTS (admin uploads, handled by a background job)
+-- =====================================================
+CREATE TABLE helper_imports (
+    import_id INT AUTO_INCREMENT PRIMARY KEY,
+    filename VARCHAR(255),
+    path VARCHAR(1024) NOT NULL,
+    format VARCHAR(10) NOT NULL,
+    approve BOOLEAN NOT NULL DEFAULT FALSE,
+    status ENUM('queued','running','done','failed') NOT NULL DEFAULT 'queued',
+    report TEXT,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP NULL
+);
+
+CREATE INDEX idx_helper_imports_status ON helper_imports (status, import_id);
+
 -- =====================================================
 -- DEFAULT DATA
 -- =====================================================
@@ -0,0 +1,322 @@
+"""
+SQLite connection handling for NearFix.
+
+Opening a connection per route means a fresh file open, schema read and pragma
+setup on every request. ConnectionPool keeps one connection per thread (SQLite
+connections are tied to the thread that made them), configures it once, and
+hands it out for the lifetime of a Flask app context.
+
+With a `profiler` (metrics.QueryProfiler) each checkout records the
+statements it ran, and the profiler sees them when it is released, as does
+the list in `query_log`, if any.
+
+ShardConnectionPool opens a region shard (see shards.py) with the home
+database attached, so the shard's requests still join to their users.
+
+MySQLConnectionPool hands out mysqlclient connections the same way, behind
+the same sqlite3-style interface, for repository.Repository.
+
+sync_replica() keeps a read-only copy of the database up to date with the
+backup API, for reads that may lag the primary by a few seconds.
+"""
+import contextvars
+import functools
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: syncs are not coordinated between processes
+    fcntl = None
+
+# applied once per new connection
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 64 * 1024 * 1024),
+    ('cache_size', -16000),  # negative means KiB, so ~16 MB
+    ('busy_timeout', 5000),
+)
+# replica connections only read; the syncing process is the one writer
+REPLICA_PRAGMAS = (
+    ('query_only', 1),
+    ('mmap_size', 64 * 1024 * 1024),
+    ('cache_size', -16000),
+    ('busy_timeout', 5000),
+)
+# prepared statements kept per connection; more than the app has distinct queries
+STATEMENT_CACHE_SIZE = 512
+
+# While this holds a list, released connections add their QueryRecords to it,
+# so statements a request has run on other threads still count toward it
+query_log = contextvars.ContextVar('query_log', default=None)
+
+
+class PooledConnection:
+    """Proxy handed to callers; close() gives the connection back instead of closing it.
+
+    A scoped connection belongs to a Flask app context, so close() is a no-op
+    and the connection is released when the context tears down.
+    """
+
+    def __init__(self, pool, conn, scoped=False):
+        self._pool = pool
+        self._conn = conn
+        self._scoped = scoped
+        # QueryRecords of this checkout, when the pool is profiled
+        self.queries = []
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def execute(self, sql, params=None):
+        profiler = self._pool.profiler
+        if profiler is not None:
+            return profiler.execute(self._conn, self.queries, sql, params)
+        return self._conn.execute(sql) if params is None else self._conn.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        profiler = self._pool.profiler
+        if profiler is not None:
+            return profiler.executemany(self._conn, self.queries, sql, rows)
+        return self._conn.executemany(sql, rows)
+
+    def close(self):
+        if not self._scoped:
+            self.release()
+
+    def release(self):
+        self._pool.release(self)
+
+
+class ConnectionPool:
+    """Per-thread SQLite connections, reused across requests"""
+
+    def __init__(self, database, pragmas=PRAGMAS, profiler=None):
+        self.database = database
+        self.pragmas = pragmas
+        self.profiler = profiler
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._created = 0
+        self._checkouts = 0
+        self._in_use = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas:
+            conn.execute(f'PRAGMA {name} = {value}')
+        with self._lock:
+            self._created += 1
+        return conn
+
+    def acquire(self, scoped=False):
+        # a connection inherited across fork (gunicorn --preload) must not be reused
+        if os.getpid() != self._pid:
+            self._local = threading.local()
+            self._pid = os.getpid()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+        return PooledConnection(self, conn, scoped)
+
+    def release(self, pooled):
+        if pooled._conn is None:
+            return
+        # never hand an open transaction to the next request
+        if pooled._conn.in_transaction:
+            pooled._conn.rollback()
+        if self.profiler is not None and pooled.queries:
+            self.profiler.flush(pooled._conn, pooled.queries)
+            collected = query_log.get()
+            if collected is not None:
+                collected.extend(pooled.queries)
+        pooled._conn = None
+        with self._lock:
+            self._in_use -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'database': self.database,
+                'connections_created': self._created,
+                'checkouts': self._checkouts,
+                'reused': self._checkouts - self._created,
+                'in_use': self._in_use,
+            }
+
+
+class ShardConnectionPool(ConnectionPool):
+    """Connections to a shard database that read `users` from the home database.
+
+    The home file is attached as `home`, and a TEMP view named users shadows
+    the shard's own (empty) users table, since TEMP is searched before MAIN.
+    For request handlers only: BEGIN IMMEDIATE would write-lock home as well,
+    so jobs that take the write lock up front use a plain ConnectionPool.
+    """
+
+    def __init__(self, database, home, pragmas=PRAGMAS, profiler=None):
+        super().__init__(database, pragmas, profiler)
+        self.home = home
+
+    def _connect(self):
+        conn = super()._connect()
+        conn.execute('ATTACH DATABASE ? AS home', (self.home,))
+        conn.execute('CREATE TEMP VIEW users AS SELECT * FROM home.users')
+        return conn
+
+
+def sync_replica(source, replica_path):
+    """Copy the database behind `source` into replica_path.
+
+    The backup runs in one step. Under WAL that is a read snapshot, so it
+    does not block writers; a stepped backup would restart on every write
+    from another connection and might never finish. When neither the
+    database file nor its WAL has changed since the last copy, only the
+    stamp moves forward.
+
+    The copy is stamped with the time.time() at which it was taken, so
+    replica_synced_at() can tell which writes it holds. Returns the stamp, or
+    None when another process is already syncing.
+    """
+    with open(replica_path + '.lock', 'a') as lock:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+        # every commit before this moment is in the snapshot the backup reads
+        taken_at = time.time()
+        state = _file_state(source.execute('PRAGMA database_list').fetchone()[2])
+        replica = sqlite3.connect(replica_path, timeout=30)
+        try:
+            if _copied_state(replica) == state:
+                replica.execute('UPDATE replica_state SET synced_at = ? WHERE id = 1', (taken_at,))
+            else:
+                source.backup(replica)
+                replica.execute('CREATE TABLE replica_state '
+                                '(id INTEGER PRIMARY KEY, synced_at REAL NOT NULL, source_state TEXT)')
+                replica.execute('INSERT INTO replica_state (id, synced_at, source_state) VALUES (1, ?, ?)',
+                                (taken_at, state))
+            replica.commit()
+        finally:
+            replica.close()
+    return taken_at
+
+
+def _file_state(path):
+    """Size and mtime of a database file and its WAL; every commit changes one of them"""
+    state = []
+    for name in (path, path + '-wal'):
+        try:
+            stat = os.stat(name)
+        except FileNotFoundError:
+            state.append('-')
+        else:
+            state.append(f'{stat.st_size}:{stat.st_mtime_ns}')
+    return ' '.join(state)
+
+
+def _copied_state(replica):
+    """The _file_state of the source when the replica was copied, if known"""
+    try:
+        row = replica.execute('SELECT source_state FROM replica_state WHERE id = 1').fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+
+def replica_synced_at(conn):
+    """When the replica behind `conn` was copied, or None before its first sync"""
+    try:
+        row = conn.execute('SELECT synced_at FROM replica_state WHERE id = 1').fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row['synced_at'] if row else None
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def mysql_statement(sql):
+    """A `?`-placeholder statement in mysqlclient's %s format, translated once"""
+    return sql.replace('%', '%%').replace('?', '%s')
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class MySQLConnection:
+    """sqlite3-style face on a mysqlclient connection: execute() straight on
+    the connection, `?` placeholders and in_transaction"""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.in_transaction = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def execute(self, sql, params=()):
+        cursor = self._conn.cursor()
+        # InnoDB opens a transaction on any statement once autocommit is off
+        self.in_transaction = True
+        # always pass a tuple so mysqlclient turns %% back into %
+        cursor.execute(mysql_statement(sql), tuple(params))
+        return cursor
+
+    def executemany(self, sql, rows):
+        cursor = self._conn.cursor()
+        self.in_transaction = True
+        cursor.executemany(mysql_statement(sql), rows)
+        return cursor
+
+    def commit(self):
+        self._conn.commit()
+        self.in_transaction = False
+
+    def rollback(self):
+        self._conn.rollback()
+        self.in_transaction = False
+
+
+class MySQLConnectionPool(ConnectionPool):
+    """Per-thread MySQL connections, handed out like the SQLite ones.
+
+    `params` go to MySQLdb.connect (host, user, password, database, ...).
+    Rows come back as dicts, with timestamps as text and DECIMALs as floats,
+    which is how SQLite returns them.
+    """
+
+    def __init__(self, profiler=None, **params):
+        super().__init__(params.get('database') or params.get('db'), pragmas=(), profiler=profiler)
+        self.params = params
+
+    def _connect(self):
+        # optional dependency: only MySQL deployments need mysqlclient
+        import MySQLdb
+        from MySQLdb.constants import FIELD_TYPE
+        from MySQLdb.converters import conversions
+        from MySQLdb.cursors import DictCursor
+
+        conv = dict(conversions)
+        for field_type in (FIELD_TYPE.DATETIME, FIELD_TYPE.TIMESTAMP, FIELD_TYPE.DATE):
+            conv[field_type] = _text
+        conv[FIELD_TYPE.DECIMAL] = conv[FIELD_TYPE.NEWDECIMAL] = float
+        conn = MySQLdb.connect(cursorclass=DictCursor, conv=conv, charset='utf8mb4', autocommit=False,
+                               **self.params)
+        with self._lock:
+            self._created += 1
+        return MySQLConnection(conn)
@@ -0,0 +1,296 @@
+"""
+Live request updates for the dashboards.
+
+request_events is the change feed: its event_id only ever grows. One
+ChangeFeed thread per process tails it and hands each new event to the
+subscribers watching that request's user or helper, so a thousand open
+dashboards cost one small query a second rather than a thousand.
+
+Subscribers are drained by a Server-Sent Events response. The browser
+reconnects on its own with Last-Event-ID, and missed events are read back
+from the table, so a dropped connection loses nothing.
+
+With region shards every shard has its own request_events, and event ids
+only grow within one file. ShardedChangeFeed runs a ChangeFeed per shard
+and gives subscribers a position of one event id per shard, sent as the
+SSE id in the form "12.0.7".
+"""
+import heapq
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+FEED_BATCH_SIZE = 500
+SUBSCRIBER_QUEUE_SIZE = 100
+
+log = logging.getLogger('nearfix.events')
+
+FEED_QUERY = '''
+    SELECT e.event_id, e.request_id, e.from_status, e.to_status, e.ts, sr.user_id, sr.helper_id
+    FROM request_events e
+    JOIN service_requests sr ON sr.request_id = e.request_id
+    WHERE e.event_id > ?
+    ORDER BY e.event_id
+    LIMIT ?
+'''
+
+# owner column per account kind, for replaying what a reconnecting client missed
+BACKLOG_QUERY = '''
+    SELECT e.event_id, e.request_id, e.from_status, e.to_status, e.ts
+    FROM service_requests sr
+    JOIN request_events e ON e.request_id = sr.request_id
+    WHERE sr.{column} = ? AND e.event_id > ?
+    ORDER BY e.event_id
+    LIMIT ?
+'''
+OWNER_COLUMNS = {'user': 'user_id', 'helper': 'helper_id'}
+
+
+def event_payload(row):
+    return {key: row[key] for key in ('event_id', 'request_id', 'from_status', 'to_status', 'ts')}
+
+
+class Subscription:
+    def __init__(self, feed, key):
+        self.feed = feed
+        self.key = key
+        self.events = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        # set when the queue overflowed; the client reconnects and replays
+        self.lagged = False
+
+    def push(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.lagged = True
+
+    def get(self, timeout):
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.feed.unsubscribe(self)
+
+
+class ChangeFeed:
+    """Fans request_events out to per-account subscribers.
+
+    `connect` returns a database connection; the poller only runs while
+    someone is subscribed. With `shard` set, events carry it for
+    ShardedChangeFeed.
+    """
+
+    # position of a client that has seen nothing
+    origin = 0
+
+    def __init__(self, connect, poll_interval=1.0, shard=None):
+        self.connect = connect
+        self.poll_interval = poll_interval
+        self.shard = shard
+        self.last_event_id = None
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+
+    def _start(self):
+        # called under the lock; a thread inherited across fork is gone
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        thread = threading.Thread(target=self._loop, name='nearfix-change-feed', daemon=True)
+        thread.start()
+
+    def head(self):
+        """Newest event id in the table"""
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT COALESCE(MAX(event_id), 0) FROM request_events').fetchone()[0]
+        finally:
+            conn.close()
+
+    def subscribe(self, kind, account_id, subscription=None):
+        """Start delivering an account's events; `subscription` is one shared with other feeds"""
+        subscription = subscription or Subscription(self, (kind, account_id))
+        with self._lock:
+            # everything after this id reaches the subscriber live; read the
+            # backlog only after subscribing so nothing falls in between
+            if self.last_event_id is None:
+                self.last_event_id = self.head()
+            self._subscribers.setdefault(subscription.key, set()).add(subscription)
+            self._start()
+        self._wakeup.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            watchers = self._subscribers.get(subscription.key)
+            if watchers:
+                watchers.discard(subscription)
+                if not watchers:
+                    del self._subscribers[subscription.key]
+
+    def backlog(self, kind, account_id, after, limit=FEED_BATCH_SIZE):
+        """Events for an account's requests after `after`, oldest first"""
+        conn = self.connect()
+        try:
+            sql = BACKLOG_QUERY.format(column=OWNER_COLUMNS[kind])
+            return [self._payload(row) for row in conn.execute(sql, (account_id, after, limit))]
+        finally:
+            conn.close()
+
+    def _payload(self, row):
+        event = event_payload(row)
+        if self.shard is not None:
+            event['shard'] = self.shard
+        return event
+
+    def parse_position(self, text):
+        """A Last-Event-ID as a position, or None if it is not one"""
+        return int(text) if text and text.isdigit() else None
+
+    def advance(self, position, event):
+        """The position after `event`, or None if `position` already covers it"""
+        return event['event_id'] if event['event_id'] > position else None
+
+    def format_position(self, position):
+        return str(position)
+
+    def poll(self):
+        """Deliver events added since the last poll; returns how many were read"""
+        conn = self.connect()
+        try:
+            rows = conn.execute(FEED_QUERY, (self.last_event_id, FEED_BATCH_SIZE)).fetchall()
+        finally:
+            conn.close()
+        for row in rows:
+            event = self._payload(row)
+            with self._lock:
+                watchers = set(self._subscribers.get(('user', row['user_id']), ()))
+                watchers |= self._subscribers.get(('helper', row['helper_id']), set())
+            for subscription in watchers:
+                subscription.push(event)
+            self.last_event_id = row['event_id']
+        return len(rows)
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                idle = not self._subscribers
+                if idle:
+                    # nobody listening: forget the position until someone is
+                    self.last_event_id = None
+                    self._wakeup.clear()
+            if idle:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                if self.poll() == FEED_BATCH_SIZE:
+                    continue
+            except Exception:
+                log.exception('change feed poll failed')
+            time.sleep(self.poll_interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': sum(len(watchers) for watchers in self._subscribers.values()),
+                'accounts': len(self._subscribers),
+                'last_event_id': self.last_event_id,
+            }
+
+
+class ShardedChangeFeed:
+    """The ChangeFeed interface over one ChangeFeed per shard.
+
+    A position is a tuple of event ids, one per shard. A subscription is
+    registered with every shard's feed, so its queue gets all of them.
+    """
+
+    def __init__(self, feeds):
+        self.feeds = feeds
+        self.origin = (0,) * len(feeds)
+
+    def subscribe(self, kind, account_id):
+        subscription = Subscription(self, (kind, account_id))
+        for feed in self.feeds:
+            feed.subscribe(kind, account_id, subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        for feed in self.feeds:
+            feed.unsubscribe(subscription)
+
+    def backlog(self, kind, account_id, after, limit=FEED_BATCH_SIZE):
+        """Every shard's events after its part of `after`, merged by time"""
+        events = heapq.merge(*(feed.backlog(kind, account_id, position, limit)
+                               for feed, position in zip(self.feeds, after)), key=lambda event: event['ts'])
+        return list(events)[:limit]
+
+    def parse_position(self, text):
+        """"12.0.7" as (12, 0, 7); a shorter id (one from before a shard was
+        added, or a plain event id) leaves the other shards at 0"""
+        parts = text.split('.') if text else []
+        if not parts or len(parts) > len(self.feeds) or not all(part.isdigit() for part in parts):
+            return None
+        return tuple(map(int, parts)) + (0,) * (len(self.feeds) - len(parts))
+
+    def advance(self, position, event):
+        shard = event['shard']
+        if event['event_id'] <= position[shard]:
+            return None
+        return position[:shard] + (event['event_id'],) + position[shard + 1:]
+
+    def format_position(self, position):
+        return '.'.join(map(str, position))
+
+    def stats(self):
+        shards = [feed.stats() for feed in self.feeds]
+        return {
+            'subscribers': shards[0]['subscribers'],
+            'accounts': shards[0]['accounts'],
+            'last_event_id': self.format_position(tuple(stats['last_event_id'] or 0 for stats in shards)),
+            'shards': shards,
+        }
+
+
+def sse_stream(feed, kind, account_id, after=None, keepalive=15, max_seconds=300):
+    """Server-Sent Events body: events after the position `after`, then live events.
+
+    The response ends after `max_seconds` so a long-lived connection does
+    not hold a worker forever; the browser reconnects and resumes from the
+    last id it saw.
+    """
+    subscription = feed.subscribe(kind, account_id)
+    try:
+        backlog = feed.backlog(kind, account_id, after) if after is not None else []
+        yield 'retry: 3000\n\n'
+        position = feed.origin if after is None else after
+        for event in backlog:
+            position = feed.advance(position, event)
+            yield format_event(event, feed.format_position(position))
+        if len(backlog) >= FEED_BATCH_SIZE:
+            # more to replay: the reconnect picks up after the last one sent
+            return
+        deadline = time.monotonic() + max_seconds
+        while time.monotonic() < deadline and not subscription.lagged:
+            event = subscription.get(timeout=keepalive)
+            if event is None:
+                yield ': keepalive\n\n'
+            else:
+                newer = feed.advance(position, event)
+                if newer is not None:
+                    position = newer
+                    yield format_event(event, feed.format_position(position))
+    finally:
+        subscription.close()
+
+
+def format_event(event, position):
+    return f"id: {position}\nevent: request\ndata: {json.dumps(event)}\n\n"
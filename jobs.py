@@ -0,0 +1,67 @@
+"""
+Periodic background jobs for NearFix.
+
+Jobs run on daemon threads inside each app process. They are started lazily
+from the first request so that a gunicorn master using --preload does not
+start threads that would be lost when it forks the workers.
+"""
+import logging
+import os
+import threading
+
+log = logging.getLogger('nearfix.jobs')
+
+
+class JobScheduler:
+    def __init__(self):
+        self.jobs = {}
+        self._wakeups = {}
+        self._lock = threading.Lock()
+        self._started_pid = None
+        self._stop = threading.Event()
+
+    def every(self, seconds, name=None):
+        """Decorator registering func to run every `seconds` seconds"""
+        def register(func):
+            self.jobs[name or func.__name__] = (seconds, func)
+            self._wakeups[name or func.__name__] = threading.Event()
+            return func
+        return register
+
+    def run(self, name):
+        """Run one job immediately in the calling thread"""
+        seconds, func = self.jobs[name]
+        return func()
+
+    def trigger(self, name):
+        """Run a started job now instead of waiting for its next interval"""
+        self._wakeups[name].set()
+
+    def _loop(self, name, seconds, func):
+        wakeup = self._wakeups[name]
+        while True:
+            wakeup.wait(seconds)
+            wakeup.clear()
+            if self._stop.is_set():
+                return
+            try:
+                func()
+            except Exception:
+                log.exception('background job %s failed', name)
+
+    def start(self):
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            self._stop.clear()
+            for name, (seconds, func) in self.jobs.items():
+                thread = threading.Thread(target=self._loop, args=(name, seconds, func),
+                                          name=f'nearfix-{name}', daemon=True)
+                thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for wakeup in self._wakeups.values():
+            wakeup.set()
+        self._started_pid = None
@@ -0,0 +1,118 @@
+"""
+Batch assignment of pending service requests to helpers.
+
+Matching requests one at a time sends every request to the same closest helper
+and strands the rest. Here a whole batch is solved together: each request is
+linked only to its few nearest helpers (a sparse graph from the spatial index)
+and the assignment minimizing total travel distance is found with the
+Hungarian method, using Dijkstra with potentials over those sparse edges.
+"""
+import heapq
+
+
+def min_distance_assignment(candidates):
+    """Solve a sparse assignment problem.
+
+    candidates maps request -> list of (distance, helper), in priority order
+    (oldest request first). Each helper takes at most one request. Requests
+    are added one at a time and a request that has been matched is never
+    dropped for a later one, so older requests keep their priority; within
+    that, the returned {request: helper} has the least total distance.
+
+    This is the Hungarian method: for each request, Dijkstra over reduced
+    costs finds the shortest augmenting path, which may move earlier requests
+    to other helpers, and the potentials are updated so the matching stays
+    optimal.
+    """
+    owner = {}        # helper -> request holding it
+    assigned = {}     # request -> helper
+    # potentials; the reduced cost of request -> helper is cost - u[request] - v[helper] >= 0
+    u = dict.fromkeys(candidates, 0.0)
+    v = {}
+    # helpers a failed search reached can never lead to a free helper again
+    frozen = set()
+    inf = float('inf')
+
+    for source in candidates:
+        if not candidates[source]:
+            continue
+        dist = {}          # tentative helper distances
+        prev = {}          # helper -> request it was reached from
+        row_dist = {source: 0.0}
+        done = []          # helpers whose distance is final, in order
+        finalized = set()
+        heap = []
+        row = source
+        target = None
+        while row is not None:
+            base = row_dist[row] - u[row]
+            for cost, helper in candidates[row]:
+                if helper in finalized or helper in frozen:
+                    continue
+                d = base + cost - v.get(helper, 0.0)
+                if d < dist.get(helper, inf):
+                    dist[helper] = d
+                    prev[helper] = row
+                    heapq.heappush(heap, (d, helper))
+            row = None
+            while heap:
+                d, helper = heapq.heappop(heap)
+                if helper in finalized:
+                    continue
+                finalized.add(helper)
+                done.append(helper)
+                if helper not in owner:
+                    target = helper
+                    break
+                # continue through the request currently holding this helper
+                row = owner[helper]
+                row_dist[row] = d
+                break
+
+        if target is None:
+            # no augmenting path, this request stays unassigned
+            frozen.update(done)
+            continue
+
+        # keep reduced costs non-negative and tight along the matching
+        shortest = dist[target]
+        for row, d in row_dist.items():
+            u[row] += shortest - d
+        for helper in done:
+            if dist[helper] < shortest:
+                v[helper] = v.get(helper, 0.0) - (shortest - dist[helper])
+
+        helper = target
+        while True:
+            row = prev[helper]
+            previous = assigned.get(row)
+            assigned[row] = helper
+            owner[helper] = row
+            if row == source:
+                break
+            helper = previous
+
+    return assigned
+
+
+def greedy_assignment(candidates, exclusive=False):
+    """Baseline: each request in turn takes its nearest helper.
+
+    With exclusive=False a helper can be handed several requests, which is what
+    per-request dispatch does.
+    """
+    taken = set()
+    assigned = {}
+    for request, options in candidates.items():
+        for cost, helper in sorted(options):
+            if exclusive and helper in taken:
+                continue
+            assigned[request] = helper
+            taken.add(helper)
+            break
+    return assigned
+
+
+def total_distance(candidates, assigned):
+    costs = {(request, helper): cost for request, options in candidates.items() for cost, helper in options}
+    return sum(costs[request, helper] for request, helper in assigned.items())
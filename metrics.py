@@ -0,0 +1,293 @@
+"""
+Request and query metrics for NearFix, in Prometheus text format.
+
+Everything is kept in memory per process; with several gunicorn workers
+each scrape sees the worker that answered it, which is enough to spot a
+slow route or statement (run one worker, or scrape each, for exact totals).
+
+QueryProfiler hooks into db.ConnectionPool: every statement run through a
+pooled connection is timed, including the time spent fetching its rows,
+and reported when the connection goes back to the pool.
+"""
+import collections
+import functools
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
+
+ROUTE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+# a statement run this often on one connection checkout looks like an N+1 loop
+REPEATED_QUERY_WARN = 10
+
+log = logging.getLogger('nearfix.sql')
+
+_PLACEHOLDER_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(\w+)', re.IGNORECASE)
+
+
+def normalize_statement(sql):
+    """SQL with whitespace collapsed and `IN (?, ?, ...)` lists folded, so
+    one statement is one string however many ids it was given"""
+    return _PLACEHOLDER_LIST.sub('IN (?, ...)', _WHITESPACE.sub(' ', sql).strip())
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_label(sql):
+    """Short stable name for a statement, e.g. 'select:service_requests:1f3a9c2e':
+    its verb, first table and a hash of normalize_statement(sql)"""
+    normalized = normalize_statement(sql)
+    table = _TABLE.search(normalized)
+    digest = hashlib.sha1(normalized.encode()).hexdigest()[:8]
+    return f"{normalized.split(' ', 1)[0].lower()}:{table.group(1) if table else ''}:{digest}"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=ROUTE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0, 0.0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += 1
+            series[2] += value
+
+    def samples(self):
+        with self._lock:
+            series = {key: (list(counts), count, total) for key, (counts, count, total) in self._series.items()}
+        for key, (counts, count, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield '_bucket', key, (('le', _number(bound)),), cumulative
+            yield '_bucket', key, (('le', '+Inf'),), count
+            yield '_count', key, (), count
+            yield '_sum', key, (), total
+
+
+class Counter:
+    """Monotonic total per label set"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._totals = collections.Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._totals[label_values] += amount
+
+    def samples(self):
+        with self._lock:
+            totals = sorted(self._totals.items())
+        for key, total in totals:
+            yield '', key, (), total
+
+
+class Gauge:
+    """Value read from `func` at scrape time; func returns a number or a
+    {label values tuple: number} dict. kind='counter' exposes a total some
+    other object already keeps."""
+
+    def __init__(self, name, help, func, labels=(), kind='gauge'):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.func = func
+
+    def samples(self):
+        value = self.func()
+        values = value if isinstance(value, dict) else {(): value}
+        for key, number in sorted(values.items()):
+            yield '', key, (), number
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=ROUTE_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, func, labels=(), kind='gauge'):
+        return self.add(Gauge(name, help, func, labels, kind))
+
+    def render(self):
+        """The Prometheus text exposition of every metric"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for suffix, key, extra, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{_labels(metric.labels, key, extra)} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class QueryRecord:
+    __slots__ = ('sql', 'params', 'elapsed', 'rows')
+
+    def __init__(self, sql, params, elapsed, rows):
+        self.sql = sql
+        self.params = params
+        self.elapsed = elapsed
+        self.rows = rows
+
+
+class ProfiledCursor:
+    """Cursor proxy adding fetch time and fetched rows to its QueryRecord"""
+
+    def __init__(self, cursor, record):
+        self._cursor = cursor
+        self._record = record
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = next(self._cursor)
+        finally:
+            self._record.elapsed += time.perf_counter() - start
+        self._record.rows += 1
+        return row
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._record.elapsed += time.perf_counter() - start
+        if row is not None:
+            self._record.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(*args)
+        self._record.elapsed += time.perf_counter() - start
+        self._record.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._record.elapsed += time.perf_counter() - start
+        self._record.rows += len(rows)
+        return rows
+
+
+class QueryProfiler:
+    """Per-statement latency and row counts, plus an opt-in slow-query log.
+
+    Statements taking at least `slow_ms` are logged to the nearfix.sql
+    logger (without their parameters, which may hold personal data), and
+    `explain_rate` of those also log their EXPLAIN QUERY PLAN. A statement
+    repeated REPEATED_QUERY_WARN times on one checkout is logged as a
+    likely N+1 loop. slow_ms=None turns the log off; metrics are always kept.
+    Metrics label statements with statement_label(); `statements` maps each
+    label seen to its SQL.
+    """
+
+    def __init__(self, registry, slow_ms=None, explain_rate=0.1):
+        self.slow_ms = slow_ms
+        self.explain_rate = explain_rate
+        self.statements = {}
+        self.durations = registry.histogram(
+            'nearfix_db_query_duration_seconds', 'Time to run a statement and fetch its rows',
+            ('statement',), QUERY_BUCKETS)
+        self.rows = registry.counter(
+            'nearfix_db_query_rows_total', 'Rows fetched or changed by a statement', ('statement',))
+        self.slow = registry.counter(
+            'nearfix_db_slow_queries_total', 'Statements slower than the slow-query threshold', ('statement',))
+
+    def execute(self, conn, queries, sql, params):
+        """Run a statement on the raw connection, recording it in `queries`"""
+        start = time.perf_counter()
+        cursor = conn.execute(sql, params) if params is not None else conn.execute(sql)
+        record = QueryRecord(sql, params, time.perf_counter() - start, max(cursor.rowcount, 0))
+        queries.append(record)
+        return ProfiledCursor(cursor, record)
+
+    def executemany(self, conn, queries, sql, rows):
+        start = time.perf_counter()
+        cursor = conn.executemany(sql, rows)
+        queries.append(QueryRecord(sql, None, time.perf_counter() - start, max(cursor.rowcount, 0)))
+        return cursor
+
+    def flush(self, conn, queries):
+        """Report one checkout's statements; `conn` is still usable for EXPLAIN"""
+        for record in queries:
+            label = statement_label(record.sql)
+            if label not in self.statements:
+                self.statements[label] = normalize_statement(record.sql)
+            self.durations.observe(record.elapsed, label)
+            if record.rows:
+                self.rows.inc(record.rows, label)
+            if self.slow_ms is not None and record.elapsed * 1000 >= self.slow_ms:
+                self.slow.inc(1, label)
+                self._log_slow(conn, record, label)
+        if self.slow_ms is not None and len(queries) >= REPEATED_QUERY_WARN:
+            for label, count in collections.Counter(statement_label(record.sql) for record in queries).items():
+                if count >= REPEATED_QUERY_WARN:
+                    log.warning('statement ran %d times on one connection (N+1?): %s %s', count, label,
+                                self.statements[label])
+
+    def _log_slow(self, conn, record, label):
+        message = f'slow query {record.elapsed * 1000:.1f} ms, {record.rows} rows: {label} {self.statements[label]}'
+        if record.params is not None and random.random() < self.explain_rate:
+            try:
+                plan = conn.execute('EXPLAIN QUERY PLAN ' + record.sql, record.params).fetchall()
+                message += ''.join(f'\n    {row[3]}' for row in plan)
+            except Exception as e:
+                message += f'\n    (no plan: {e})'
+        log.warning(message)
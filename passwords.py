@@ -0,0 +1,138 @@
+"""
+Password hashing off the request thread.
+
+Hashing is deliberately slow, so a burst of logins run inline ties up every
+web worker for the whole burst. Hashes and checks go to a small process pool
+instead. When max_pending operations are already waiting, callers get
+HasherBusy at once and the app answers 503 instead of queueing without limit.
+
+Both bounds hold per process. With several web worker processes on one host,
+pass their number as `processes` and the default pool gives each a share of
+the CPUs.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+LATENCY_SAMPLES = 1000
+
+
+class HasherBusy(Exception):
+    """Too many password hashes are already queued"""
+
+
+class PasswordHasher:
+    """Bounded process pool for werkzeug password hashing.
+
+    `method` is a werkzeug method string such as 'scrypt:32768:8:1' or
+    'pbkdf2:sha256:600000'. Hashes made with any other method still verify,
+    and needs_rehash() reports them so they can be upgraded at login.
+    `workers` defaults to this process's share of the CPUs among `processes`.
+    """
+
+    def __init__(self, method=DEFAULT_METHOD, workers=None, max_pending=None, processes=1):
+        self.method = method
+        self.workers = workers or max(1, (os.cpu_count() or 1) // processes)
+        self.max_pending = max_pending or self.workers * 4
+        self._pool = None
+        self._pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._latency = {'hash': deque(maxlen=LATENCY_SAMPLES), 'verify': deque(maxlen=LATENCY_SAMPLES)}
+        self._counts = {'hash': 0, 'verify': 0}
+        self.rejected = 0
+
+    def _executor(self):
+        # a pool inherited across fork is unusable; each worker process makes its own
+        if self._pid != os.getpid():
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            self._pid = os.getpid()
+        return self._pool
+
+    def _run(self, kind, func, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise HasherBusy(f'{self._pending} password hashes already queued')
+            self._pending += 1
+            pool = self._executor()
+        start = time.perf_counter()
+        try:
+            return pool.submit(func, *args).result()
+        except BrokenProcessPool:
+            # a pool process died; start a fresh pool on the next call
+            with self._lock:
+                if self._pool is pool:
+                    self._pid = None
+            raise HasherBusy('password hashing pool restarted')
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._pending -= 1
+                self._latency[kind].append(elapsed)
+                self._counts[kind] += 1
+
+    def shutdown(self):
+        """Stop this process's pool; the next call starts a new one.
+
+        Call it before a multiprocessing child exits, which otherwise waits on
+        the pool processes forever.
+        """
+        with self._lock:
+            pool = self._pool if self._pid == os.getpid() else None
+            self._pool = self._pid = None
+        if pool is not None:
+            pool.shutdown()
+
+    def hash(self, password):
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, stored, password):
+        return self._run('verify', check_password_hash, stored, password)
+
+    def needs_rehash(self, stored):
+        """True if `stored` was made with a different method or cost"""
+        return stored.split('$', 1)[0] != self.method
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'method': self.method,
+                'workers': self.workers,
+                'pending': self._pending,
+                'max_pending': self.max_pending,
+                'rejected': self.rejected,
+            }
+            for kind, samples in self._latency.items():
+                ordered = sorted(samples)
+                stats[kind] = {
+                    'count': self._counts[kind],
+                    'p50_ms': round(ordered[len(ordered) // 2] * 1000, 1) if ordered else None,
+                    'p95_ms': round(ordered[int(len(ordered) * 0.95)] * 1000, 1) if ordered else None,
+                    'max_ms': round(ordered[-1] * 1000, 1) if ordered else None,
+                }
+        return stats
+
+
+def tune_scrypt(target_ms, max_log_n=17):
+    """The scrypt method string whose hash time is closest to `target_ms` on this machine.
+
+    Returns (method, measured milliseconds).
+    """
+    best = None
+    for log_n in range(12, max_log_n + 1):
+        method = f'scrypt:{2 ** log_n}:8:1'
+        start = time.perf_counter()
+        generate_password_hash('calibration', method)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if best is None or abs(elapsed_ms - target_ms) < abs(best[1] - target_ms):
+            best = (method, elapsed_ms)
+        if elapsed_ms >= target_ms:
+            break
+    return best
@@ -0,0 +1,506 @@
+"""
+Data access for NearFix's request handlers.
+
+Every query the routes run is written here once, in portable SQL with `?`
+placeholders, and Repository wraps each in a method. `connect` returns a
+pooled connection: db.ConnectionPool for SQLite, or db.MySQLConnectionPool,
+which rewrites placeholders for mysqlclient and returns rows and timestamps
+in the same shape, so the same methods run on both; tests/test_repository.py
+runs them against each. On MySQL the schema is database.sql, which holds
+only the tables used here.
+
+Rows are only ever read by column name, since MySQL rows are dicts.
+
+Reads that may lag a few seconds (dashboards and admin listings) go through
+`connect_read`, which can point at a replica. Every committed write calls
+`on_write`, so the app can send the writer's next reads to the primary until
+the replica has caught up.
+
+Schema upkeep (migrations, triggers) and the background jobs that lean on
+SQLite-only features stay in app.py.
+"""
+
+IDENTITY_QUERIES = {
+    'user': 'SELECT user_id, username, email, full_name, phone, address FROM users WHERE user_id = ?',
+    'helper': '''
+        SELECT h.helper_id, h.username, h.email, h.full_name, h.phone, h.service_type_id,
+               h.is_available, h.is_approved, s.service_name
+        FROM helpers h LEFT JOIN services s ON h.service_type_id = s.service_id
+        WHERE h.helper_id = ?
+    ''',
+    'admin': 'SELECT admin_id, username, email, full_name FROM admins WHERE admin_id = ?',
+}
+
+# account kind -> (table, id column)
+ACCOUNT_TABLES = {
+    'user': ('users', 'user_id'),
+    'helper': ('helpers', 'helper_id'),
+    'admin': ('admins', 'admin_id'),
+}
+
+# the services catalog, also loaded by app.services_cache on the caller's connection
+SERVICES_QUERY = 'SELECT * FROM services'
+
+HELPER_DISPATCH_QUERY = '''
+    SELECT h.helper_id, h.service_type_id, h.latitude, h.longitude, h.is_available, h.is_approved,
+           h.active_jobs < COALESCE(s.max_concurrent_jobs, 1) AS has_capacity
+    FROM helpers h LEFT JOIN services s ON h.service_type_id = s.service_id
+    WHERE h.helper_id = ?
+'''
+
+# Hot queries; app.check_query_plans() makes sure each one stays on an index
+USER_REQUESTS_QUERY = '''
+    SELECT sr.*, s.service_name, h.full_name as helper_name
+    FROM service_requests sr
+    LEFT JOIN services s ON sr.service_type_id = s.service_id
+    LEFT JOIN helpers h ON sr.helper_id = h.helper_id
+    WHERE sr.user_id = ? AND (sr.created_at, sr.request_id) < (?, ?)
+    ORDER BY sr.created_at DESC, sr.request_id DESC
+    LIMIT ?
+'''
+
+HELPER_REQUESTS_QUERY = '''
+    SELECT sr.*, u.full_name as user_name, u.phone as user_phone, s.service_name
+    FROM service_requests sr
+    JOIN users u ON sr.user_id = u.user_id
+    JOIN services s ON sr.service_type_id = s.service_id
+    WHERE sr.helper_id = ? AND (sr.created_at, sr.request_id) < (?, ?)
+    ORDER BY sr.created_at DESC, sr.request_id DESC
+    LIMIT ?
+'''
+DASHBOARD_REQUESTS_QUERIES = {'user': USER_REQUESTS_QUERY, 'helper': HELPER_REQUESTS_QUERY}
+
+PENDING_HELPERS_QUERY = '''
+    SELECT h.*, s.service_name
+    FROM helpers h
+    LEFT JOIN services s ON h.service_type_id = s.service_id
+    WHERE h.is_approved = 0
+'''
+
+# admin helper uploads, newest first, as the run_helper_imports job left them
+RECENT_IMPORTS_QUERY = '''
+    SELECT import_id, filename, status, report, error, created_at, finished_at
+    FROM helper_imports ORDER BY import_id DESC LIMIT 5
+'''
+
+RECENT_REQUESTS_LIMIT = 10
+RECENT_REQUESTS_QUERY = f'''
+    SELECT sr.*, u.full_name as user_name, h.full_name as helper_name, s.service_name
+    FROM service_requests sr
+    LEFT JOIN users u ON sr.user_id = u.user_id
+    LEFT JOIN helpers h ON sr.helper_id = h.helper_id
+    LEFT JOIN services s ON sr.service_type_id = s.service_id
+    ORDER BY sr.created_at DESC
+    LIMIT {RECENT_REQUESTS_LIMIT}
+'''
+
+# one card of each dashboard, for live updates
+REQUEST_CARD_QUERIES = {
+    'user': '''
+        SELECT sr.*, s.service_name, h.full_name as helper_name
+        FROM service_requests sr
+        LEFT JOIN services s ON sr.service_type_id = s.service_id
+        LEFT JOIN helpers h ON sr.helper_id = h.helper_id
+        WHERE sr.request_id = ? AND sr.user_id = ?
+    ''',
+    'helper': '''
+        SELECT sr.*, u.full_name as user_name, u.phone as user_phone, s.service_name
+        FROM service_requests sr
+        JOIN users u ON sr.user_id = u.user_id
+        JOIN services s ON sr.service_type_id = s.service_id
+        WHERE sr.request_id = ? AND sr.helper_id = ?
+    ''',
+}
+
+REQUEST_STATUS_QUERY = '''
+    SELECT sr.request_id, sr.user_id, sr.helper_id, sr.status, sr.updated_at,
+           h.full_name as helper_name, s.service_name
+    FROM service_requests sr
+    LEFT JOIN helpers h ON sr.helper_id = h.helper_id
+    LEFT JOIN services s ON sr.service_type_id = s.service_id
+    WHERE sr.request_id = ?
+'''
+
+REQUEST_EVENTS_QUERY = '''
+    SELECT from_status, to_status, ts FROM request_events
+    WHERE request_id = ?
+    ORDER BY ts, event_id
+'''
+
+ADMIN_USERS_QUERY = '''
+    SELECT * FROM users
+    WHERE (created_at, user_id) < (?, ?)
+    ORDER BY created_at DESC, user_id DESC
+    LIMIT ?
+'''
+
+ADMIN_HELPERS_QUERY = '''
+    SELECT h.*, s.service_name
+    FROM helpers h
+    LEFT JOIN services s ON h.service_type_id = s.service_id
+    WHERE (h.created_at, h.helper_id) < (?, ?)
+    ORDER BY h.created_at DESC, h.helper_id DESC
+    LIMIT ?
+'''
+
+# JSON API: only the columns the clients use, per account kind
+API_REQUEST_SELECT = {
+    'user': '''
+        SELECT sr.request_id, sr.status, sr.title, sr.description, sr.service_type_id, s.service_name,
+               sr.user_address, sr.user_latitude, sr.user_longitude, sr.created_at, sr.updated_at,
+               sr.helper_id, h.full_name AS helper_name, h.phone AS helper_phone
+        FROM service_requests sr
+        JOIN services s ON sr.service_type_id = s.service_id
+        LEFT JOIN helpers h ON sr.helper_id = h.helper_id
+    ''',
+    'helper': '''
+        SELECT sr.request_id, sr.status, sr.title, sr.description, sr.service_type_id, s.service_name,
+               sr.user_address, sr.user_latitude, sr.user_longitude, sr.created_at, sr.updated_at,
+               sr.user_id, u.full_name AS user_name, u.phone AS user_phone
+        FROM service_requests sr
+        JOIN services s ON sr.service_type_id = s.service_id
+        JOIN users u ON sr.user_id = u.user_id
+    ''',
+}
+API_REQUESTS_QUERIES = {
+    kind: select + f'''
+        WHERE sr.{kind}_id = ? AND (sr.created_at, sr.request_id) < (?, ?)
+        ORDER BY sr.created_at DESC, sr.request_id DESC
+        LIMIT ?
+    ''' for kind, select in API_REQUEST_SELECT.items()
+}
+API_REQUEST_QUERIES = {
+    kind: select + f' WHERE sr.request_id = ? AND sr.{kind}_id = ?' for kind, select in API_REQUEST_SELECT.items()
+}
+# requests changed after a change_seq cursor, oldest change first
+CHANGES_SELECT = {
+    **API_REQUEST_SELECT,
+    'admin': '''
+        SELECT sr.request_id, sr.status, sr.title, sr.description, sr.service_type_id, s.service_name,
+               sr.user_address, sr.user_latitude, sr.user_longitude, sr.created_at, sr.updated_at,
+               sr.user_id, sr.helper_id
+        FROM service_requests sr
+        JOIN services s ON sr.service_type_id = s.service_id
+    ''',
+}
+CHANGES_QUERIES = {
+    kind: select.replace('SELECT ', 'SELECT sr.change_seq, ', 1) + f'''
+        WHERE {'' if kind == 'admin' else f'sr.{kind}_id = ? AND '}sr.change_seq > ?
+        ORDER BY sr.change_seq
+        LIMIT ?
+    ''' for kind, select in CHANGES_SELECT.items()
+}
+# where a cursor from before change_seq, an (updated_at, request_id) pair,
+# resumes: just before the oldest change after it, so nothing is skipped
+LEGACY_CHANGE_POSITION_QUERY = '''
+    SELECT COALESCE(MIN(change_seq) - 1, (SELECT MAX(change_seq) FROM service_requests), 0) AS change_seq
+    FROM service_requests
+    WHERE (updated_at, request_id) > (?, ?)
+'''
+
+# validator for an account's request list: changes whenever any of its rows does
+API_REQUESTS_VERSION_QUERIES = {
+    kind: f'SELECT COUNT(*) AS count, MAX(updated_at) AS updated_at FROM service_requests WHERE {kind}_id = ?'
+    for kind in API_REQUEST_SELECT
+}
+
+
+class DuplicateAccount(Exception):
+    """The username or email is already taken"""
+
+
+class Repository:
+    """Every query the request handlers run, on connections from `connect`.
+
+    Reads return rows (or lists of rows); writes commit before returning.
+    Methods documented as replica reads use `connect_read` (default: connect).
+    """
+
+    def __init__(self, connect, connect_read=None, on_write=None):
+        self.connect = connect
+        self.connect_read = connect_read or connect
+        self.on_write = on_write
+
+    def _all(self, sql, params=(), replica=False):
+        conn = (self.connect_read if replica else self.connect)()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def _one(self, sql, params=(), replica=False):
+        conn = (self.connect_read if replica else self.connect)()
+        try:
+            return conn.execute(sql, params).fetchone()
+        finally:
+            conn.close()
+
+    def _commit(self, conn):
+        conn.commit()
+        if self.on_write is not None:
+            self.on_write()
+
+    def _write(self, sql, params=()):
+        """Run one statement and commit; returns its cursor"""
+        conn = self.connect()
+        try:
+            cur = conn.execute(sql, params)
+            self._commit(conn)
+            return cur
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    # accounts
+
+    def identity(self, kind, account_id):
+        """Profile row of a logged-in account, or None if it no longer exists"""
+        return self._one(IDENTITY_QUERIES[kind], (account_id,))
+
+    def account_by_username(self, kind, username):
+        """The full row, password hash included, for checking a login"""
+        table, _ = ACCOUNT_TABLES[kind]
+        return self._one(f'SELECT * FROM {table} WHERE username = ?', (username,))
+
+    def replace_password_hash(self, kind, account_id, old_hash, new_hash):
+        """Swap in an upgraded hash unless the password changed meanwhile"""
+        table, id_column = ACCOUNT_TABLES[kind]
+        self._write(f'UPDATE {table} SET password = ? WHERE {id_column} = ? AND password = ?',
+                    (new_hash, account_id, old_hash))
+
+    def _insert_account(self, sql, params):
+        conn = self.connect()
+        try:
+            cur = conn.execute(sql, params)
+            self._commit(conn)
+            return cur.lastrowid
+        except conn.IntegrityError:
+            conn.rollback()
+            raise DuplicateAccount() from None
+        finally:
+            conn.close()
+
+    def create_user(self, username, email, password_hash, full_name, phone, address):
+        return self._insert_account(
+            'INSERT INTO users (username, email, password, full_name, phone, address) VALUES (?, ?, ?, ?, ?, ?)',
+            (username, email, password_hash, full_name, phone, address))
+
+    def create_helper(self, username, email, password_hash, full_name, phone, service_type_id, latitude, longitude):
+        return self._insert_account('''
+            INSERT INTO helpers
+            (username, email, password, full_name, phone, service_type_id, latitude, longitude)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (username, email, password_hash, full_name, phone, service_type_id, latitude, longitude))
+
+    def helper_taken(self, username, email):
+        """Whether a helper already has this username or email"""
+        return self._one('SELECT 1 FROM helpers WHERE username = ? OR email = ?', (username, email)) is not None
+
+    def delete_helper(self, helper_id):
+        self._write('DELETE FROM helpers WHERE helper_id = ?', (helper_id,))
+
+    # helpers
+
+    def helper_dispatch_row(self, helper_id):
+        """What the dispatch index needs to know about a helper"""
+        return self._one(HELPER_DISPATCH_QUERY, (helper_id,))
+
+    def helper_availability(self, helper_id):
+        return self._one('SELECT is_available, active_jobs FROM helpers WHERE helper_id = ?', (helper_id,))
+
+    def set_helper_availability(self, helper_id, is_available):
+        self._write('UPDATE helpers SET is_available = ? WHERE helper_id = ?', (is_available, helper_id))
+
+    def approve_helper(self, helper_id):
+        self._write('UPDATE helpers SET is_approved = 1 WHERE helper_id = ?', (helper_id,))
+
+    def approve_helpers(self, service_type_id=None, created_from=None, created_before=None, with_location=False):
+        """Approve every pending helper matching the filters; returns how many"""
+        where, params = ['is_approved = 0'], []
+        if service_type_id is not None:
+            where.append('service_type_id = ?')
+            params.append(service_type_id)
+        if created_from is not None:
+            where.append('created_at >= ?')
+            params.append(created_from)
+        if created_before is not None:
+            where.append('created_at < ?')
+            params.append(created_before)
+        if with_location:
+            where.append("latitude IS NOT NULL AND latitude <> '' AND longitude IS NOT NULL AND longitude <> ''")
+        return self._write(f"UPDATE helpers SET is_approved = 1 WHERE {' AND '.join(where)}", params).rowcount
+
+    def pending_helpers(self):
+        """Replica read"""
+        return self._all(PENDING_HELPERS_QUERY, replica=True)
+
+    # helper imports
+
+    def create_import(self, filename, path, fmt, approve):
+        """Queue a stored upload for the run_helper_imports job; returns its id"""
+        return self._write('INSERT INTO helper_imports (filename, path, format, approve) VALUES (?, ?, ?, ?)',
+                           (filename, path, fmt, int(bool(approve)))).lastrowid
+
+    def recent_imports(self):
+        """Read from the primary, since the job updates the rows as it goes"""
+        return self._all(RECENT_IMPORTS_QUERY)
+
+    # services
+
+    def services(self):
+        return self._all(SERVICES_QUERY)
+
+    def add_service(self, service_name, description, max_concurrent_jobs):
+        self._write('INSERT INTO services (service_name, description, max_concurrent_jobs) VALUES (?, ?, ?)',
+                    (service_name, description, max_concurrent_jobs))
+
+    def set_service_capacity(self, service_id, max_concurrent_jobs):
+        self._write('UPDATE services SET max_concurrent_jobs = ? WHERE service_id = ?',
+                    (max_concurrent_jobs, service_id))
+
+    def replace_services(self, services):
+        """Overwrite the catalog with `services` rows, ids included (a shard's copy)"""
+        conn = self.connect()
+        try:
+            conn.execute('DELETE FROM services')
+            conn.executemany('''
+                INSERT INTO services (service_id, service_name, description, max_concurrent_jobs, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(row['service_id'], row['service_name'], row['description'], row['max_concurrent_jobs'],
+                   row['created_at']) for row in services])
+            self._commit(conn)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    # service requests
+
+    def create_request(self, user_id, service_type_id, title, description, latitude, longitude, address):
+        """Insert a pending request and return its id; triggers queue it for dispatch"""
+        return self._write('''
+            INSERT INTO service_requests
+            (user_id, service_type_id, title, description, user_latitude, user_longitude, user_address, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 'pending')
+        ''', (user_id, service_type_id, title, description, latitude, longitude, address)).lastrowid
+
+    def dashboard_requests(self, kind, owner_id, cursor, limit):
+        """A user's or helper's requests before a (created_at, request_id) cursor, newest first.
+
+        Replica read.
+        """
+        return self._all(DASHBOARD_REQUESTS_QUERIES[kind], (owner_id, *cursor, limit), replica=True)
+
+    def last_event_id(self):
+        """Newest request_events id on the replica, where live updates for
+        rows read from it must resume"""
+        return self._one('SELECT COALESCE(MAX(event_id), 0) AS event_id FROM request_events',
+                         replica=True)['event_id']
+
+    def api_requests(self, kind, owner_id, cursor, limit):
+        return self._all(API_REQUESTS_QUERIES[kind], (owner_id, *cursor, limit))
+
+    def requests_version(self, kind, owner_id):
+        """(count, newest updated_at) of an account's requests"""
+        row = self._one(API_REQUESTS_VERSION_QUERIES[kind], (owner_id,))
+        return row['count'], row['updated_at']
+
+    def request_card(self, kind, request_id, owner_id):
+        return self._one(REQUEST_CARD_QUERIES[kind], (request_id, owner_id))
+
+    def api_request(self, kind, request_id, owner_id):
+        return self._one(API_REQUEST_QUERIES[kind], (request_id, owner_id))
+
+    def request_status(self, request_id):
+        return self._one(REQUEST_STATUS_QUERY, (request_id,))
+
+    def request_state(self, kind, request_id, owner_id):
+        """helper_id, status and updated_at of a request owned by this account, or None"""
+        return self._one(f'SELECT helper_id, status, updated_at FROM service_requests '
+                         f'WHERE request_id = ? AND {kind}_id = ?', (request_id, owner_id))
+
+    def request_history(self, request_id):
+        return self._all(REQUEST_EVENTS_QUERY, (request_id,))
+
+    def move_request(self, request_id, from_status, to_status, release_helper_id=None):
+        """Change a request's status if it is still `from_status`.
+
+        Giving release_helper_id also hands back one of that helper's job
+        slots, in the same transaction. Returns whether the request moved.
+        """
+        conn = self.connect()
+        try:
+            cur = conn.execute('UPDATE service_requests SET status = ? WHERE request_id = ? AND status = ?',
+                               (to_status, request_id, from_status))
+            if cur.rowcount != 1:
+                conn.rollback()
+                return False
+            if release_helper_id is not None:
+                conn.execute('UPDATE helpers SET active_jobs = active_jobs - 1 WHERE helper_id = ? AND active_jobs > 0',
+                             (release_helper_id,))
+            self._commit(conn)
+            return True
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def changed_requests(self, kind, owner_id, cursor, limit):
+        """Requests changed after `cursor`, oldest change first.
+
+        The cursor holds one change_seq position per shard (see shards.py); a
+        single database is one shard. kind 'admin' sees every request and
+        ignores owner_id.
+        """
+        owner = () if kind == 'admin' else (owner_id,)
+        position = cursor[0]
+        if isinstance(position, tuple):
+            position = self._one(LEGACY_CHANGE_POSITION_QUERY, position)['change_seq']
+        return self._all(CHANGES_QUERIES[kind], (*owner, position, limit))
+
+    # admin pages, all replica reads
+
+    def stats_counters(self):
+        return {row['name']: row['value']
+                for row in self._all('SELECT name, value FROM stats_counters', replica=True)}
+
+    def recent_requests(self):
+        return self._all(RECENT_REQUESTS_QUERY, replica=True)
+
+    def users_page(self, cursor, limit):
+        return self._all(ADMIN_USERS_QUERY, (*cursor, limit), replica=True)
+
+    def helpers_page(self, cursor, limit):
+        return self._all(ADMIN_HELPERS_QUERY, (*cursor, limit), replica=True)
+
+    def export_batches(self, table, columns, id_column, status=None, created_from=None, created_before=None,
+                       batch_size=1000):
+        """Yield lists of rows of `table`, oldest first, `batch_size` at a time"""
+        where, params = [], []
+        if status is not None:
+            where.append('status = ?')
+            params.append(status)
+        if created_from is not None:
+            where.append('created_at >= ?')
+            params.append(created_from)
+        if created_before is not None:
+            where.append('created_at < ?')
+            params.append(created_before)
+        sql = f"SELECT {', '.join(columns)} FROM {table}"
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += f' ORDER BY created_at, {id_column}'
+        conn = self.connect()
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            conn.close()
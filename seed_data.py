@@ -0,0 +1,198 @@
+"""
+Synthetic NearFix data for benchmarks.
+
+    python seed_data.py --dir /tmp/nearfix-bench --users 1000000 --helpers 50000 --requests 2000000
+
+Builds (or extends) <dir>/nearfix.db with the app's own schema, then bulk
+loads users, helpers and service requests. People are spread over several
+Indian cities in proportion to their size, clustered around a few hotspots
+per city with a thinner suburban spread, and requests are spread over the
+last --days days with a realistic status mix. Helpers never hold more active
+jobs than their service allows, and the app's counters are reconciled at
+the end, so the result looks like a live database.
+
+Every account's password is --password, hashed once with the app's method
+so logins cost what they do in production.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+
+# name, weight, centre, spread of the suburbs in degrees
+CITIES = [
+    ('Delhi', 0.24, (28.61, 77.21), 0.12),
+    ('Mumbai', 0.22, (19.08, 72.88), 0.08),
+    ('Bengaluru', 0.16, (12.97, 77.59), 0.09),
+    ('Hyderabad', 0.12, (17.39, 78.49), 0.09),
+    ('Chennai', 0.11, (13.08, 80.27), 0.08),
+    ('Kolkata', 0.09, (22.57, 88.36), 0.07),
+    ('Pune', 0.06, (18.52, 73.86), 0.06),
+]
+HOTSPOTS_PER_CITY = 6
+HOTSPOT_SHARE = 0.7
+
+# status -> share of requests; pending ones are queued for the dispatcher,
+# which works through them in the background once the app is running
+STATUS_MIX = [
+    ('completed', 0.70),
+    ('cancelled', 0.10),
+    ('work_done_by_helper', 0.04),
+    ('in_progress', 0.05),
+    ('accepted', 0.08),
+    ('pending', 0.03),
+]
+ACTIVE_STATUSES = ('accepted', 'in_progress')
+CHUNK = 10000
+
+
+class Geography:
+    def __init__(self, rng):
+        self.rng = rng
+        self.weights = [weight for _, weight, _, _ in CITIES]
+        self.hotspots = [
+            [(lat + rng.gauss(0, spread / 2), lon + rng.gauss(0, spread / 2)) for _ in range(HOTSPOTS_PER_CITY)]
+            for _, _, (lat, lon), spread in CITIES
+        ]
+
+    def city(self):
+        return self.rng.choices(range(len(CITIES)), self.weights)[0]
+
+    def point(self, city):
+        rng = self.rng
+        _, _, (lat, lon), spread = CITIES[city]
+        if rng.random() < HOTSPOT_SHARE:
+            lat, lon = rng.choice(self.hotspots[city])
+            spread /= 6
+        return round(lat + rng.gauss(0, spread), 6), round(lon + rng.gauss(0, spread), 6)
+
+
+def chunks(rows, size=CHUNK):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def timestamp(rng, days):
+    moment = datetime.utcnow() - timedelta(seconds=rng.uniform(0, days * 86400))
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def load(conn, sql, rows, label):
+    start = time.perf_counter()
+    count = 0
+    for chunk in chunks(rows):
+        conn.executemany(sql, chunk)
+        conn.commit()
+        count += len(chunk)
+        print(f'\r{label}: {count}', end='', file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    print(f'\r{label}: {count} in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f}/s)', file=sys.stderr)
+    return count
+
+
+def seed(conn, args, password_hash):
+    rng = random.Random(args.seed)
+    geo = Geography(rng)
+    tag = f'{args.seed}-{int(time.time())}'
+    services = {row[0]: row[1] for row in conn.execute('SELECT service_id, max_concurrent_jobs FROM services')}
+    service_ids = sorted(services)
+
+    load(conn, '''
+        INSERT INTO users (username, email, password, full_name, phone, address, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', ((f'bench{tag}u{i}', f'u{i}.{tag}@bench.nearfix', password_hash, f'Bench User {i}',
+           f'9{rng.randrange(10 ** 9):09d}', CITIES[geo.city()][0], timestamp(rng, args.days))
+          for i in range(args.users)), 'users')
+
+    helper_cities = [geo.city() for _ in range(args.helpers)]
+    helper_services = [rng.choice(service_ids) for _ in range(args.helpers)]
+    first_helper = conn.execute('SELECT COALESCE(MAX(helper_id), 0) + 1 FROM helpers').fetchone()[0]
+    load(conn, '''
+        INSERT INTO helpers (username, email, password, full_name, phone, service_type_id,
+                             latitude, longitude, is_available, is_approved, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', ((f'bench{tag}h{i}', f'h{i}.{tag}@bench.nearfix', password_hash, f'Bench Helper {i}',
+           f'8{rng.randrange(10 ** 9):09d}', helper_services[i], *geo.point(helper_cities[i]),
+           int(rng.random() < 0.8), int(rng.random() < 0.95), timestamp(rng, args.days))
+          for i in range(args.helpers)), 'helpers')
+
+    # (city, service) -> helper ids, for assigning requests to plausible helpers
+    local_helpers = {}
+    for i, (city, service_id) in enumerate(zip(helper_cities, helper_services)):
+        local_helpers.setdefault((city, service_id), []).append(first_helper + i)
+    user_ids = [row[0] for row in conn.execute('SELECT user_id FROM users')]
+    active_jobs = {}
+    statuses, shares = zip(*STATUS_MIX)
+
+    def requests():
+        for i in range(args.requests):
+            city = geo.city()
+            service_id = rng.choice(service_ids)
+            status = rng.choices(statuses, shares)[0]
+            helper_id = None
+            if status != 'pending':
+                nearby = local_helpers.get((city, service_id))
+                helper_id = rng.choice(nearby) if nearby else None
+                if helper_id is None:
+                    status = 'pending'
+                elif status in ACTIVE_STATUSES:
+                    if active_jobs.get(helper_id, 0) >= services[service_id]:
+                        status = 'completed'
+                    else:
+                        active_jobs[helper_id] = active_jobs.get(helper_id, 0) + 1
+            yield (rng.choice(user_ids), helper_id, service_id, f'Bench request {i}',
+                   'Synthetic request for benchmarking', *geo.point(city),
+                   CITIES[city][0], status, timestamp(rng, args.days))
+
+    load(conn, '''
+        INSERT INTO service_requests (user_id, helper_id, service_type_id, title, description,
+                                      user_latitude, user_longitude, user_address, status, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', requests(), 'requests')
+    conn.executemany('UPDATE helpers SET active_jobs = ? WHERE helper_id = ?',
+                     [(count, helper_id) for helper_id, count in active_jobs.items()])
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--dir', required=True, help='directory for nearfix.db; created if missing')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--helpers', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--days', type=int, default=90, help='spread created_at over this many days')
+    parser.add_argument('--password', default='bench')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    # the app keeps its database in the working directory and builds the schema on import
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, here)
+    os.makedirs(args.dir, exist_ok=True)
+    os.chdir(args.dir)
+    import app as app_module
+
+    conn = sqlite3.connect(app_module.DATABASE)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    password_hash = app_module.password_hasher.hash(args.password)
+    start = time.perf_counter()
+    seed(conn, args, password_hash)
+    conn.close()
+
+    drift = app_module.reconcile_counters()
+    app_module.password_hasher.shutdown()
+    print(f'seeded {os.path.abspath(app_module.DATABASE)} in {time.perf_counter() - start:.1f}s'
+          + (f', counters reconciled: {sorted(drift)}' if drift else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Server-side sessions for NearFix.
+
+The cookie carries only a random session id and the data lives in a
+SessionStore. SQLiteSessionStore keeps sessions in the app database, so
+every worker process sees the same ones. MemorySessionStore is a
+single-process stand-in with the same interface, which is also the shape a
+Redis-backed store would take.
+"""
+import secrets
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+class SessionStore:
+    """Backend interface: session id -> serialized data with an expiry time"""
+
+    def load(self, sid):
+        """(data, expires_at) for a live session, or None"""
+        raise NotImplementedError
+
+    def save(self, sid, data, expires_at):
+        raise NotImplementedError
+
+    def delete(self, sid):
+        raise NotImplementedError
+
+    def sweep(self):
+        """Drop expired sessions and return how many were removed"""
+        raise NotImplementedError
+
+
+class SQLiteSessionStore(SessionStore):
+    """Sessions in the `sessions` table; `connect` returns a database connection"""
+
+    def __init__(self, connect):
+        self.connect = connect
+
+    def load(self, sid):
+        conn = self.connect()
+        row = conn.execute('SELECT data, expires_at FROM sessions WHERE sid = ? AND expires_at > ?',
+                           (sid, time.time())).fetchone()
+        conn.close()
+        return tuple(row) if row else None
+
+    def save(self, sid, data, expires_at):
+        conn = self.connect()
+        conn.execute('''
+            INSERT INTO sessions (sid, data, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (sid) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at
+        ''', (sid, data, expires_at))
+        conn.commit()
+        conn.close()
+
+    def delete(self, sid):
+        conn = self.connect()
+        conn.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+        conn.commit()
+        conn.close()
+
+    def sweep(self):
+        conn = self.connect()
+        cur = conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (time.time(),))
+        conn.commit()
+        conn.close()
+        return cur.rowcount
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions in a dict; only for a single process (development, tests)"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        with self._lock:
+            found = self._sessions.get(sid)
+        if found is None or found[1] <= time.time():
+            return None
+        return found
+
+    def save(self, sid, data, expires_at):
+        with self._lock:
+            self._sessions[sid] = (data, expires_at)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, (_, expires_at) in self._sessions.items() if expires_at <= now]
+            for sid in expired:
+                del self._sessions[sid]
+        return len(expired)
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.modified = False
+        self.replaced_sid = None
+
+    def regenerate(self):
+        """Move the data to a fresh session id, e.g. at login"""
+        if self.sid is not None:
+            self.replaced_sid = self.sid
+            self.sid = None
+        self.modified = True
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Flask session interface over a SessionStore.
+
+    Sessions expire PERMANENT_SESSION_LIFETIME after their last write. An
+    unchanged session is rewritten only once half of that has passed, so most
+    requests cost a single primary-key read.
+    """
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            found = self.store.load(sid)
+            if found is not None:
+                data, expires_at = found
+                return ServerSideSession(self.serializer.loads(data), sid, expires_at)
+        return ServerSideSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.replaced_sid:
+            self.store.delete(session.replaced_sid)
+
+        if not session:
+            if session.sid is not None and session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+                response.vary.add('Cookie')
+            return
+        response.vary.add('Cookie')
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        renew = session.expires_at is None or session.expires_at - now < lifetime / 2
+        if not (session.modified or renew):
+            return
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        session.expires_at = now + lifetime
+        self.store.save(session.sid, self.serializer.dumps(dict(session)), session.expires_at)
+        response.set_cookie(
+            name, session.sid,
+            expires=session.expires_at if session.permanent else None,
+            httponly=self.get_cookie_httponly(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            domain=domain, path=path,
+        )
@@ -0,0 +1,292 @@
+"""
+Region shards for NearFix.
+
+Helpers and service requests are split by region, each region in its own
+SQLite file, so bookings and dispatch in one region never wait on another
+region's write lock. A region is a list of geohash prefixes: a location
+belongs to the region with the longest matching prefix, and anything else,
+or without a location, to the home shard. The home shard is the main
+database, which also keeps the accounts, sessions and services catalog.
+
+Every shard has the full schema. Each hands out helper and request ids from
+its own range, with the shard index in the bits above SHARD_ID_BITS, so an
+id names its shard without a lookup. The home shard's ids start at 1, as in
+an unsharded database.
+
+Requests are matched to helpers of their own shard, so everything a helper
+works on lives in one file. A user's requests and the admin pages are read
+from every shard at once and merged.
+"""
+import heapq
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+
+from db import query_log
+from repository import RECENT_REQUESTS_LIMIT, DuplicateAccount
+from spatial import geohash
+
+HOME_SHARD = 0
+# ids per shard; 2 ** 40 is a trillion, and shard 8191 still fits in a JSON number
+SHARD_ID_BITS = 40
+# tables whose rows are spread over the shards; the rest live in the home shard
+SHARDED_TABLES = ('helpers', 'service_requests')
+
+
+def shard_of(row_id):
+    """Shard index of a helper or request id"""
+    return int(row_id) >> SHARD_ID_BITS
+
+
+def first_id(shard):
+    """sqlite_sequence value a new shard starts its id range from"""
+    return shard << SHARD_ID_BITS
+
+
+class ShardRouter:
+    """Maps a location to its shard. regions[i] holds the geohash prefixes of shard i + 1."""
+
+    def __init__(self, regions):
+        self.shard_by_prefix = {}
+        for shard, prefixes in enumerate(regions, start=1):
+            for prefix in prefixes:
+                if prefix in self.shard_by_prefix:
+                    raise ValueError(f'geohash prefix {prefix!r} is in two regions')
+                self.shard_by_prefix[prefix] = shard
+        self.precision = max(map(len, self.shard_by_prefix), default=0)
+        self.count = len(regions) + 1
+
+    def shard_for(self, latitude, longitude):
+        if not self.shard_by_prefix:
+            return HOME_SHARD
+        try:
+            cell = geohash(float(latitude), float(longitude), self.precision)
+        except (TypeError, ValueError):
+            return HOME_SHARD
+        for length in range(self.precision, 0, -1):
+            shard = self.shard_by_prefix.get(cell[:length])
+            if shard is not None:
+                return shard
+        return HOME_SHARD
+
+
+def newest_first(results, id_column, limit):
+    """Merge per-shard pages sorted by (created_at, id) descending"""
+    rows = heapq.merge(*results, key=lambda row: (row['created_at'], row[id_column]), reverse=True)
+    return list(islice(rows, limit))
+
+
+def _logging_to(collected, call, *args):
+    """call(*args) on a pool thread, with its statements going to `collected`"""
+    token = query_log.set(collected)
+    try:
+        return call(*args)
+    finally:
+        query_log.reset(token)
+
+
+class ShardedRepository:
+    """The repository.Repository interface over one Repository per shard.
+
+    Lookups by helper or request id go to the id's shard, new helpers and
+    requests to the shard of their location, and lists are read from every
+    shard in parallel and merged in the order one database would return.
+    Users, admins and the services catalog live in the home shard. Catalog
+    writes are copied to every shard, whose dispatcher reads its own copy.
+    """
+
+    def __init__(self, router, shards):
+        self.router = router
+        self.shards = shards
+        self.home = shards[HOME_SHARD]
+        self._pool = ThreadPoolExecutor(max_workers=max(len(shards) - 1, 1), thread_name_prefix='nearfix-shards')
+
+    def _by_id(self, row_id):
+        return self.shards[shard_of(row_id)]
+
+    def _account_shard(self, kind, account_id):
+        return self._by_id(account_id) if kind == 'helper' else self.home
+
+    def _map(self, call, shards):
+        """call(shard index) for each of `shards` at once; results in the same order.
+
+        The first call runs in the calling thread, so a home shard read still
+        sees the request (replica routing, the request's own connection). The
+        others report their statements to the caller's db.query_log.
+        """
+        collected = query_log.get()
+        futures = [self._pool.submit(_logging_to, collected, call, shard) for shard in shards[1:]]
+        return [call(shards[0])] + [future.result() for future in futures]
+
+    def _each(self, method, *args, shards=None):
+        """Repository.method(*args) on every shard, or on the listed shard indexes"""
+        shards = list(range(len(self.shards)) if shards is None else shards)
+        return self._map(lambda shard: getattr(self.shards[shard], method)(*args), shards)
+
+    # accounts
+
+    def identity(self, kind, account_id):
+        return self._account_shard(kind, account_id).identity(kind, account_id)
+
+    def account_by_username(self, kind, username):
+        if kind != 'helper':
+            return self.home.account_by_username(kind, username)
+        return next((row for row in self._each('account_by_username', kind, username) if row is not None), None)
+
+    def replace_password_hash(self, kind, account_id, old_hash, new_hash):
+        self._account_shard(kind, account_id).replace_password_hash(kind, account_id, old_hash, new_hash)
+
+    def create_user(self, username, email, password_hash, full_name, phone, address):
+        return self.home.create_user(username, email, password_hash, full_name, phone, address)
+
+    def create_helper(self, username, email, password_hash, full_name, phone, service_type_id, latitude, longitude):
+        """Insert a helper into the shard of their location.
+
+        Usernames and emails are only unique within one file, so the new row
+        is checked against the other shards once committed, and removed if one
+        of them has it too. Of two racing sign-ups the later one always sees
+        the earlier, so at worst both are refused.
+        """
+        shard = self.router.shard_for(latitude, longitude)
+        helper_id = self.shards[shard].create_helper(username, email, password_hash, full_name, phone,
+                                                     service_type_id, latitude, longitude)
+        others = [other for other in range(len(self.shards)) if other != shard]
+        if any(self._each('helper_taken', username, email, shards=others)):
+            self.shards[shard].delete_helper(helper_id)
+            raise DuplicateAccount()
+        return helper_id
+
+    # helpers
+
+    def helper_dispatch_row(self, helper_id):
+        return self._by_id(helper_id).helper_dispatch_row(helper_id)
+
+    def helper_availability(self, helper_id):
+        return self._by_id(helper_id).helper_availability(helper_id)
+
+    def set_helper_availability(self, helper_id, is_available):
+        self._by_id(helper_id).set_helper_availability(helper_id, is_available)
+
+    def approve_helper(self, helper_id):
+        self._by_id(helper_id).approve_helper(helper_id)
+
+    def approve_helpers(self, service_type_id=None, created_from=None, created_before=None, with_location=False):
+        return sum(self._each('approve_helpers', service_type_id, created_from, created_before, with_location))
+
+    def pending_helpers(self):
+        return [row for rows in self._each('pending_helpers') for row in rows]
+
+    # helper imports, queued in the home shard whichever shards the helpers go to
+
+    def create_import(self, filename, path, fmt, approve):
+        return self.home.create_import(filename, path, fmt, approve)
+
+    def recent_imports(self):
+        return self.home.recent_imports()
+
+    # services
+
+    def services(self):
+        return self.home.services()
+
+    def add_service(self, service_name, description, max_concurrent_jobs):
+        self.home.add_service(service_name, description, max_concurrent_jobs)
+        self.copy_services()
+
+    def set_service_capacity(self, service_id, max_concurrent_jobs):
+        self.home.set_service_capacity(service_id, max_concurrent_jobs)
+        self.copy_services()
+
+    def copy_services(self):
+        """Make every shard's catalog a copy of the home shard's"""
+        if len(self.shards) > 1:
+            self._each('replace_services', self.home.services(), shards=range(1, len(self.shards)))
+
+    # service requests
+
+    def create_request(self, user_id, service_type_id, title, description, latitude, longitude, address):
+        shard = self.shards[self.router.shard_for(latitude, longitude)]
+        return shard.create_request(user_id, service_type_id, title, description, latitude, longitude, address)
+
+    def dashboard_requests(self, kind, owner_id, cursor, limit):
+        if kind == 'helper':
+            return self._by_id(owner_id).dashboard_requests(kind, owner_id, cursor, limit)
+        return newest_first(self._each('dashboard_requests', kind, owner_id, cursor, limit), 'request_id', limit)
+
+    def last_event_id(self):
+        """Newest request_events id of each shard"""
+        return tuple(self._each('last_event_id'))
+
+    def api_requests(self, kind, owner_id, cursor, limit):
+        if kind == 'helper':
+            return self._by_id(owner_id).api_requests(kind, owner_id, cursor, limit)
+        return newest_first(self._each('api_requests', kind, owner_id, cursor, limit), 'request_id', limit)
+
+    def requests_version(self, kind, owner_id):
+        if kind == 'helper':
+            return self._by_id(owner_id).requests_version(kind, owner_id)
+        versions = self._each('requests_version', kind, owner_id)
+        return (sum(count for count, _ in versions),
+                max((updated_at for _, updated_at in versions if updated_at), default=None))
+
+    def request_card(self, kind, request_id, owner_id):
+        return self._by_id(request_id).request_card(kind, request_id, owner_id)
+
+    def api_request(self, kind, request_id, owner_id):
+        return self._by_id(request_id).api_request(kind, request_id, owner_id)
+
+    def request_status(self, request_id):
+        return self._by_id(request_id).request_status(request_id)
+
+    def request_state(self, kind, request_id, owner_id):
+        return self._by_id(request_id).request_state(kind, request_id, owner_id)
+
+    def request_history(self, request_id):
+        return self._by_id(request_id).request_history(request_id)
+
+    def move_request(self, request_id, from_status, to_status, release_helper_id=None):
+        return self._by_id(request_id).move_request(request_id, from_status, to_status, release_helper_id)
+
+    def changed_requests(self, kind, owner_id, cursor, limit):
+        """Requests changed after `cursor`, which holds one change_seq position
+        per shard: each file numbers its own changes. Shards are interleaved
+        by updated_at, each in its own change_seq order."""
+        shards = [shard_of(owner_id)] if kind == 'helper' else list(range(len(self.shards)))
+        results = self._map(lambda shard: self.shards[shard].changed_requests(kind, owner_id, (cursor[shard],), limit),
+                            shards)
+        rows = heapq.merge(*results, key=lambda row: (row['updated_at'], row['request_id']))
+        return list(islice(rows, limit))
+
+    # admin pages
+
+    def stats_counters(self):
+        totals = Counter()
+        for counters in self._each('stats_counters'):
+            totals.update(counters)
+        return dict(totals)
+
+    def recent_requests(self):
+        rows = heapq.merge(*self._each('recent_requests'), key=lambda row: row['created_at'], reverse=True)
+        return list(islice(rows, RECENT_REQUESTS_LIMIT))
+
+    def users_page(self, cursor, limit):
+        return self.home.users_page(cursor, limit)
+
+    def helpers_page(self, cursor, limit):
+        return newest_first(self._each('helpers_page', cursor, limit), 'helper_id', limit)
+
+    def export_batches(self, table, columns, id_column, status=None, created_from=None, created_before=None,
+                       batch_size=1000):
+        """Batches of `table` rows in (created_at, id) order across every shard that has it"""
+        shards = self.shards if table in SHARDED_TABLES else [self.home]
+        rows = heapq.merge(*(
+            chain.from_iterable(shard.export_batches(table, columns, id_column, status, created_from,
+                                                     created_before, batch_size))
+            for shard in shards
+        ), key=lambda row: (row['created_at'], row[id_column]))
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return
+            yield batch
+
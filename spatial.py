@@ -0,0 +1,411 @@
+"""
+Spatial lookup of helpers for NearFix dispatch.
+
+Helpers are bucketed into a fixed lat/lon grid per service type so that the
+nearest-helper search only looks at the cells around the customer instead of
+every helper offering that service.
+"""
+import heapq
+import math
+import threading
+import time
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, the array fallback gives the same results
+    np = None
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+# helpers with a free slot: active_jobs below their service's max_concurrent_jobs
+DISPATCH_HELPERS_QUERY = '''
+    SELECT helper_id, latitude, longitude
+    FROM helpers
+    WHERE service_type_id = ?1 AND is_available = 1 AND is_approved = 1
+      AND active_jobs < (SELECT max_concurrent_jobs FROM services WHERE service_id = ?1)
+'''
+
+# below this range the equirectangular approximation is within a few meters
+EQUIRECT_MAX_KM = 50
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in kilometers"""
+    lat1, lon1, lat2, lon2 = float(lat1), float(lon1), float(lat2), float(lon2)
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    delta_lat = math.radians(lat2 - lat1)
+    delta_lon = math.radians(lon2 - lon1)
+
+    a = math.sin(delta_lat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(delta_lon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def parse_point(lat, lon):
+    """(lat, lon) as floats, or None if either is blank.
+
+    Raises ValueError for values that are not numbers or not on the globe.
+    """
+    if lat in (None, '') or lon in (None, ''):
+        return None
+    try:
+        lat, lon = float(lat), float(lon)
+    except TypeError:
+        raise ValueError(f'not a coordinate: {lat!r}, {lon!r}') from None
+    # NaN fails the comparison too
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError(f'not a coordinate: {lat!r}, {lon!r}')
+    return lat, lon
+
+
+class CoordBlock:
+    """A batch of helper coordinates held as radians with cos(lat) precomputed"""
+
+    def __init__(self, ids, lats, lons):
+        self.ids = list(ids)
+        lat_rad = [math.radians(float(v)) for v in lats]
+        lon_rad = [math.radians(float(v)) for v in lons]
+        cos_lat = [math.cos(v) for v in lat_rad]
+        if np is not None:
+            self.lat_rad = np.array(lat_rad, dtype=float)
+            self.lon_rad = np.array(lon_rad, dtype=float)
+            self.cos_lat = np.array(cos_lat, dtype=float)
+        else:
+            self.lat_rad = array('d', lat_rad)
+            self.lon_rad = array('d', lon_rad)
+            self.cos_lat = array('d', cos_lat)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def take(self, positions):
+        """A new block holding only the given positions"""
+        block = CoordBlock.__new__(CoordBlock)
+        block.ids = [self.ids[i] for i in positions]
+        if np is not None:
+            block.lat_rad = self.lat_rad[positions]
+            block.lon_rad = self.lon_rad[positions]
+            block.cos_lat = self.cos_lat[positions]
+        else:
+            block.lat_rad = array('d', (self.lat_rad[i] for i in positions))
+            block.lon_rad = array('d', (self.lon_rad[i] for i in positions))
+            block.cos_lat = array('d', (self.cos_lat[i] for i in positions))
+        return block
+
+
+def haversine_many(lat, lon, block):
+    """Distances in km from one origin to every point of a CoordBlock"""
+    lat1 = math.radians(float(lat))
+    lon1 = math.radians(float(lon))
+    cos1 = math.cos(lat1)
+    if np is not None:
+        a = (np.sin((block.lat_rad - lat1) / 2) ** 2
+             + cos1 * block.cos_lat * np.sin((block.lon_rad - lon1) / 2) ** 2)
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+    sin, asin, sqrt = math.sin, math.asin, math.sqrt
+    return [2 * EARTH_RADIUS_KM * asin(sqrt(min(1.0, sin((lat2 - lat1) / 2) ** 2
+                                                 + cos1 * cos2 * sin((lon2 - lon1) / 2) ** 2)))
+            for lat2, lon2, cos2 in zip(block.lat_rad, block.lon_rad, block.cos_lat)]
+
+
+def equirect_many(lat, lon, block):
+    """Flat-earth distances in km; only meaningful for short ranges"""
+    lat1 = math.radians(float(lat))
+    lon1 = math.radians(float(lon))
+    cos1 = math.cos(lat1)
+    if np is not None:
+        x = (block.lon_rad - lon1) * cos1
+        y = block.lat_rad - lat1
+        return EARTH_RADIUS_KM * np.sqrt(x * x + y * y)
+
+    sqrt = math.sqrt
+    return [EARTH_RADIUS_KM * sqrt(((lon2 - lon1) * cos1) ** 2 + (lat2 - lat1) ** 2)
+            for lat2, lon2 in zip(block.lat_rad, block.lon_rad)]
+
+
+def distances_within(lat, lon, block, radius_km):
+    """(distance_km, id) pairs of a CoordBlock within radius_km of the origin.
+
+    Short radii are prefiltered with the equirectangular approximation so the
+    haversine only runs on points that can actually be in range.
+    """
+    if not len(block):
+        return []
+    if radius_km <= EQUIRECT_MAX_KM:
+        approx = equirect_many(lat, lon, block)
+        # small slack so the approximation never drops a point that is in range
+        limit = radius_km * 1.01 + 0.01
+        keep = [i for i, d in enumerate(approx) if d <= limit]
+        if not keep:
+            return []
+        if len(keep) < len(block):
+            block = block.take(keep)
+    return [(float(d), helper_id)
+            for d, helper_id in zip(haversine_many(lat, lon, block), block.ids)
+            if d <= radius_km]
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash(lat, lon, precision=5):
+    """Geohash cell of a point; precision 5 cells are about 4.9 x 4.9 km"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    lat, lon = float(lat), float(lon)
+    chars = []
+    bits = bit_count = 0
+    even = True
+    while len(chars) < precision:
+        rng, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = bit_count = 0
+    return ''.join(chars)
+
+
+def geohash_center(cell):
+    """(lat, lon) at the middle of a geohash cell"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in cell:
+        value = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            rng = lon_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if value >> shift & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
+
+
+def _has_coords(helper):
+    # the registration form posts empty strings when location is skipped
+    return helper['latitude'] not in (None, '') and helper['longitude'] not in (None, '')
+
+
+class GridIndex:
+    """Grid-bucket index over (lat, lon) points keyed by helper id.
+
+    Any object with the same add/remove/nearest/within methods can be used
+    instead (see HelperIndexRegistry's index_factory).
+    """
+
+    def __init__(self, cell_deg=0.05):
+        self.cell_deg = cell_deg
+        self.cells = {}
+        self.points = {}
+        # CoordBlocks are rebuilt lazily after a cell changes
+        self._blocks = {}
+        self._all_block = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, helper_id):
+        return helper_id in self.points
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg)))
+
+    def _touch(self, cell):
+        self._blocks.pop(cell, None)
+        self._all_block = None
+
+    def add(self, helper_id, lat, lon):
+        self.remove(helper_id)
+        lat, lon = float(lat), float(lon)
+        cell = self._cell(lat, lon)
+        self.points[helper_id] = (lat, lon, cell)
+        self.cells.setdefault(cell, {})[helper_id] = (lat, lon)
+        self._touch(cell)
+
+    def remove(self, helper_id):
+        point = self.points.pop(helper_id, None)
+        if point is None:
+            return
+        bucket = self.cells[point[2]]
+        del bucket[helper_id]
+        if not bucket:
+            del self.cells[point[2]]
+        self._touch(point[2])
+
+    def _block(self, cell):
+        block = self._blocks.get(cell)
+        if block is None:
+            bucket = self.cells[cell]
+            block = CoordBlock(bucket.keys(),
+                               [p[0] for p in bucket.values()],
+                               [p[1] for p in bucket.values()])
+            self._blocks[cell] = block
+        return block
+
+    def _all(self):
+        if self._all_block is None:
+            self._all_block = CoordBlock(self.points.keys(),
+                                         [p[0] for p in self.points.values()],
+                                         [p[1] for p in self.points.values()])
+        return self._all_block
+
+    def _ring(self, center, r):
+        """Yield the occupied cells at Chebyshev distance r from center"""
+        ci, cj = center
+        if r == 0:
+            if center in self.cells:
+                yield center
+            return
+        for j in range(cj - r, cj + r + 1):
+            for i in (ci - r, ci + r):
+                if (i, j) in self.cells:
+                    yield (i, j)
+        for i in range(ci - r + 1, ci + r):
+            for j in (cj - r, cj + r):
+                if (i, j) in self.cells:
+                    yield (i, j)
+
+    def _ring_min_km(self, lat, r):
+        """Lower bound on the distance to any point r or more rings away"""
+        if r <= 0:
+            return 0.0
+        # longitude cells are the narrow side; use the highest latitude they could reach
+        far_lat = min(89.0, abs(lat) + (r + 1) * self.cell_deg)
+        return (r - 1) * self.cell_deg * KM_PER_DEGREE * math.cos(math.radians(far_lat))
+
+    @staticmethod
+    def _scan(lat, lon, block, k=None):
+        """(distance_km, helper_id) for a block, only the k closest when k is given"""
+        distances = haversine_many(lat, lon, block)
+        if k is None or k >= len(block):
+            return [(float(d), helper_id) for d, helper_id in zip(distances, block.ids)]
+        if np is not None:
+            picked = np.argpartition(distances, k - 1)[:k]
+            return [(float(distances[i]), block.ids[i]) for i in picked]
+        return heapq.nsmallest(k, zip(distances, block.ids))
+
+    def nearest(self, lat, lon, k=1):
+        """Return up to k (distance_km, helper_id) pairs, closest first"""
+        lat, lon = float(lat), float(lon)
+        if not self.points:
+            return []
+
+        center = self._cell(lat, lon)
+        found = []
+        seen = 0
+        r = 0
+        while seen < len(self.points):
+            # once a ring has more cells than the index has occupied cells a
+            # plain scan of everything is cheaper than walking empty cells
+            if 8 * r > len(self.cells):
+                found = self._scan(lat, lon, self._all(), k)
+                break
+            for cell in self._ring(center, r):
+                block = self._block(cell)
+                seen += len(block)
+                found.extend(self._scan(lat, lon, block, k))
+            r += 1
+            if len(found) >= k:
+                found.sort()
+                del found[k:]
+                if found[k - 1][0] <= self._ring_min_km(lat, r):
+                    break
+
+        found.sort()
+        return found[:k]
+
+    def within(self, lat, lon, radius_km):
+        """Return (distance_km, helper_id) pairs within radius_km, closest first"""
+        lat, lon = float(lat), float(lon)
+        center = self._cell(lat, lon)
+        found = []
+        r = 0
+        while r == 0 or self._ring_min_km(lat, r) <= radius_km:
+            if 8 * r > len(self.cells):
+                found = distances_within(lat, lon, self._all(), radius_km)
+                break
+            for cell in self._ring(center, r):
+                found.extend(distances_within(lat, lon, self._block(cell), radius_km))
+            r += 1
+
+        return sorted(found)
+
+
+class HelperIndexRegistry:
+    """One spatial index per service_type_id over available, approved helpers.
+
+    The registry is per process, so under several gunicorn workers an index can
+    miss changes made by another worker. Callers re-check the chosen helper
+    against the database, and each index is rebuilt after refresh_seconds.
+    """
+
+    def __init__(self, index_factory=GridIndex, refresh_seconds=60):
+        self.index_factory = index_factory
+        self.refresh_seconds = refresh_seconds
+        self._indexes = {}
+        self._built_at = {}
+        self._lock = threading.Lock()
+
+    def _build(self, conn, service_type_id):
+        index = self.index_factory()
+        rows = conn.execute(DISPATCH_HELPERS_QUERY, (service_type_id,)).fetchall()
+        for row in rows:
+            if not _has_coords(row):
+                continue
+            index.add(row['helper_id'], row['latitude'], row['longitude'])
+        return index
+
+    def _get(self, conn, service_type_id):
+        index = self._indexes.get(service_type_id)
+        built_at = self._built_at.get(service_type_id, 0)
+        if index is None or time.monotonic() - built_at > self.refresh_seconds:
+            index = self._build(conn, service_type_id)
+            self._indexes[service_type_id] = index
+            self._built_at[service_type_id] = time.monotonic()
+        return index
+
+    def nearest(self, conn, service_type_id, lat, lon, k=1):
+        with self._lock:
+            return self._get(conn, int(service_type_id)).nearest(lat, lon, k)
+
+    def within(self, conn, service_type_id, lat, lon, radius_km):
+        with self._lock:
+            return self._get(conn, int(service_type_id)).within(lat, lon, radius_km)
+
+    def sync_helper(self, helper):
+        """Add or drop one helper row according to its current state.
+
+        The row needs is_available, is_approved and has_capacity columns.
+        """
+        if helper is None or helper['service_type_id'] is None:
+            return
+        with self._lock:
+            index = self._indexes.get(int(helper['service_type_id']))
+            if index is None:
+                # built lazily on the next lookup
+                return
+            if helper['is_available'] and helper['is_approved'] and helper['has_capacity'] and _has_coords(helper):
+                index.add(helper['helper_id'], helper['latitude'], helper['longitude'])
+            else:
+                index.remove(helper['helper_id'])
+
+    def discard(self, service_type_id, helper_id):
+        with self._lock:
+            index = self._indexes.get(int(service_type_id))
+            if index is not None:
+                index.remove(helper_id)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            self._built_at.clear()
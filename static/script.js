@@ -254,7 +254,10 @@ function loadContent(url, targetElementId) {
     targetElement.innerHTML = '<div class="loading">Loading...</div>';
     
     fetch(url)
-        .then(response => response.text())
+        .then(response => {
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            return response.text();
+        })
         .then(html => {
             targetElement.innerHTML = html;
         })
@@ -264,6 +267,67 @@ function loadContent(url, targetElementId) {
         });
 }
 
+// Live Request Updates: the server pushes status changes, and only the
+// changed card is refetched
+function watchRequestEvents() {
+    const container = document.querySelector('[data-events-url]');
+    if (!container || !window.EventSource) return;
+
+    const source = new EventSource(container.dataset.eventsUrl);
+    source.addEventListener('request', function(e) {
+        const event = JSON.parse(e.data);
+        const cardId = `request-${event.request_id}`;
+        let card = document.getElementById(cardId);
+        if (!card) {
+            const list = container.querySelector('.requests-list');
+            if (!list) {
+                // first request on an empty dashboard
+                window.location.reload();
+                return;
+            }
+            card = document.createElement('div');
+            card.id = cardId;
+            list.prepend(card);
+        }
+        card.className = `request-item status-${event.to_status}`;
+        loadContent(container.dataset.cardUrl.replace('/0/', `/${event.request_id}/`), cardId);
+        if (event.from_status) {
+            showNotification(`Request #${event.request_id} is now ${event.to_status.replace(/_/g, ' ')}.`, 'success');
+        }
+    });
+}
+
+document.addEventListener('DOMContentLoaded', watchRequestEvents);
+
+// Poll Pending Requests until the dispatcher assigns a helper; only used
+// where the browser has no EventSource
+function pollPendingRequests() {
+    if (window.EventSource && document.querySelector('[data-events-url]')) return;
+    const pendingItems = document.querySelectorAll('[data-status-url]');
+    pendingItems.forEach(item => {
+        const poll = () => {
+            fetch(item.dataset.statusUrl)
+                .then(response => response.json())
+                .then(data => {
+                    if (data.status !== 'pending') {
+                        showNotification(data.helper_name
+                            ? `${data.helper_name} has been assigned to your request!`
+                            : 'Your request status has changed.', 'success');
+                        setTimeout(() => window.location.reload(), 1500);
+                    } else {
+                        setTimeout(poll, 3000);
+                    }
+                })
+                .catch(error => {
+                    console.error('Error polling request status:', error);
+                });
+        };
+        setTimeout(poll, 3000);
+    });
+}
+
+document.addEventListener('DOMContentLoaded', pollPendingRequests);
+
 // Search Functionality (for future search features)
 function setupSearch(searchInputId, resultsContainerId, searchUrl) {
     const searchInput = document.getElementById(searchInputId);
@@ -0,0 +1,115 @@
+"""
+Concurrency check for helper reservation.
+
+    python stress_booking.py --workers 8 --bookings 50 --helpers 40 --capacity 2
+
+Seeds a throwaway database, then forks several processes that each log in as
+their own user and fire bookings through the Flask test client while also
+running the dispatcher, the way several gunicorn workers would. At the end
+no helper may hold more active jobs than their service allows, and every
+helper's active_jobs counter must match. Exits non-zero on overbooking.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+ACTIVE_STATUSES = ('accepted', 'in_progress')
+
+
+def seed(app_module, n_workers, n_helpers, capacity):
+    from werkzeug.security import generate_password_hash
+    password = generate_password_hash('stress', method='pbkdf2:sha256:1000')
+    conn = sqlite3.connect(app_module.DATABASE)
+    conn.execute('UPDATE services SET max_concurrent_jobs = ? WHERE service_id = 1', (capacity,))
+    conn.executemany('''
+        INSERT INTO helpers (username, email, password, full_name, service_type_id,
+                             latitude, longitude, is_available, is_approved)
+        VALUES (?, ?, ?, ?, 1, ?, ?, 1, 1)
+    ''', [(f'helper{i}', f'helper{i}@stress', password, f'Helper {i}',
+           28.6 + random.uniform(-0.05, 0.05), 77.2 + random.uniform(-0.05, 0.05))
+          for i in range(n_helpers)])
+    conn.executemany('INSERT INTO users (username, email, password, full_name) VALUES (?, ?, ?, ?)',
+                     [(f'user{i}', f'user{i}@stress', password, f'User {i}') for i in range(n_workers)])
+    conn.commit()
+    conn.close()
+
+
+def worker(number, n_bookings, barrier):
+    import app as app_module
+    client = app_module.app.test_client()
+    client.post('/user/login', data={'username': f'user{number}', 'password': 'stress'})
+    barrier.wait()
+    for i in range(n_bookings):
+        client.post('/user/request_service', data={
+            'service_type_id': '1',
+            'title': f'stress {number}-{i}',
+            'description': 'parallel booking',
+            'latitude': str(28.6 + random.uniform(-0.05, 0.05)),
+            'longitude': str(77.2 + random.uniform(-0.05, 0.05)),
+            'address': '',
+        })
+        app_module.jobs.run('dispatch_queued_requests')
+    app_module.jobs.run('rematch_pending_requests')
+    app_module.password_hasher.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--bookings', type=int, default=50, help='bookings per worker')
+    parser.add_argument('--helpers', type=int, default=40)
+    parser.add_argument('--capacity', type=int, default=1, help='max concurrent jobs per helper')
+    args = parser.parse_args()
+
+    # the app keeps its database in the working directory
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, here)
+    os.chdir(tempfile.mkdtemp(prefix='nearfix-stress-'))
+    import app as app_module
+    seed(app_module, args.workers, args.helpers, args.capacity)
+
+    barrier = multiprocessing.Barrier(args.workers)
+    start = time.perf_counter()
+    processes = [multiprocessing.Process(target=worker, args=(n, args.bookings, barrier))
+                 for n in range(args.workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    conn = sqlite3.connect(app_module.DATABASE)
+    placeholders = ', '.join('?' * len(ACTIVE_STATUSES))
+    total, assigned = conn.execute('SELECT COUNT(*), COUNT(helper_id) FROM service_requests').fetchone()
+    overbooked = conn.execute(f'''
+        SELECT helper_id, COUNT(*) FROM service_requests
+        WHERE status IN ({placeholders}) AND helper_id IS NOT NULL
+        GROUP BY helper_id HAVING COUNT(*) > ?
+    ''', (*ACTIVE_STATUSES, args.capacity)).fetchall()
+    miscounted = conn.execute(f'''
+        SELECT helper_id, active_jobs FROM helpers h
+        WHERE active_jobs <> (SELECT COUNT(*) FROM service_requests sr
+                              WHERE sr.helper_id = h.helper_id AND sr.status IN ({placeholders}))
+    ''', ACTIVE_STATUSES).fetchall()
+    failed = sum(process.exitcode != 0 for process in processes)
+
+    print(f'{total} bookings from {args.workers} processes in {elapsed:.2f}s, '
+          f'{assigned} assigned to {args.helpers} helpers')
+    if failed:
+        print(f'{failed} worker processes failed')
+    if overbooked:
+        print(f'OVERBOOKED helpers: {overbooked}')
+    if miscounted:
+        print(f'active_jobs out of step: {miscounted}')
+    if failed or overbooked or miscounted or total != args.workers * args.bookings:
+        sys.exit(1)
+    print('no overbooking')
+
+
+if __name__ == '__main__':
+    main()
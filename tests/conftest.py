@@ -0,0 +1,39 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def nearfix(tmp_path_factory):
+    """The app module, with nearfix.db created and migrated in a scratch directory"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('nearfix'))
+    try:
+        import app
+        yield app
+        app.password_hasher.shutdown()
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope='session')
+def seeded_database(nearfix, tmp_path_factory):
+    """Copy of the app's database as migrations and seed data left it"""
+    path = tmp_path_factory.mktemp('seeded') / 'nearfix.db'
+    conn = nearfix.get_job_connection(nearfix.HOME_SHARD)
+    try:
+        conn.execute(f"VACUUM INTO '{path}'")
+    finally:
+        conn.close()
+    return path
+
+
+@pytest.fixture
+def sqlite_database(seeded_database, tmp_path):
+    """Path of a fresh database for one test"""
+    return shutil.copy(seeded_database, tmp_path / 'nearfix.db')
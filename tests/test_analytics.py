@@ -0,0 +1,55 @@
+"""
+Demand rollups on a scratch copy of the migrated database.
+"""
+import pytest
+
+from analytics import GEOHASH_PRECISION, NO_LOCATION, rollup_demand
+from db import ConnectionPool
+from spatial import geohash
+
+
+@pytest.fixture
+def conn(sqlite_database):
+    conn = ConnectionPool(sqlite_database).acquire()
+    # start from a drained watermark so only this test's requests are counted
+    rollup_demand(conn)
+    with conn:
+        conn.execute('DELETE FROM demand_hourly')
+        conn.execute('DELETE FROM assign_latency_hourly')
+    yield conn
+    conn.close()
+
+
+def add_request(conn, latitude, longitude):
+    with conn:
+        user_id = conn.execute('SELECT MIN(user_id) FROM users').fetchone()[0]
+        if user_id is None:
+            user_id = conn.execute('''
+                INSERT INTO users (username, email, password, full_name) VALUES ('alice', 'alice@example.com', 'hash', 'Alice')
+            ''').lastrowid
+        conn.execute('''
+            INSERT INTO service_requests (user_id, service_type_id, title, description, user_latitude, user_longitude)
+            VALUES (?, 1, 'job', 'leaking tap', ?, ?)
+        ''', (user_id, latitude, longitude))
+
+
+def demand_by_cell(conn):
+    return dict(conn.execute('SELECT geohash, SUM(requests) FROM demand_hourly GROUP BY geohash').fetchall())
+
+
+def test_rollup_by_cell(conn):
+    add_request(conn, 28.6, 77.2)
+    add_request(conn, None, None)
+    assert rollup_demand(conn) == 2
+    assert demand_by_cell(conn) == {geohash(28.6, 77.2, GEOHASH_PRECISION): 1, NO_LOCATION: 1}
+    assert rollup_demand(conn) == 0
+
+
+def test_bad_coordinates_go_to_no_location(conn):
+    add_request(conn, 'abc', 77.2)
+    add_request(conn, 91.0, 77.2)
+    add_request(conn, 28.6, 77.2)
+    assert rollup_demand(conn) == 3
+    assert demand_by_cell(conn) == {geohash(28.6, 77.2, GEOHASH_PRECISION): 1, NO_LOCATION: 2}
+    last_event_id = conn.execute('SELECT MAX(event_id) FROM request_events').fetchone()[0]
+    assert conn.execute("SELECT last_event_id FROM rollup_watermarks WHERE name = 'demand'").fetchone()[0] == last_event_id
@@ -0,0 +1,77 @@
+"""
+Helper job slots under concurrent dispatchers.
+
+Every thread has its own connection to a scratch copy of the database and
+claims in autocommit mode, so the capacity check gets no help from an
+enclosing transaction.
+"""
+import sqlite3
+import threading
+
+CAPACITY = 3
+DISPATCHERS = 16
+
+
+def add_helper(path):
+    conn = sqlite3.connect(path)
+    try:
+        with conn:
+            return conn.execute('''
+                INSERT INTO helpers (username, email, password, full_name, service_type_id, is_approved)
+                VALUES ('bob', 'bob@example.com', 'hash', 'Bob', 1, 1)
+            ''').lastrowid
+    finally:
+        conn.close()
+
+
+def active_jobs(path, helper_id):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT active_jobs FROM helpers WHERE helper_id = ?', (helper_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def race(path, action):
+    """Run action(conn) on DISPATCHERS threads at once; returns what each returned"""
+    start = threading.Barrier(DISPATCHERS)
+    results = []
+
+    def dispatcher():
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        try:
+            start.wait()
+            for _ in range(4):
+                results.append(action(conn))
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=dispatcher) for _ in range(DISPATCHERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_claims_stay_within_capacity(nearfix, sqlite_database):
+    helper_id = add_helper(sqlite_database)
+    claims = race(sqlite_database, lambda conn: nearfix.claim_helper(conn, helper_id, CAPACITY))
+    assert sorted(claim for claim in claims if claim is not None) == list(range(1, CAPACITY + 1))
+    assert active_jobs(sqlite_database, helper_id) == CAPACITY
+
+
+def test_concurrent_claims_and_releases(nearfix, sqlite_database):
+    helper_id = add_helper(sqlite_database)
+    seen = []
+
+    def claim_then_release(conn):
+        active = nearfix.claim_helper(conn, helper_id, CAPACITY)
+        seen.append(active)
+        if active is not None:
+            nearfix.release_helper(conn, helper_id)
+
+    race(sqlite_database, claim_then_release)
+    assert any(active is not None for active in seen)
+    assert all(active <= CAPACITY for active in seen if active is not None)
+    assert active_jobs(sqlite_database, helper_id) == 0
@@ -0,0 +1,179 @@
+"""
+Repository against both drivers.
+
+SQLite runs on a copy of the app's migrated database. MySQL runs on a
+scratch database loaded from database.sql, and only when mysqlclient is
+installed and NEARFIX_TEST_MYSQL holds connection parameters, e.g.
+"host=127.0.0.1 user=root password=secret". The scratch database
+(nearfix_test by default) is dropped and recreated for every test.
+"""
+import os
+import re
+
+import pytest
+
+from conftest import ROOT
+from db import ConnectionPool, MySQLConnectionPool
+from repository import DuplicateAccount, Repository
+
+FIRST_PAGE = ('9999-12-31 23:59:59', 2 ** 63 - 1)
+
+
+def mysql_params():
+    pytest.importorskip('MySQLdb')
+    spec = os.environ.get('NEARFIX_TEST_MYSQL')
+    if not spec:
+        pytest.skip('NEARFIX_TEST_MYSQL is not set')
+    params = dict(item.split('=', 1) for item in spec.split())
+    params.setdefault('database', 'nearfix_test')
+    if 'port' in params:
+        params['port'] = int(params['port'])
+    return params
+
+
+def sql_statements(script):
+    """The statements of a mysql client script, honouring DELIMITER lines"""
+    delimiter, lines = ';', []
+    for line in script.splitlines():
+        if line.startswith('DELIMITER '):
+            delimiter = line.split()[1]
+            continue
+        lines.append(line)
+        if line.rstrip().endswith(delimiter):
+            statement = '\n'.join(lines).rstrip()[:-len(delimiter)]
+            lines = []
+            if re.sub(r'--.*', '', statement).strip():
+                yield statement
+
+
+def load_mysql_schema(params):
+    import MySQLdb
+
+    server = {key: value for key, value in params.items() if key != 'database'}
+    with open(os.path.join(ROOT, 'database.sql')) as f:
+        script = f.read()
+    # the script creates and selects `nearfix` itself; run it in the scratch database instead
+    script = re.sub(r'^(CREATE DATABASE|USE) .*$', '', script, flags=re.MULTILINE)
+    conn = MySQLdb.connect(**server)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"DROP DATABASE IF EXISTS `{params['database']}`")
+        cursor.execute(f"CREATE DATABASE `{params['database']}`")
+        cursor.execute(f"USE `{params['database']}`")
+        for statement in sql_statements(script):
+            cursor.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@pytest.fixture(params=['sqlite', 'mysql'])
+def repo(request):
+    if request.param == 'sqlite':
+        pool = ConnectionPool(request.getfixturevalue('sqlite_database'))
+    else:
+        params = mysql_params()
+        try:
+            load_mysql_schema(params)
+        except Exception as e:
+            pytest.skip(f'MySQL is not reachable: {e}')
+        pool = MySQLConnectionPool(**params)
+    writes = []
+    repo = Repository(pool.acquire, on_write=lambda: writes.append(1))
+    repo.writes = writes
+    return repo
+
+
+def add_user(repo, name='alice'):
+    return repo.create_user(name, f'{name}@example.com', 'hash', name.title(), '555', 'somewhere')
+
+
+def add_helper(repo, name='bob', service_type_id=1, latitude=28.6, longitude=77.2):
+    return repo.create_helper(name, f'{name}@example.com', 'hash', name.title(), '555', service_type_id,
+                              latitude, longitude)
+
+
+def test_accounts(repo):
+    user_id = add_user(repo)
+    assert repo.account_by_username('user', 'alice')['user_id'] == user_id
+    assert repo.identity('user', user_id)['full_name'] == 'Alice'
+    assert repo.account_by_username('user', 'nobody') is None
+    with pytest.raises(DuplicateAccount):
+        add_user(repo)
+    repo.replace_password_hash('user', user_id, 'stale', 'new')
+    assert repo.account_by_username('user', 'alice')['password'] == 'hash'
+    repo.replace_password_hash('user', user_id, 'hash', 'new')
+    assert repo.account_by_username('user', 'alice')['password'] == 'new'
+    assert repo.writes
+
+
+def test_helper_approval_and_counters(repo):
+    counters = repo.stats_counters()
+    first = add_helper(repo, 'bob', service_type_id=1)
+    add_helper(repo, 'carol', service_type_id=2)
+    add_helper(repo, 'dave', service_type_id=1, latitude=None, longitude=None)
+    assert repo.helper_taken('bob', 'other@example.com')
+    assert not repo.helper_taken('eve', 'eve@example.com')
+    assert {row['username'] for row in repo.pending_helpers()} == {'bob', 'carol', 'dave'}
+
+    assert repo.approve_helpers(service_type_id=1, with_location=True) == 1
+    assert repo.identity('helper', first)['is_approved'] == 1
+    assert {row['username'] for row in repo.pending_helpers()} == {'carol', 'dave'}
+    assert repo.stats_counters()['total_helpers'] == counters['total_helpers'] + 3
+    assert repo.stats_counters()['pending_helpers'] == counters['pending_helpers'] + 2
+
+
+def test_request_lifecycle(repo):
+    user_id = add_user(repo)
+    helper_id = add_helper(repo)
+    repo.approve_helper(helper_id)
+    request_ids = [repo.create_request(user_id, 1, f'job {n}', 'leaking tap', 28.6, 77.2, 'here')
+                   for n in range(3)]
+
+    page = repo.dashboard_requests('user', user_id, FIRST_PAGE, 2)
+    assert [row['request_id'] for row in page] == request_ids[:0:-1]
+    rest = repo.dashboard_requests('user', user_id, (page[-1]['created_at'], page[-1]['request_id']), 2)
+    assert [row['request_id'] for row in rest] == request_ids[:1]
+
+    assert not repo.move_request(request_ids[0], 'accepted', 'in_progress')
+    assert repo.move_request(request_ids[0], 'pending', 'cancelled')
+    assert repo.request_status(request_ids[0])['status'] == 'cancelled'
+    assert [(event['from_status'], event['to_status']) for event in repo.request_history(request_ids[0])] == [
+        (None, 'pending'), ('pending', 'cancelled')]
+    assert repo.last_event_id() > 0
+
+
+def test_export_batches(repo):
+    for name in ('alice', 'bob', 'carol'):
+        add_user(repo, name)
+    batches = list(repo.export_batches('users', ('user_id', 'username'), 'user_id', batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert [row['username'] for batch in batches for row in batch] == ['alice', 'bob', 'carol']
+
+
+def test_changed_requests(repo):
+    user_id = add_user(repo)
+    first, second = (repo.create_request(user_id, 1, 'job', 'leaking tap', None, None, None) for _ in range(2))
+    rows = repo.changed_requests('user', user_id, (0,), 10)
+    assert [row['request_id'] for row in rows] == [first, second]
+    position = rows[-1]['change_seq']
+    assert repo.changed_requests('user', user_id, (position,), 10) == []
+
+    repo.move_request(first, 'pending', 'cancelled')
+    rows = repo.changed_requests('admin', None, (position,), 10)
+    assert [(row['request_id'], row['status']) for row in rows] == [(first, 'cancelled')]
+    assert rows[0]['change_seq'] > position
+    # an (updated_at, request_id) cursor from before change_seq skips nothing
+    assert [row['request_id'] for row in repo.changed_requests('user', user_id, (('', 0),), 10)] == [second, first]
+
+
+def test_helper_imports(repo):
+    assert not repo.recent_imports()
+    first = repo.create_import('a.csv', '/tmp/a.csv', 'csv', False)
+    second = repo.create_import('b.ndjson', '/tmp/b.ndjson', 'ndjson', 'on')
+    assert second > first
+    rows = repo.recent_imports()
+    assert [(row['import_id'], row['filename'], row['status']) for row in rows] == [
+        (second, 'b.ndjson', 'queued'), (first, 'a.csv', 'queued')]
+    assert rows[0]['report'] is None and rows[0]['finished_at'] is None
+    assert repo.writes